@@ -27,14 +27,27 @@
 
 import logging
 import os
+import socket
 import stat
+import sys
+import tempfile
+from .asyncproxy import AsyncFixToolProxy
 from .proxy import FixToolProxy
 from .version import VERSION
 
 
-def spawn_agent():
+# Number of agents spawned by this process, used to name their sockets.
+_spawn_count = 0
+
+
+def spawn_agent(loop: str = None, workers: int = None):
     """Create a new agent, and associated proxy.
 
+    :param loop: Event loop implementation for the agent: "asyncio"
+    (the default) or "uvloop".  If uvloop isn't installed, the agent
+    falls back to asyncio.
+    :param workers: If greater than one, shard the agent's clients and
+    servers across this many worker processes.
     :returns: Reference to proxy, or None on error."""
 
     # Spawned agents are spawned from the calling process, and usually
@@ -46,6 +59,11 @@ def spawn_agent():
     # can be read by the proxy which subsequently connects to it on
     # that port.
     #
+    # Where the platform supports it, the agent instead listens on a
+    # Unix domain socket, named for this process, and reports its path
+    # as "unix:<path>".  This is quicker than loopback TCP, and doesn't
+    # use up ephemeral ports.
+    #
     # The agent can be explicitly shutdown at any time by the proxy,
     # but will also be implicitly killed if the proxy instance is
     # deleted.
@@ -75,7 +93,22 @@ def spawn_agent():
 
     logging.info("Using agent: %s", fixtool_agent)
 
-    agent = os.popen(fixtool_agent + ' start')
+    command = fixtool_agent + ' start'
+    if loop:
+        command += ' --loop ' + loop
+    if workers:
+        command += ' --workers ' + str(workers)
+    if hasattr(socket, "AF_UNIX"):
+        global _spawn_count
+        _spawn_count += 1
+        tmpdir = "/tmp" if sys.platform == "darwin" else tempfile.gettempdir()
+        unix_path = os.path.join(tmpdir, "fixtool-%d-%d.sock"
+                                 % (os.getpid(), _spawn_count))
+        if os.path.exists(unix_path):
+            os.unlink(unix_path)
+        command += ' --unix ' + unix_path
+
+    agent = os.popen(command)
     status = agent.readline()
     agent.close()  # Just the parent; the forked agent is still running
 
@@ -85,21 +118,32 @@ def spawn_agent():
         logging.error("Failed to start agent: %s", status)
         return None
 
+    # A spawned agent is always the same version as this proxy, so it
+    # is safe to use binary frames.
+    address = status[3:].strip()
+    if address.startswith("unix:"):
+        return FixToolProxy(None, None, binary=True, unix_path=address[5:])
+
     try:
-        port = int(status[3:])
+        port = int(address)
     except ValueError:
         logging.error("Unable to read port number from agent output")
         return None
 
-    agent_proxy = FixToolProxy("localhost", port)
+    agent_proxy = FixToolProxy("localhost", port, binary=True)
     return agent_proxy
 
 
-def connect_agent(host: str, port: int):
+def connect_agent(host: str = None, port: int = None, binary: bool = False,
+                  unix_path: str = None):
     """Create a proxy, and connect it to an existing agent.
 
     :param host: String host name or IP address for the agent.
-    :param port: Integer TCP port number for the agent."""
+    :param port: Integer TCP port number for the agent.
+    :param binary: If True, use binary frames for FIX messages.  The
+    agent must support this.
+    :param unix_path: Unix domain socket path for the agent, used
+    instead of host and port."""
 
-    agent_proxy = FixToolProxy(host, port)
+    agent_proxy = FixToolProxy(host, port, binary, unix_path)
     return agent_proxy
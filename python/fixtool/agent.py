@@ -28,6 +28,8 @@
 import argparse
 import asyncio
 import base64
+import collections
+import itertools
 import json
 import logging
 import os
@@ -38,13 +40,43 @@ import sys
 import tempfile
 import time
 
-import simplefix
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
 
+from fixtool.framing import FixFramer, WireMessage, split_messages
+from fixtool.heartbeat import Heartbeat
+from fixtool.journal import DIRECTIONS, RECEIVED, SENT, check_sync_interval
+from fixtool.journal import open_journal
 # pylint: disable=unused-wildcard-import
 from fixtool.message import *
+from fixtool.message import BINARY_HEADER
 from fixtool.proxy import FixToolProxy
+from fixtool.session import SequenceNumbers, SessionLayer
+from fixtool.shmring import DEFAULT_RING_SIZE, SharedChannel
+from fixtool.timerwheel import TimerWheel
 from fixtool.version import VERSION
 
+# Length header preceding each control protocol frame.
+FRAME_HEADER = struct.Struct(">L")
+
+# Valid payload lengths for binary frames that take fixed arguments: an
+# optional timeout for get, and the limits for get all.
+FRAME_PAYLOAD_LENGTHS = {OP_CLIENT_GET: (0, 4), OP_SESSION_GET: (0, 4),
+                         OP_CLIENT_GET_ALL: (8,), OP_SESSION_GET_ALL: (8,)}
+
+# Options accepted by client and server session 'configure' requests.
+CONFIGURE_OPTIONS = ("queue_capacity", "queue_policy",
+                     "write_high_watermark", "write_low_watermark",
+                     "write_notify", "raw",
+                     "auto_heartbeat", "heartbeat_interval",
+                     "auto_sequence", "next_send_sequence",
+                     "next_receive_sequence", "session_layer",
+                     "begin_string", "sender_comp_id", "target_comp_id",
+                     "journal", "journal_sync_interval")
+
 # Log level names, from argv.
 LOGLEVELS = {
     "DEBUG": logging.DEBUG,
@@ -54,467 +86,1886 @@ LOGLEVELS = {
     "CRITICAL": logging.CRITICAL
 }
 
+# Event loop implementations, from argv.
+EVENT_LOOPS = ("asyncio", "uvloop")
 
-class Client:
-    """Simulated FIX client."""
 
-    def __init__(self, name: str):
-        """Constructor."""
-        self._name = name
-        self._comp_id = b''
-        self._auto_heartbeat = True
-        self._auto_sequence = True
-        self._raw = False
-        self._next_send_sequence = 0
-        self._last_seen_sequence = 0
-        self._host = None
-        self._port = None
-        self._is_connected = False
+class ReceiveQueue(object):
+    """Queue of received FIX messages, with optional capacity limit.
+
+    When the queue is at capacity, its policy determines what happens to
+    newly received messages:
+
+    - "block": the message is queued, and the owner stops reading from
+      its socket until the queue has room, pushing back on the peer.
+    - "drop_oldest": the oldest queued message is discarded.
+    - "drop_newest": the new message is discarded.
+    - "spill": the message is written to a temporary file, and read
+      back as the queue is drained."""
+
+    POLICIES = ("block", "drop_oldest", "drop_newest", "spill")
+
+    def __init__(self, capacity: int = None, policy: str = "block"):
+        """Constructor.
+
+        :param capacity: Maximum number of messages held in memory, or
+        None for no limit.
+        :param policy: Behaviour when at capacity; one of POLICIES."""
+        self._messages = collections.deque()
+        self._capacity = None
+        self._policy = "block"
+        self._dropped = 0
 
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.setblocking(True)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._spill = None
+        self._spill_count = 0
+        self._spill_offset = 0
 
-        self._parser = simplefix.FixParser()
-        self._queue = []
+        self.configure(capacity, policy)
         return
 
-    def destroy(self):
-        """Destroy the client instance."""
-        if self._is_connected:
-            self.disconnect()
+    def __len__(self):
+        return len(self._messages) + self._spill_count
+
+    def capacity(self):
+        """Return the queue's capacity, or None if unlimited."""
+        return self._capacity
+
+    def policy(self) -> str:
+        """Return the queue's overflow policy."""
+        return self._policy
+
+    def dropped_count(self) -> int:
+        """Return the number of messages discarded due to overflow."""
+        return self._dropped
 
+    @classmethod
+    def check(cls, capacity: int, policy: str):
+        """Raise ValueError if a capacity or overflow policy is invalid.
+
+        :param capacity: As for configure().
+        :param policy: As for configure()."""
+        if capacity is not None and (not isinstance(capacity, int) or
+                                     capacity < 1):
+            raise ValueError("Bad queue capacity: %s" % str(capacity))
+        if policy not in cls.POLICIES:
+            raise ValueError("Bad queue policy: %s" % str(policy))
         return
 
-    def connect(self, host: str, port: int):
-        """Attempt connection to a FIX server.
+    def configure(self, capacity: int, policy: str):
+        """Change the queue's capacity and overflow policy.
 
-        :param host: Server's host name or IP address.
-        :param port: Server's TCP port number."""
-        self._host = host
-        self._port = port
-        self._socket.connect((self._host, self._port))
-        self._is_connected = True
+        :param capacity: Maximum number of messages held in memory, or
+        None for no limit.
+        :param policy: Behaviour when at capacity; one of POLICIES.
+
+        Raises ValueError if either is invalid."""
+        self.check(capacity, policy)
+        self._capacity = capacity
+        self._policy = policy
+
+        if policy != "spill":
+            # Bring back any spilled messages, even past capacity.
+            while self._spill_count:
+                self._messages.append(self.unspill())
+        else:
+            self.refill()
 
-        asyncio.get_event_loop().add_reader(self._socket, self.readable)
+        if policy == "drop_oldest" and capacity is not None:
+            while len(self._messages) > capacity:
+                self._messages.popleft()
+                self._dropped += 1
         return
 
-    def is_connected(self):
-        """Returns True if this client is connected to a server."""
-        return self._is_connected
+    def is_full(self) -> bool:
+        """Return True if the in-memory queue is at or over capacity."""
+        return self._capacity is not None and \
+            len(self._messages) >= self._capacity
+
+    def is_blocked(self) -> bool:
+        """Return True if the owner should stop reading its socket."""
+        return self._policy == "block" and self.is_full()
+
+    def append(self, message: bytes) -> bool:
+        """Add a message to the end of the queue.
+
+        :param message: Byte array of received FIX message.
+        :returns: False if the message was discarded."""
+        if self._spill_count:
+            # Keep messages in order, behind those already spilled.
+            self.spill(message)
+            return True
+
+        if not self.is_full() or self._policy == "block":
+            self._messages.append(message)
+            return True
+
+        if self._policy == "drop_oldest":
+            self._messages.popleft()
+            self._messages.append(message)
+            self._dropped += 1
+            return True
+
+        if self._policy == "drop_newest":
+            self._dropped += 1
+            return False
+
+        self.spill(message)
+        return True
+
+    def popleft(self):
+        """Remove and return the first message, or None if empty."""
+        if not self._messages:
+            return None
 
-    def disconnect(self):
-        """Close the active server connection for this client."""
-        asyncio.get_event_loop().remove_reader(self._socket)
-        self._socket.close()
-        self._is_connected = False
+        message = self._messages.popleft()
+        if self._spill_count:
+            self.refill()
+        return message
+
+    def take(self, max_count: int = None, max_bytes: int = None):
+        """Remove and return messages from the front of the queue.
+
+        :param max_count: Maximum number of messages to return, or None.
+        :param max_bytes: Maximum total size of the returned messages, or
+        None.  The first queued message is always returned, even if it
+        is larger than this limit."""
+        messages = []
+        total = 0
+        while self._messages:
+            if max_count is not None and len(messages) >= max_count:
+                break
+
+            length = len(self._messages[0])
+            if max_bytes is not None and messages and \
+                    total + length > max_bytes:
+                break
+
+            messages.append(self.popleft())
+            total += length
+        return messages
+
+    def clear(self):
+        """Discard all queued messages."""
+        self._messages.clear()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self._spill_count = 0
+        self._spill_offset = 0
         return
 
-    def readable(self):
-        """Handle received data on the client's server connection.
+    def spill(self, message: bytes):
+        """Write a message to the end of the spill file."""
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        self._spill.seek(0, os.SEEK_END)
+        self._spill.write(FRAME_HEADER.pack(len(message)) + message)
+        self._spill_count += 1
+        return
 
-        This method actually parses the message content, so it must
-        be well-formed FIX, so that it can detect the end of the
-        message.  This is perhaps not ideal, but ..."""
-        buf = self._socket.recv(65536)
-        if not buf:
-            self.disconnect()
+    def unspill(self) -> bytes:
+        """Read the first message from the spill file."""
+        self._spill.seek(self._spill_offset)
+        length = FRAME_HEADER.unpack(self._spill.read(FRAME_HEADER.size))[0]
+        message = self._spill.read(length)
+        self._spill_offset += FRAME_HEADER.size + length
+        self._spill_count -= 1
+
+        if not self._spill_count:
+            self._spill.truncate(0)
+            self._spill_offset = 0
+        return message
+
+    def refill(self):
+        """Move spilled messages back into memory, once half drained."""
+        if self._capacity is not None and \
+                len(self._messages) > self._capacity // 2:
             return
 
-        self._parser.append_buffer(buf)
-        message = self._parser.get_message()
-        while message is not None:
-            self._queue.append(message.encode())
-            message = self._parser.get_message()
+        while self._spill_count and not self.is_full():
+            self._messages.append(self.unspill())
         return
 
-    def receive_queue_length(self) -> int:
-        """Return the number of messages on the received message queue."""
-        return len(self._queue)
-
-    def get_message(self):
-        """Return the first message from the received message queue."""
-        if self.receive_queue_length() < 1:
-            return None
-        return self._queue.pop(0)
 
-    def send_message(self, message: bytes):
-        """Send a message to the connected server session.
+class WriteBuffer(object):
+    """Outbound data for a FIX connection, written by its transport.
 
-        :param message: Byte array of formatted FIX message to send.
+    Data that can't be written immediately is buffered by the transport,
+    and written when the socket becomes writable, so a slow peer doesn't
+    block the agent.  When the amount buffered rises above the high
+    watermark, the transport pauses writing, and it resumes once the
+    buffer drains to the low watermark.  Listeners are told of each
+    change.
 
-        The message has been received via the control protocol, where
-        it was wrapped/unwrapped in BASE64, and we assume it is good.
-        We send it as-is."""
-        self._socket.sendall(message)
-        return
+    Writing raises OSError while there's no connection, unless hold()
+    was called, in which case data is held until a transport is
+    attached."""
 
+    DEFAULT_HIGH_WATERMARK = 64 * 1024
+    DEFAULT_LOW_WATERMARK = 16 * 1024
 
-class Server:
     def __init__(self):
         """Constructor."""
-        self._auto_heartbeat = True
-        self._auto_sequence = True
-        self._raw = False
-        self._next_send_sequence = 0
-        self._last_seen_sequence = 0
-        self._pending_sessions = []
-        self._accepted_sessions = {}
+        self._transport = None
+        self._pending = bytearray()
+        self._closed = True
+        self._high = self.DEFAULT_HIGH_WATERMARK
+        self._low = self.DEFAULT_LOW_WATERMARK
+        self._paused = False
+        self._listeners = {}
+        return
 
-        self._socket = None
+    def attach(self, transport: asyncio.WriteTransport):
+        """Start writing to a connected transport.
+
+        :param transport: Transport for the FIX connection."""
+        self._transport = transport
+        self._closed = False
+        self._transport.set_write_buffer_limits(self._high, self._low)
+        if self._pending:
+            pending = bytes(self._pending)
+            self._pending.clear()
+            self._transport.write(pending)
         return
 
-    def destroy(self):
-        """Destroy the server instance."""
-        if self._socket is not None:
-            self.unlisten()
+    def hold(self):
+        """Accept data before a transport is attached, holding it until
+        attach() is called."""
+        self._closed = False
+        return
 
-        for session in self._pending_sessions:
-            session.destroy()
-        self._pending_sessions = []
+    def detach(self):
+        """Stop writing, discarding any data not yet attached."""
+        self._transport = None
+        self._pending.clear()
+        self._closed = True
+        self.set_paused(False)
+        return
 
-        for session in self._accepted_sessions.values():
-            session.destroy()
-        self._accepted_sessions = {}
+    def buffered(self) -> int:
+        """Return the number of bytes waiting to be written."""
+        if self._transport is None:
+            return len(self._pending)
+        return self._transport.get_write_buffer_size()
+
+    def is_paused(self) -> bool:
+        """Return True if the buffer is above its high watermark."""
+        return self._paused
+
+    def is_closed(self) -> bool:
+        """Return True if data can't be written."""
+        return self._closed
+
+    def watermarks(self):
+        """Return the (high, low) watermarks, in bytes."""
+        return self._high, self._low
+
+    @staticmethod
+    def check_watermarks(high: int, low: int):
+        """Raise ValueError if watermarks are invalid.
+
+        :param high: As for set_watermarks().
+        :param low: As for set_watermarks()."""
+        if not isinstance(high, int) or not isinstance(low, int) or \
+                low < 0 or high < low:
+            raise ValueError("Bad watermarks: high %s, low %s"
+                             % (str(high), str(low)))
         return
 
-    def is_raw(self):
-        """Is this server configured in 'raw' mode?"""
-        return self._raw
+    def set_watermarks(self, high: int, low: int):
+        """Change the watermarks.
 
-    def listen(self, port):
-        """Listen for client connections.
+        :param high: Buffer size above which to pause, in bytes.
+        :param low: Buffer size at which to resume, in bytes.
 
-        :param port: TCP port number to listen on."""
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.setblocking(False)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._socket.bind(('', port))
-        self._socket.listen(5)
-        actual_port = self._socket.getsockname()[1]
+        Raises ValueError if they're invalid."""
+        self.check_watermarks(high, low)
+        self._high = high
+        self._low = low
+        if self._transport is not None:
+            self._transport.set_write_buffer_limits(high, low)
+        return
 
-        asyncio.get_event_loop().add_reader(self._socket, self.acceptable)
-        return actual_port
+    def add_listener(self, key, callback):
+        """Report changes in paused state.
 
-    def unlisten(self):
-        """Stop listening for client connections."""
-        asyncio.get_event_loop().remove_reader(self._socket)
-        self._socket.close()
-        self._socket = None
+        :param key: Key identifying the listener.
+        :param callback: Function called with paused flag, and the
+        number of bytes buffered."""
+        self._listeners[key] = callback
         return
 
-    def acceptable(self):
-        """Handle readable event on listening socket."""
-        sock, _ = self._socket.accept()
-        session = ServerSession(self, sock)
-        self._pending_sessions.append(session)
+    def remove_listener(self, key):
+        """Stop reporting changes in paused state to a listener.
+
+        :param key: Key identifying the listener."""
+        self._listeners.pop(key, None)
         return
 
-    def pending_client_count(self):
-        """Return number of pending client sessions."""
-        return len(self._pending_sessions)
+    def write(self, data: bytes):
+        """Write data to the transport, which buffers whatever won't fit.
 
-    def accept_client_session(self, name: str):
-        """Accept a pending client session.
+        :param data: Byte array to write.
 
-        :param name: Name for client session."""
+        Raises OSError if there's no connection."""
+        if self._closed:
+            raise OSError("Not connected")
 
-        if self.pending_client_count() < 1:
-            return None
+        if self._transport is None:
+            self._pending += data
+            return
 
-        client = self._pending_sessions.pop(0)
-        client.set_name(name)
-        self._accepted_sessions[name] = client
-        return client
+        self._transport.write(data)
+        return
 
+    def set_paused(self, paused: bool):
+        """Handle the transport pausing or resuming writing.
 
-class ServerSession:
-    """Server state of an active client connection."""
+        :param paused: True if paused, False if resumed."""
+        if paused == self._paused:
+            return
 
-    def __init__(self, server: Server, sock: socket.SocketType):
-        """Constructor.
+        self._paused = paused
+        buffered = self.buffered()
+        for callback in list(self._listeners.values()):
+            callback(paused, buffered)
+        return
 
-        :param server: Server instance that owns this session.
-        :param sock: ephemeral sock for this session."""
-        self._server = server
-        self._socket = sock
-        self._name = None
-        self._parser = simplefix.FixParser()
-        self._is_connected = True
-        self._queue = []
 
-        asyncio.get_event_loop().add_reader(sock, self.readable)
-        return
+# Base class for FIX and control connection protocols.  Buffered
+# protocols read into a buffer they provide, rather than being given
+# newly allocated bytes for each read; they need Python 3.7 or later.
+if hasattr(asyncio, "BufferedProtocol"):
+    BaseProtocol = asyncio.BufferedProtocol
+else:
+    BaseProtocol = asyncio.Protocol
 
-    def destroy(self):
-        """Destroy the active session to a client."""
-        if self._is_connected:
-            self.disconnect()
-        self._queue = []
-        return
 
-    def set_name(self, name: str):
-        """Set the user-visible name of this session.
+class FixProtocol(BaseProtocol):
+    """Connection protocol for a client or server session.
 
-        :param name: User-visible name for this session, as used
-        in logging, etc."""
-        self._name = name
-        return
+    Reads into a single receive buffer, reused for each read, and passes
+    events through to the owning client or server session."""
 
-    def readable(self):
-        """Handle readable event on session's socket."""
-        buf = self._socket.recv(65536)
-        if not buf:
-            self._is_connected = False
-            return
+    RECEIVE_BUFFER_SIZE = 65536
+
+    def __init__(self, owner):
+        """Constructor.
 
-        self._parser.append_buffer(buf)
-        msg = self._parser.get_message()
-        while msg is not None:
-            self._queue.append(msg.encode())
-            msg = self._parser.get_message()
+        :param owner: Client or ServerSession."""
+        self._owner = owner
+        self._transport = None
+        self._buffer = bytearray(self.RECEIVE_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
         return
 
-    def is_connected(self) -> bool:
-        """Return True if session is connected."""
-        return self._is_connected
+    def close(self):
+        """Close the transport, and stop passing events to the owner.
 
-    def disconnect(self):
-        """Close this session."""
-        asyncio.get_event_loop().remove_reader(self._socket)
-        self._socket.close()
-        self._socket = None
-        self._is_connected = False
+        The owner may reconnect before the transport reports that the
+        connection was lost, so later events are ignored."""
+        self._owner = None
+        if self._transport is not None:
+            self._transport.close()
         return
 
-    def receive_queue_length(self) -> int:
-        """Return the number of messages on the received message queue."""
-        return len(self._queue)
+    def connection_made(self, transport):
+        self._transport = transport
+        if self._owner is not None:
+            self._owner.connection_made(transport)
+        return
 
-    def get_message(self):
-        """Return the first message from the received message queue."""
-        if self.receive_queue_length() < 1:
-            return None
-        return self._queue.pop(0)
+    def connection_lost(self, exc):
+        self._transport = None
+        if self._owner is not None:
+            self._owner.connection_lost(exc)
+        return
 
-    def send_message(self, message: bytes):
-        """Send a message to the connected client.
+    def get_buffer(self, sizehint):
+        return self._view
 
-        :param message: Byte array of formatted FIX message to send."""
-        self._socket.sendall(message)
+    def buffer_updated(self, nbytes):
+        if self._owner is not None:
+            self._owner.data_received(bytes(self._view[:nbytes]))
         return
 
+    def data_received(self, data):
+        if self._owner is not None:
+            self._owner.data_received(data)
+        return
 
-class ControlSession:
-    """Control client session."""
-
-    def __init__(self, sock: socket.SocketType):
-        """Constructor.
+    def pause_writing(self):
+        if self._owner is not None:
+            self._owner.write_buffer().set_paused(True)
+        return
 
-        :param sock: Accepted socket."""
-        self._socket = sock
-        self._buffer = b''
+    def resume_writing(self):
+        if self._owner is not None:
+            self._owner.write_buffer().set_paused(False)
         return
 
-    def append_bytes(self, buffer: bytes):
-        """Receive a buffer of bytes from this control client.
 
-        :param buffer: Array of bytes from client."""
-        self._buffer += buffer
-        if len(self._buffer) <= 4:
-            # No payload yet
-            return None
+class FixEntity:
+    """A FIX connection: a client, or a server's session with a client.
 
-        payload_length = struct.unpack(b'>L', self._buffer[:4])[0]
-        if len(buffer) < 4 + payload_length:
-            # Not received full message yet
-            return None
-        self._buffer = self._buffer[4:]
+    Holds the state and behaviour they share: the received message
+    queue, the outbound buffer, and the heartbeat, sequence number,
+    session layer and journal features."""
 
-        # FIXME: deal with the case where there's multiple control
-        # FIXME: messages in the buffer.
+    def __init__(self, name: str, initiator: bool, timers: TimerWheel):
+        """Constructor.
 
-        payload = self._buffer[:payload_length]
-        self._buffer = self._buffer[payload_length:]
-        return payload
+        :param name: Name, or None if not yet known.
+        :param initiator: True for a client, False for a server session.
+        :param timers: Agent's shared timer wheel."""
+        self._name = name
+        self._auto_heartbeat = True
+        self._heartbeat_interval = 0
+        self._auto_sequence = False
+        self._session_layer = False
+        self._raw = False
+        self._is_connected = False
+        self._destroyed = False
+        self._transport = None
+        self._writer = WriteBuffer()
+        self._timers = timers
+        self._journal = None
+        self._journal_sync_interval = None
+        self._heartbeat = Heartbeat(self, timers)
+        self._sequence = SequenceNumbers(name)
+        self._session = SessionLayer(self, initiator, self._heartbeat,
+                                     self._sequence, timers)
+
+        self._framer = FixFramer()
+        self._queue = ReceiveQueue()
+        self._paused = False
+        self._subscribers = {}
+        self._waiters = []
+        return
 
-    def send(self, payload: bytes):
-        """Send a buffer to the control client.
+    def destroy(self):
+        """Disconnect, and close the journal."""
+        self._destroyed = True
+        if self._is_connected:
+            self.disconnect()
+        self.set_journal(False, None)
+        return
 
-        :param payload: Array of bytes to send to client."""
+    def connection_lost(self, exc):
+        """Handle the connection being closed.
 
-        payload_length = len(payload)
-        header = struct.pack(">L", payload_length)
-        self._socket.sendall(header + payload)
+        :param exc: Exception, or None if closed normally."""
+        self._transport = None
+        self._is_connected = False
+        self._writer.detach()
+        self._heartbeat.stop()
+        self._session.disconnected()
         return
 
-    def close(self):
-        """Close this connection."""
-        self._socket.close()
+    def is_connected(self):
+        """Return True if connected to the peer."""
+        return self._is_connected
+
+    def disconnect(self):
+        """Close the connection.
+
+        Data already written is still sent before the socket closes.
+        With the session layer enabled, that includes a Logout."""
+        if self._session_layer:
+            self._session.logout()
+        self._writer.detach()
+        if self._transport is not None:
+            self._transport.get_protocol().close()
+            self._transport = None
+        self._paused = False
+        self._is_connected = False
+        self._heartbeat.stop()
+        self._session.disconnected()
         return
 
+    def data_received(self, buf: bytes):
+        """Handle received data on the connection.
+
+        :param buf: Byte array of received data.
+
+        Messages are framed using their BodyLength field, and queued
+        exactly as received, without being parsed."""
+        for message in self._framer.append_buffer(buf):
+            self.record(RECEIVED, message)
+
+            # Features looking at fields share one lazily built index.
+            wire = WireMessage(message)
+            if self._session_layer:
+                self._heartbeat.received(wire, True)
+                if not self._session.received(wire):
+                    continue
+            else:
+                if self._auto_sequence:
+                    self._sequence.check(wire)
+                self._heartbeat.received(wire, self._raw)
+            self.deliver(message)
+
+        if self._queue.is_blocked():
+            self.pause_reading()
+        return
 
-class FixToolAgent(object):
-    """Main class for the simulation agent."""
+    def deliver(self, message: bytes):
+        """Pass a received message to subscribers, or queue it.
 
-    def __init__(self, port=0):
-        """Constructor.
+        :param message: Byte array of received FIX message."""
+        if not self._subscribers:
+            if self._queue.append(message):
+                self.wake_waiters()
+            return
 
-        :param port: TCP port number for accepting control sessions."""
-        self._socket = None
-        self._loop = None
+        for callback in self._subscribers.values():
+            callback(message)
+        return
 
-        self._control_sessions = {}
-        self._clients = {}
-        self._servers = {}
-        self._server_sessions = {}
+    def subscribe(self, subscriber, callback):
+        """Deliver received messages to a subscriber, as they arrive.
 
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.setblocking(False)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._socket.bind(('0.0.0.0', port))
-        self._socket.listen(5)
+        :param subscriber: Key identifying the subscriber.
+        :param callback: Function called with each received message.
 
-        self._loop = asyncio.get_event_loop()
-        self._loop.add_reader(self._socket, self.accept)
-        self._loop.add_signal_handler(signal.SIGINT, self.handle_sigint)
+        Any messages already queued are delivered immediately."""
+        self._subscribers[subscriber] = callback
 
-        name = self._socket.getsockname()
-        self._port = name[1]
+        for message in self._queue.take():
+            callback(message)
+        self.resume_reading()
         return
 
-    def port(self):
-        """Get the active control sessions port number."""
-        return self._port
+    def unsubscribe(self, subscriber):
+        """Stop delivering received messages to a subscriber.
 
-    def run(self):
-        """Enter mainloop."""
-        self._loop.run_forever()
+        :param subscriber: Key identifying the subscriber."""
+        self._subscribers.pop(subscriber, None)
+        self._writer.remove_listener(subscriber)
         return
 
-    def stop(self):
-        """Exit mainloop."""
-        if self._loop.is_running():
-            self._loop.stop()
-            logging.debug("event loop stopped.")
+    def wake_waiters(self):
+        """Wake any requests waiting for a message to be queued."""
+        waiters = self._waiters
+        self._waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
         return
 
-    def reset(self):
-        """Clean up all simulated entities."""
+    async def wait_for_message(self, timeout: float):
+        """Wait until the received message queue is not empty.
+
+        :param timeout: Maximum time to wait, in seconds."""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        await self.settle()
+        while not self._queue:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                return
+        return
 
-        logging.info("agent reseting ...")
-        # Server listening sockets.
-        for server in self._servers.values():
-            server.destroy()
-        self._servers = {}
+    def receive_queue_length(self) -> int:
+        """Return the number of messages on the received message queue.
 
-        # Client sessions.
-        for client in self._clients.values():
-            client.destroy()
-        self._clients = {}
+        Use settle() first to include data already received by the
+        operating system, but not yet seen by the event loop."""
+        return len(self._queue)
 
-        # Server sessions are cleaned up by server.destroy()
-        self._server_sessions = {}
+    # Limit on event loop iterations in settle(), if data keeps arriving.
+    SETTLE_ITERATIONS = 100
+
+    async def settle(self):
+        """Wait for the event loop to process data already received.
+
+        Returns once the socket has no unread data, reading is paused
+        or the connection has closed.  Data arriving continuously could
+        keep the socket readable, so at most SETTLE_ITERATIONS
+        iterations of the event loop are run.  If unread data can't be
+        measured, this is best-effort: two iterations are run, the
+        first polling for I/O and the second after its callbacks."""
+        if self.unread_bytes() is None:
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            return
 
-        logging.info("agent reset complete.")
+        for _ in range(self.SETTLE_ITERATIONS):
+            if not self.unread_bytes():
+                break
+            await asyncio.sleep(0)
         return
 
-    def shutdown(self):
-        """Clean up for exit."""
-
-        logging.info("agent shutting down ...")
-        self.stop()
-        self.reset()
+    def unread_bytes(self):
+        """Return the number of bytes received by the operating system
+        but not yet read, or None if that can't be measured.
 
-        # Control sessions.
-        for sock, session in self._control_sessions.items():
-            self._loop.remove_reader(sock)
-            session.close()
-        self._control_sessions = {}
+        Zero is returned while reading is paused, or if not connected,
+        since there's nothing the event loop will read."""
+        if self._transport is None or self._paused:
+            return 0
 
-        # Control session listening socket.
-        self._loop.remove_reader(self._socket)
-        self._socket.close()
-        self._socket = None
-        self._port = None
+        sock = self._transport.get_extra_info("socket")
+        if fcntl is None or sock is None:
+            return None
+        try:
+            count = fcntl.ioctl(sock.fileno(), termios.FIONREAD,
+                                b"\0\0\0\0")
+        except (OSError, ValueError):
+            return 0
+        return struct.unpack("i", count)[0]
 
-        # Event loop.
-        self._loop.remove_signal_handler(signal.SIGINT)
-        self._loop.close()
-        self._loop = None
+    def get_message(self):
+        """Return the first message from the received message queue."""
+        if self.receive_queue_length() < 1:
+            return None
 
-        logging.info("agent shutdown complete.")
+        message = self._queue.popleft()
+        self.resume_reading()
+        return message
+
+    def get_messages(self, max_count: int = None, max_bytes: int = None):
+        """Remove and return messages from the received message queue.
+
+        :param max_count: Maximum number of messages to return, or None.
+        :param max_bytes: Maximum total size of the returned messages, or
+        None.  The first queued message is always returned, even if it
+        is larger than this limit."""
+        messages = self._queue.take(max_count, max_bytes)
+        self.resume_reading()
+        return messages
+
+    def pause_reading(self):
+        """Stop reading from the socket while the queue is full."""
+        if not self._paused:
+            self._paused = True
+            if self._transport is not None:
+                self._transport.pause_reading()
         return
 
-    def handle_sigint(self, *args):
-        """Handle SIGINT."""
-        # pylint: disable=unused-argument
-        logging.info("Exiting on C-c.")
-        self.stop()
+    def resume_reading(self):
+        """Resume reading from the socket, once the queue has room."""
+        if self._paused and not self._queue.is_blocked():
+            self._paused = False
+            if self._transport is not None:
+                self._transport.resume_reading()
         return
 
-    def accept(self):
-        """Accept a new control client connection."""
-        sock, addr = self._socket.accept()
-        self._loop.add_reader(sock, self.readable, sock)
-        self._control_sessions[sock] = ControlSession(sock)
+    def configure(self, options: dict):
+        """Change configurable options.
+
+        :param options: Dictionary of option names and values.  Options
+        not included are left unchanged.
+
+        Raises ValueError if an option or its value is invalid, having
+        changed none of them."""
+        self.check_options(options)
+
+        # Creating a journal can still fail, so it's done first.
+        self.set_journal(options.get("journal", self._journal is not None),
+                         options.get("journal_sync_interval",
+                                     self._journal_sync_interval))
+
+        self._queue.configure(options.get("queue_capacity",
+                                          self._queue.capacity()),
+                              options.get("queue_policy",
+                                          self._queue.policy()))
+        self.resume_reading()
+
+        high, low = self._writer.watermarks()
+        self._writer.set_watermarks(options.get("write_high_watermark", high),
+                                    options.get("write_low_watermark", low))
+        self.set_raw(options.get("raw", self._raw))
+        self.set_auto_heartbeat(options.get("auto_heartbeat",
+                                            self._auto_heartbeat),
+                                options.get("heartbeat_interval",
+                                            self._heartbeat_interval))
+        self.set_auto_sequence(options.get("auto_sequence",
+                                           self._auto_sequence),
+                               options.get("next_send_sequence"),
+                               options.get("next_receive_sequence"))
+        self._session.configure(options)
+        self.set_session_layer(options.get("session_layer",
+                                           self._session_layer))
+        return
 
-        logging.info("Accepted control session from %s", addr[0])
+    def check_options(self, options: dict):
+        """Raise ValueError if an option, or its value, is invalid.
+
+        :param options: As for configure().
+
+        Values are checked as they would be applied, together with the
+        current values of options not included."""
+        for key in options:
+            if key not in CONFIGURE_OPTIONS:
+                raise ValueError("Unknown option: %s" % key)
+
+        ReceiveQueue.check(options.get("queue_capacity",
+                                       self._queue.capacity()),
+                           options.get("queue_policy", self._queue.policy()))
+        high, low = self._writer.watermarks()
+        WriteBuffer.check_watermarks(options.get("write_high_watermark",
+                                                 high),
+                                     options.get("write_low_watermark", low))
+
+        for key in ("raw", "auto_heartbeat", "auto_sequence",
+                    "session_layer"):
+            if key in options and not isinstance(options[key], bool):
+                raise ValueError("Bad %s flag: %s" % (key, str(options[key])))
+        if options.get("session_layer", self._session_layer) and \
+                options.get("raw", self._raw):
+            raise ValueError("The session layer can't be used in raw mode")
+
+        if "heartbeat_interval" in options:
+            Heartbeat.check_interval(options["heartbeat_interval"])
+        SequenceNumbers.check_numbers(options.get("next_send_sequence"),
+                                      options.get("next_receive_sequence"))
+        SessionLayer.check_options(options)
+
+        location = options.get("journal")
+        if location and location is not True and \
+                not isinstance(location, str):
+            raise ValueError("Bad journal location: %s" % str(location))
+        check_sync_interval(options.get("journal_sync_interval"))
         return
 
-    def readable(self, sock):
-        """Handle readable event on a control client socket."""
-        logging.log(logging.DEBUG, "Control session readable")
-        control_session = self._control_sessions[sock]
-        buf = sock.recv(65536)
-        if not buf:
-            self._loop.remove_reader(sock)
-            del self._control_sessions[sock]
-            control_session.close()
-            logging.log(logging.INFO, "Disconnected control session.")
-            return
+    def set_raw(self, raw: bool):
+        """Enable or disable raw mode for received messages.
 
-        payload = control_session.append_bytes(buf)
-        while payload is not None:
-            message = json.loads(payload.decode())
-            self.handle_request(control_session, message)
-            payload = None  # FIXME: deal with multiple messages
+        :param raw: If True, the agent never looks inside received
+        messages; if False, agent-side features may read their fields.
 
+        Received messages are queued exactly as received in either
+        mode."""
+        if not isinstance(raw, bool):
+            raise ValueError("Bad raw flag: %s" % str(raw))
+        self._raw = raw
         return
 
-    def handle_request(self, client, message):
-        """Process a received message."""
+    def set_auto_heartbeat(self, enabled: bool, interval):
+        """Configure automatic heartbeats.
+
+        :param enabled: If True, send Heartbeats and TestRequests, and
+        answer received TestRequests.
+        :param interval: HeartBtInt, in seconds, or zero to disable.
+
+        Generated messages take the session's MsgSeqNums, so enabling
+        heartbeats implies automatic sequencing."""
+        if not isinstance(enabled, bool):
+            raise ValueError("Bad auto_heartbeat flag: %s" % str(enabled))
+        self._heartbeat.set_interval(interval if enabled else 0)
+        self._heartbeat_interval = interval
+        self._auto_heartbeat = enabled
+        self._auto_sequence = self._auto_sequence or \
+            self._heartbeat.interval() > 0
+        return
 
-        message_type = message["type"]
-        logging.debug("Dispatching [%s]", message_type)
+    def set_auto_sequence(self, enabled: bool, next_send: int = None,
+                          next_receive: int = None):
+        """Configure automatic sequence numbering.
+
+        :param enabled: If True, stamp MsgSeqNum and SendingTime into
+        sent messages, and check the MsgSeqNum of received messages.
+        :param next_send: MsgSeqNum for the next message sent, or None
+        to leave it unchanged.
+        :param next_receive: MsgSeqNum expected for the next message
+        received, or None to leave it unchanged.  Setting it discards
+        any recorded gaps."""
+        if not isinstance(enabled, bool):
+            raise ValueError("Bad auto_sequence flag: %s" % str(enabled))
+        self._sequence.set(next_send, next_receive)
+        self._auto_sequence = enabled or self._session_layer or \
+            self._heartbeat.interval() > 0
+        return
 
-        if message_type == "client_create":
-            self.handle_client_create(client, message)
+    def set_session_layer(self, enabled: bool):
+        """Enable or disable the session layer.
 
-        elif message_type == "client_destroy":
-            self.handle_client_destroy(client, message)
+        :param enabled: If True, the agent handles session-level
+        messages itself, from the next connection.  This implies
+        automatic sequencing.
 
-        elif message_type == "client_connect":
+        Raises ValueError if raw mode is also enabled."""
+        if not isinstance(enabled, bool):
+            raise ValueError("Bad session_layer flag: %s" % str(enabled))
+        if enabled and self._raw:
+            raise ValueError("The session layer can't be used in raw mode")
+        self._session_layer = enabled
+        self._auto_sequence = self._auto_sequence or enabled
+        return
+
+    def start_session(self):
+        """Start the session layer, or heartbeats, once connected."""
+        if self._session_layer:
+            self._session.connected()
+        else:
+            self._heartbeat.start()
+        return
+
+    def start_heartbeat(self, interval):
+        """Start heartbeats, once logged on.
+
+        :param interval: HeartBtInt agreed in the Logon exchange."""
+        if self._auto_heartbeat:
+            self._heartbeat.set_interval(interval)
+        return
+
+    def sequence_numbers(self):
+        """Return the next MsgSeqNum to send, the next expected to be
+        received, and a list of (first, last) inbound gaps."""
+        return (self._sequence.next_send, self._sequence.next_receive,
+                list(self._sequence.gaps))
+
+    def set_journal(self, location, sync_interval: float):
+        """Start or stop recording messages in a journal.
+
+        :param location: Directory for a new journal file, True for the
+        system's temporary directory, or False to close the journal.
+        A journal already open is kept.
+        :param sync_interval: See Journal."""
+        if not location:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+        elif self._journal is None:
+            self._journal = open_journal(location, sync_interval,
+                                         self._timers,
+                                         self._name or "session")
+        else:
+            self._journal.set_sync_interval(sync_interval)
+
+        self._journal_sync_interval = sync_interval
+        self._session.set_journal(self._journal)
+        return
+
+    def journal(self):
+        """Return the session's journal, or None."""
+        return self._journal
+
+    def record(self, direction: int, data: bytes, indexed: bool = True):
+        """Append messages to the journal, if enabled.
+
+        :param direction: SENT or RECEIVED.
+        :param data: Bytes of one or more complete messages.
+        :param indexed: See Journal.append().
+
+        A journal that fails is closed, rather than failing the send
+        or receive."""
+        if self._journal is None:
+            return
+
+        try:
+            self._journal.append(direction, data, indexed)
+        except (OSError, ValueError, struct.error) as e:
+            logging.error("%s: closing failed journal %s: %s", self._name,
+                          self._journal.path(), str(e))
+            journal = self._journal
+            self._journal = None
+            self._session.set_journal(None)
+            try:
+                journal.close()
+            except (OSError, ValueError) as e:
+                logging.error("%s: failed to close journal: %s",
+                              self._name, str(e))
+        return
+
+    def dropped_count(self) -> int:
+        """Return the number of received messages discarded on overflow."""
+        return self._queue.dropped_count()
+
+    def send_message(self, message: bytes):
+        """Send a message to the peer.
+
+        :param message: Byte array of formatted FIX message to send.
+
+        The message has been received via the control protocol, where
+        it was wrapped/unwrapped in BASE64, and we assume it is good.
+        We send it as-is, unless automatic sequencing is enabled.  The
+        binary protocol sends a batch of messages concatenated, so they're
+        split before being stamped.
+
+        Raises OSError if the entity isn't connected."""
+        if self._writer.is_closed():
+            raise OSError("Not connected")
+        if self._session_layer and not self._session.is_active():
+            self._session.hold(message)
+            return
+        if self._auto_sequence:
+            message = b''.join(self._sequence.stamp(part)
+                               for part in split_messages(message))
+        self._writer.write(message)
+        self.record(SENT, message)
+        self._heartbeat.sent(message, self._raw)
+        return
+
+    def send_messages(self, messages: list):
+        """Send several messages to the peer.
+
+        :param messages: List of byte arrays of formatted FIX messages.
+
+        The messages are written to the socket as a single buffer, to
+        minimise the number of system calls needed.  Raises OSError if
+        the entity isn't connected."""
+        if self._writer.is_closed():
+            raise OSError("Not connected")
+        if self._session_layer and not self._session.is_active():
+            for message in messages:
+                self._session.hold(message)
+            return
+        if self._auto_sequence:
+            messages = [self._sequence.stamp(message)
+                        for message in messages]
+        data = b''.join(messages)
+        self._writer.write(data)
+        self.record(SENT, data)
+        if messages:
+            self._heartbeat.sent(messages[-1], self._raw)
+        return
+
+    def write_buffer(self) -> WriteBuffer:
+        """Return the outbound buffer for the connection."""
+        return self._writer
+
+
+class Client(FixEntity):
+    """Simulated FIX client."""
+
+    def __init__(self, name: str, timers: TimerWheel):
+        """Constructor.
+
+        :param name: Client name.
+        :param timers: Agent's shared timer wheel."""
+        super().__init__(name, True, timers)
+        self._comp_id = b''
+        self._host = None
+        self._port = None
+        self._connecting = False
+        return
+
+    def is_connecting(self):
+        """Return True if a connection attempt is in progress."""
+        return self._connecting
+
+    def connect(self, host: str, port: int, timeout: float = None):
+        """Start connecting to a FIX server.
+
+        :param host: Server's host name or IP address.
+        :param port: Server's TCP port number.
+        :param timeout: Maximum time to wait for the connection to
+        complete, in seconds, or None to wait indefinitely.
+        :returns: Coroutine, to be awaited for the result.
+
+        The client is connecting from now until the coroutine
+        completes, so a second attempt can be refused at once."""
+        self._host = host
+        self._port = port
+        self._connecting = True
+        return self.complete_connect(host, port, timeout)
+
+    async def complete_connect(self, host: str, port: int,
+                               timeout: float = None):
+        """(Internal) Connect to a FIX server.
+
+        The event loop continues to run while connecting.  Raises
+        OSError (or asyncio.TimeoutError) if the connection fails, or
+        if the client is destroyed before it completes."""
+        loop = asyncio.get_event_loop()
+        try:
+            await asyncio.wait_for(
+                loop.create_connection(lambda: FixProtocol(self), host,
+                                       port, family=socket.AF_INET),
+                timeout)
+        finally:
+            self._connecting = False
+
+        if self._destroyed:
+            raise ConnectionAbortedError("Client '%s' was destroyed"
+                                         % self._name)
+        return
+
+    def connection_made(self, transport: asyncio.Transport):
+        """Handle the connection being established.
+
+        :param transport: Transport for the server connection.
+
+        If the client was destroyed while connecting, the connection is
+        closed without starting the session."""
+        if self._destroyed:
+            transport.close()
+            return
+
+        self._transport = transport
+        self._writer.attach(transport)
+        self._is_connected = True
+        if self._paused:
+            transport.pause_reading()
+        self.start_session()
+        return
+
+    def connection_lost(self, exc):
+        """Handle the connection being closed.
+
+        :param exc: Exception, or None if closed normally."""
+        if exc is not None:
+            logging.info("Client %s connection lost: %s",
+                         self._name, str(exc))
+        super().connection_lost(exc)
+        return
+
+
+class Server:
+    # Default listen backlog.  Bursts of connections beyond the backlog
+    # are refused, so it's not kept small.
+    DEFAULT_BACKLOG = 128
+
+    def __init__(self, timers: TimerWheel):
+        """Constructor.
+
+        :param timers: Agent's shared timer wheel, for sessions."""
+        self._timers = timers
+        self._session_options = {}
+        self._raw = False
+        self._pending_sessions = []
+        self._accepted_sessions = {}
+        self._waiters = []
+
+        self._socket = None
+        return
+
+    def destroy(self):
+        """Destroy the server instance."""
+        if self._socket is not None:
+            self.unlisten()
+
+        for session in self._pending_sessions:
+            session.destroy()
+        self._pending_sessions = []
+
+        for session in self._accepted_sessions.values():
+            session.destroy()
+        self._accepted_sessions = {}
+        return
+
+    def session_names(self) -> list:
+        """Return the names of the sessions accepted by this server."""
+        return list(self._accepted_sessions)
+
+    def configure(self, options: dict):
+        """Change options for sessions accepted from now on.
+
+        :param options: Dictionary of option names and values, as for a
+        server session.  Options not included are left unchanged.
+
+        Raises ValueError if an option is unknown.  Values are checked
+        as each session is accepted.  Sessions already accepted are
+        not changed."""
+        for key in options:
+            if key not in CONFIGURE_OPTIONS:
+                raise ValueError("Unknown option: %s" % key)
+
+        self._session_options.update(options)
+        return
+
+    def is_raw(self):
+        """Is this server configured in 'raw' mode?"""
+        return self._raw
+
+    def listen(self, port, backlog: int = None, reuse_port: bool = False):
+        """Listen for client connections.
+
+        :param port: TCP port number to listen on.
+        :param backlog: Maximum number of connections waiting to be
+        accepted, or None for the default.
+        :param reuse_port: If True, set SO_REUSEPORT, so that other
+        processes can listen on the same port, and the kernel spreads
+        incoming connections across them.
+
+        Raises OSError if the socket can't be bound."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(('', port))
+            sock.listen(backlog or self.DEFAULT_BACKLOG)
+        except OSError:
+            sock.close()
+            raise
+
+        self._socket = sock
+        actual_port = self._socket.getsockname()[1]
+
+        asyncio.get_event_loop().add_reader(self._socket, self.acceptable)
+        return actual_port
+
+    def unlisten(self):
+        """Stop listening for client connections."""
+        asyncio.get_event_loop().remove_reader(self._socket)
+        self._socket.close()
+        self._socket = None
+        return
+
+    def acceptable(self):
+        """Handle readable event on listening socket.
+
+        Accepts all connections waiting in the listen backlog."""
+        while self._socket is not None:
+            try:
+                sock, _ = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+
+            session = ServerSession(self, self._timers)
+            try:
+                session.configure(self._session_options)
+            except ValueError as e:
+                logging.warning("Bad session options: %s", str(e))
+            self._pending_sessions.append(session)
+            asyncio.ensure_future(session.attach(sock))
+
+        waiters = self._waiters
+        self._waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        return
+
+    def pending_client_count(self):
+        """Return number of pending client sessions.
+
+        Connections already completed by the operating system, but not
+        yet seen by the event loop, are included in the count."""
+        if self._socket is not None:
+            self.acceptable()
+        return len(self._pending_sessions)
+
+    async def wait_for_pending(self, timeout: float):
+        """Wait until there is a pending client session.
+
+        :param timeout: Maximum time to wait, in seconds."""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while self.pending_client_count() < 1:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                return
+        return
+
+    def accept_client_session(self, name: str):
+        """Accept a pending client session.
+
+        :param name: Name for client session."""
+
+        if self.pending_client_count() < 1:
+            return None
+
+        client = self._pending_sessions.pop(0)
+        client.set_name(name)
+        self._accepted_sessions[name] = client
+        return client
+
+
+class ServerSession(FixEntity):
+    """Server state of an active client connection."""
+
+    def __init__(self, server: Server, timers: TimerWheel):
+        """Constructor.
+
+        :param server: Server instance that owns this session.
+        :param timers: Agent's shared timer wheel.
+
+        The session is connected, but has no transport until attach()
+        completes; data sent before then is held by the write buffer."""
+        super().__init__(None, False, timers)
+        self._writer.hold()
+        self._server = server
+        self._attached = asyncio.get_event_loop().create_future()
+        self._is_connected = True
+        return
+
+    async def attach(self, sock: socket.SocketType):
+        """Create a transport for the session's accepted socket.
+
+        :param sock: Ephemeral socket for this session."""
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.connect_accepted_socket(lambda: FixProtocol(self),
+                                               sock)
+        except OSError as e:
+            logging.info("Failed to attach session: %s", str(e))
+            sock.close()
+            self.connection_lost(e)
+        return
+
+    def connection_made(self, transport: asyncio.Transport):
+        """Handle the transport being attached to the session.
+
+        :param transport: Transport for the client connection."""
+        if not self._is_connected:
+            # Disconnected before the transport was attached.
+            transport.close()
+            return
+
+        self._transport = transport
+        self._writer.attach(transport)
+        if self._paused:
+            transport.pause_reading()
+        self.start_session()
+        if not self._attached.done():
+            self._attached.set_result(None)
+        return
+
+    def connection_lost(self, exc):
+        """Handle the connection being closed.
+
+        :param exc: Exception, or None if closed normally."""
+        super().connection_lost(exc)
+        if not self._attached.done():
+            self._attached.set_result(None)
+        return
+
+    def destroy(self):
+        """Destroy the active session to a client."""
+        super().destroy()
+        self._queue.clear()
+        return
+
+    def set_name(self, name: str):
+        """Set the user-visible name of this session.
+
+        :param name: User-visible name for this session, as used
+        in logging, etc."""
+        self._name = name
+        self._sequence.name = name
+        return
+
+    def disconnect(self):
+        """Close this session.
+
+        Data already written is still sent before the socket closes.
+        With the session layer enabled, that includes a Logout."""
+        super().disconnect()
+        if not self._attached.done():
+            self._attached.set_result(None)
+        return
+
+    async def settle(self):
+        """Wait for the transport to be attached, and then for the event
+        loop to process data already received."""
+        await self._attached
+        await super().settle()
+        return
+
+
+class ControlSession:
+    """Control client session.
+
+    Received bytes are read into a single buffer, reused for each read.
+    Complete frames are copied out, and any partial frame is kept until
+    the rest of it arrives."""
+
+    INITIAL_BUFFER_SIZE = 65536
+    MINIMUM_READ_SIZE = 4096
+
+    def __init__(self, transport: asyncio.Transport):
+        """Constructor.
+
+        :param transport: Transport for the accepted connection."""
+        self._transport = transport
+        self._buffer = bytearray(self.INITIAL_BUFFER_SIZE)
+        self._start = 0
+        self._end = 0
+        self._binary = False
+        return
+
+    def is_binary(self) -> bool:
+        """Return True if binary frames have been negotiated."""
+        return self._binary
+
+    def set_binary(self, binary: bool):
+        """Enable or disable binary frames for this session.
+
+        :param binary: True if binary frames can be used."""
+        self._binary = binary
+        return
+
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        """Return the free space at the end of the receive buffer.
+
+        :param sizehint: Minimum size wanted, or -1 for any size.
+
+        The buffer is compacted or replaced here, rather than as frames
+        are consumed, because it can't be resized while the transport
+        holds a view of it."""
+        pending = self._end - self._start
+        needed = max(sizehint, self.MINIMUM_READ_SIZE)
+        if len(self._buffer) - self._end < needed:
+            if len(self._buffer) - pending >= needed:
+                # Move the partial frame to the front.
+                self._buffer[:pending] = self._buffer[self._start:self._end]
+            else:
+                buffer = bytearray(max(len(self._buffer) * 2,
+                                       pending + needed))
+                buffer[:pending] = self._buffer[self._start:self._end]
+                self._buffer = buffer
+            self._start = 0
+            self._end = pending
+
+        return memoryview(self._buffer)[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        """Consume bytes written to the buffer from get_buffer().
+
+        :param nbytes: Number of bytes written.
+        :returns: List of complete frame payloads, possibly empty."""
+        self._end += nbytes
+
+        payloads = []
+        offset = self._start
+        with memoryview(self._buffer) as view:
+            while self._end - offset >= FRAME_HEADER.size:
+                length = FRAME_HEADER.unpack_from(view, offset)[0]
+                start = offset + FRAME_HEADER.size
+                if self._end - start < length:
+                    # Not received full message yet
+                    break
+
+                offset = start + length
+                payloads.append(bytes(view[start:offset]))
+
+        if offset == self._end:
+            self._start = self._end = 0
+        else:
+            self._start = offset
+        return payloads
+
+    def append_bytes(self, buffer: bytes):
+        """Receive a buffer of bytes from this control client.
+
+        :param buffer: Array of bytes from client.
+        :returns: List of complete frame payloads, possibly empty.
+
+        The buffer can contain any number of frames, and partial frames
+        (or headers) are kept until the rest of their bytes arrive."""
+        with self.get_buffer(len(buffer)) as view:
+            view[:len(buffer)] = buffer
+        return self.buffer_updated(len(buffer))
+
+    def send(self, payload: bytes):
+        """Send a buffer to the control client.
+
+        :param payload: Array of bytes to send to client."""
+
+        if self._transport is None:
+            # Closed while a delayed response was pending.
+            return
+
+        header = FRAME_HEADER.pack(len(payload))
+        self._transport.write(header + payload)
+        return
+
+    def reply(self, request: dict, response):
+        """Send a response message to the control client.
+
+        :param request: Control message being responded to.
+        :param response: Response message to send.
+
+        The request's identifier, if it has one, is copied to the
+        response so the client can match it to its request."""
+        response.request_id = request.get("request_id")
+        self.send(response.to_json().encode())
+        return
+
+    def send_frame(self, frame: BinaryFrame):
+        """Send a binary frame to the control client.
+
+        :param frame: Binary frame to send."""
+        self.send(frame.to_bytes())
+        return
+
+    def close(self):
+        """Close this connection."""
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        return
+
+
+class ControlProtocol(BaseProtocol):
+    """Connection protocol for a control session.
+
+    Reads directly into the control session's receive buffer, and passes
+    complete frames to the agent."""
+
+    def __init__(self, agent):
+        """Constructor.
+
+        :param agent: FixToolAgent accepting the connection."""
+        self._agent = agent
+        self._session = None
+        return
+
+    def connection_made(self, transport):
+        self._session = ControlSession(transport)
+        self._agent.accept(self._session, transport)
+        return
+
+    def connection_lost(self, exc):
+        self._agent.disconnected(self._session)
+        return
+
+    def get_buffer(self, sizehint):
+        return self._session.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self._agent.dispatch(self._session,
+                             self._session.buffer_updated(nbytes))
+        return
+
+    def data_received(self, data):
+        self._agent.dispatch(self._session,
+                             self._session.append_bytes(data))
+        return
+
+
+class ChannelAttachment(object):
+    """Shared memory channel attached to a client or server session.
+
+    Messages written to the channel by the proxy are sent by the entity,
+    and messages received by the entity are written to the channel,
+    bypassing the control session."""
+
+    # Delay before retrying delivery to a full channel, in seconds.
+    RETRY_INTERVAL = 0.001
+
+    def __init__(self, entity, channel: SharedChannel):
+        """Constructor.
+
+        :param entity: Client or ServerSession.
+        :param channel: Shared memory channel, opened by the agent."""
+        self._entity = entity
+        self._channel = channel
+        self._overflow = collections.deque()
+        self._retry = None
+
+        self._loop = asyncio.get_event_loop()
+        self._loop.add_reader(channel.doorbell(), self.readable)
+
+        # Drains any queued messages to the channel.
+        entity.subscribe(self, self.deliver)
+        return
+
+    def close(self):
+        """Detach the channel from its entity."""
+        self._entity.unsubscribe(self)
+        self._loop.remove_reader(self._channel.doorbell())
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+
+        # Anything that didn't fit in the channel goes back on the queue.
+        for message in self._overflow:
+            self._entity.deliver(message)
+        self._overflow.clear()
+
+        self._channel.close()
+        return
+
+    def readable(self):
+        """Send messages written to the channel by the proxy."""
+        self._channel.clear()
+        messages = self._channel.outbound.read_many()
+        while messages:
+            try:
+                self._entity.send_messages(messages)
+            except OSError as e:
+                logging.info("Discarded %d channel messages: %s",
+                             len(messages), str(e))
+            messages = self._channel.outbound.read_many()
+        return
+
+    def deliver(self, message: bytes):
+        """Write a received message to the channel.
+
+        :param message: Byte array of received FIX message.
+
+        If the channel is full, the message is held until the proxy
+        makes room for it."""
+        if self._overflow or not self._channel.inbound.write(message):
+            self._overflow.append(message)
+            self.schedule_retry()
+        return
+
+    def schedule_retry(self):
+        """Arrange to retry writing held messages to the channel."""
+        if self._retry is None:
+            self._retry = self._loop.call_later(self.RETRY_INTERVAL,
+                                                self.retry)
+        return
+
+    def retry(self):
+        """Write held messages to the channel, as space allows."""
+        self._retry = None
+        while self._overflow:
+            if not self._channel.inbound.write(self._overflow[0]):
+                self.schedule_retry()
+                return
+            self._overflow.popleft()
+        return
+
+
+class FixToolAgent(object):
+    """Main class for the simulation agent."""
+
+    def __init__(self, port=0, unix_path=None, loop=None, sock=None):
+        """Constructor.
+
+        :param port: TCP port number for accepting control sessions.
+        :param unix_path: If set, accept control sessions on a Unix
+        domain socket at this path, rather than using TCP.
+        :param loop: Event loop to run, or None to use the current
+        event loop.  It becomes the current event loop.
+        :param sock: If set, an already bound socket on which to accept
+        control sessions; port is ignored, and unix_path is the path it
+        is bound to, if it's a Unix domain socket."""
+        self._socket = None
+        self._listener = None
+        self._loop = None
+        self._port = None
+        self._unix_path = unix_path
+
+        self._control_sessions = set()
+        self._clients = {}
+        self._servers = {}
+        self._server_sessions = {}
+
+        # Binary frames identify clients and server sessions using
+        # integer handles, rather than names.
+        self._handles = {}
+        self._client_handles = {}
+        self._session_handles = {}
+        self._next_handle = 1
+
+        # Shared memory channels, by client or server session.
+        self._attachments = {}
+
+        if sock is not None:
+            self._socket = sock
+            self._socket.setblocking(False)
+            if not unix_path:
+                self._port = self._socket.getsockname()[1]
+        elif unix_path:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.setblocking(False)
+            self._socket.bind(unix_path)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.setblocking(False)
+            self._socket.setsockopt(socket.SOL_SOCKET,
+                                    socket.SO_REUSEADDR, 1)
+            self._socket.bind(('0.0.0.0', port))
+            self._port = self._socket.getsockname()[1]
+
+        if loop is not None:
+            asyncio.set_event_loop(loop)
+        self._loop = asyncio.get_event_loop()
+        self._timers = TimerWheel(self._loop)
+        self._listener = self._loop.run_until_complete(
+            self._loop.create_server(lambda: ControlProtocol(self),
+                                     sock=self._socket, backlog=5))
+        self._loop.add_signal_handler(signal.SIGINT, self.handle_sigint)
+        return
+
+    def port(self):
+        """Get the active control sessions port number."""
+        return self._port
+
+    def unix_path(self):
+        """Get the active control sessions Unix socket path, if any."""
+        return self._unix_path
+
+    def run(self):
+        """Enter mainloop."""
+        self._loop.run_forever()
+        return
+
+    def stop(self):
+        """Exit mainloop."""
+        if self._loop.is_running():
+            self._loop.stop()
+            logging.debug("event loop stopped.")
+        return
+
+    def reset(self):
+        """Clean up all simulated entities."""
+
+        logging.info("agent reseting ...")
+        # Shared memory channels.
+        for attachment in self._attachments.values():
+            attachment.close()
+        self._attachments = {}
+
+        # Server listening sockets.
+        for server in self._servers.values():
+            server.destroy()
+        self._servers = {}
+
+        # Client sessions.
+        for client in self._clients.values():
+            client.destroy()
+        self._clients = {}
+
+        # Server sessions are cleaned up by server.destroy()
+        self._server_sessions = {}
+        self._handles = {}
+        self._client_handles = {}
+        self._session_handles = {}
+
+        logging.info("agent reset complete.")
+        return
+
+    def shutdown(self):
+        """Clean up for exit."""
+
+        logging.info("agent shutting down ...")
+        self.stop()
+        self.reset()
+
+        # Control sessions.
+        for session in self._control_sessions:
+            session.close()
+        self._control_sessions = set()
+
+        # Control session listening socket.
+        self._listener.close()
+        self._listener = None
+        self._socket = None
+        self._port = None
+        if self._unix_path:
+            try:
+                os.unlink(self._unix_path)
+            except OSError:
+                pass
+            self._unix_path = None
+
+        # Timers.  Sessions cancel their own on disconnect.
+        self._timers.stop()
+
+        # Event loop.  Closed transports release their sockets in a
+        # callback, so let those run first.
+        self._loop.run_until_complete(asyncio.sleep(0))
+        self._loop.remove_signal_handler(signal.SIGINT)
+        self._loop.close()
+        self._loop = None
+
+        logging.info("agent shutdown complete.")
+        return
+
+    def entities(self):
+        """Return a list of all clients and server sessions."""
+        return list(self._clients.values()) + \
+            list(self._server_sessions.values())
+
+    def detach(self, entity):
+        """Detach any shared memory channel from a client or session.
+
+        :param entity: Client or ServerSession."""
+        attachment = self._attachments.pop(entity, None)
+        if attachment is not None:
+            attachment.close()
+        return
+
+    @staticmethod
+    def check_timeout(timeout):
+        """Raise ValueError if a request's timeout is invalid.
+
+        :param timeout: Seconds to wait, or None."""
+        if timeout is not None and (isinstance(timeout, bool) or
+                                    not isinstance(timeout, (int, float)) or
+                                    timeout < 0):
+            raise ValueError("Bad timeout: %s" % str(timeout))
+        return
+
+    @staticmethod
+    def set_write_notify(control: ControlSession, entity, name: str,
+                         message_class, notify: bool):
+        """Report (or stop reporting) outbound buffer watermark crossings.
+
+        :param control: Control session to which reports are pushed.
+        :param entity: Client or ServerSession.
+        :param name: Name of client or server session.
+        :param message_class: Report message class.
+        :param notify: True to start reporting, False to stop."""
+        writer = entity.write_buffer()
+        if not notify:
+            writer.remove_listener(control)
+            return
+
+        def push(paused, buffered):
+            control.send(message_class(name, paused, buffered).to_json()
+                         .encode())
+            return
+
+        writer.add_listener(control, push)
+        return
+
+    def handle_sigint(self, *args):
+        """Handle SIGINT."""
+        # pylint: disable=unused-argument
+        logging.info("Exiting on C-c.")
+        self.stop()
+        return
+
+    def accept(self, control_session: ControlSession,
+               transport: asyncio.Transport):
+        """Accept a new control client connection.
+
+        :param control_session: Control session for the connection.
+        :param transport: Transport for the connection."""
+        self._control_sessions.add(control_session)
+
+        if self._unix_path:
+            peer = self._unix_path
+        else:
+            peer = transport.get_extra_info("peername")[0]
+        logging.info("Accepted control session from %s", peer)
+        return
+
+    def disconnected(self, control_session: ControlSession):
+        """Clean up after a control client disconnects.
+
+        :param control_session: Disconnected control session."""
+        self._control_sessions.discard(control_session)
+        for entity in self.entities():
+            entity.unsubscribe(control_session)
+        control_session.close()
+        logging.log(logging.INFO, "Disconnected control session.")
+        return
+
+    def dispatch(self, control_session: ControlSession, payloads: list):
+        """Handle frames received from a control client.
+
+        :param control_session: Control session.
+        :param payloads: List of complete frame payloads."""
+        logging.log(logging.DEBUG, "Control session readable")
+
+        # Pipelined clients can have several requests in one read.
+        for payload in payloads:
+            if control_session.is_binary() and BinaryFrame.is_binary(payload):
+                if len(payload) < BINARY_HEADER.size:
+                    logging.warning("Binary frame too short: %d bytes",
+                                    len(payload))
+                    continue
+                frame = BinaryFrame.from_bytes(payload)
+                self.handle_frame(control_session, frame)
+            else:
+                message = self.decode_request(control_session, payload)
+                if message is not None:
+                    self.handle_request(control_session, message)
+
+        return
+
+    @staticmethod
+    def decode_request(control: ControlSession, payload: bytes):
+        """Decode a JSON request from a control client.
+
+        :param control: Control session.
+        :param payload: Frame payload.
+        :returns: Request dictionary, or None if it was malformed.
+
+        A malformed request is refused with a 'bad_request' response,
+        leaving the control session open."""
+        try:
+            message = json.loads(payload.decode())
+        except ValueError as e:
+            control.reply({}, BadRequestMessage("Bad JSON: %s" % e))
+            return None
+
+        if not isinstance(message, dict):
+            control.reply({}, BadRequestMessage("Request is not an object"))
+            return None
+
+        if not isinstance(message.get("type"), str):
+            control.reply(message, BadRequestMessage("Missing request type"))
+            return None
+        return message
+
+    def handle_request(self, client, message):
+        """Process a received message."""
+
+        message_type = message["type"]
+        logging.debug("Dispatching [%s] (request %s)",
+                      message_type, message.get("request_id"))
+
+        if message_type == "client_create":
+            self.handle_client_create(client, message)
+
+        elif message_type == "client_destroy":
+            self.handle_client_destroy(client, message)
+
+        elif message_type == "client_connect":
             self.handle_client_connect(client, message)
 
+        elif message_type == "client_disconnect":
+            self.handle_client_disconnect(client, message)
+
         elif message_type == "client_is_connected_request":
             self.handle_client_is_connected_request(client, message)
 
         elif message_type == "client_send":
             self.handle_client_send(client, message)
 
+        elif message_type == "client_send_batch":
+            self.handle_client_send_batch(client, message)
+
         elif message_type == "client_receive_count_request":
             self.handle_client_receive_count_request(client, message)
 
         elif message_type == "client_get":
             self.handle_client_get(client, message)
 
+        elif message_type == "client_get_all":
+            self.handle_client_get_all(client, message)
+
+        elif message_type == "client_subscribe":
+            self.handle_client_subscribe(client, message)
+
+        elif message_type == "client_attach":
+            self.handle_client_attach(client, message)
+
+        elif message_type == "client_configure":
+            self.handle_client_configure(client, message)
+
+        elif message_type == "client_sequence_request":
+            self.handle_client_sequence_request(client, message)
+
+        elif message_type == "client_journal_request":
+            self.handle_client_journal_request(client, message)
+
         elif message_type == "server_create":
             self.handle_server_create(client, message)
 
         elif message_type == "server_destroy":
             self.handle_server_destroy(client, message)
 
+        elif message_type == "server_configure":
+            self.handle_server_configure(client, message)
+
         elif message_type == "server_listen":
             self.handle_server_listen(client, message)
 
@@ -536,183 +1987,791 @@ class FixToolAgent(object):
         elif message_type == "session_send":
             self.handle_session_send(client, message)
 
+        elif message_type == "session_send_batch":
+            self.handle_session_send_batch(client, message)
+
         elif message_type == "session_receive_count_request":
             self.handle_session_receive_count_request(client, message)
 
         elif message_type == "session_get":
             self.handle_session_get(client, message)
 
+        elif message_type == "session_get_all":
+            self.handle_session_get_all(client, message)
+
+        elif message_type == "session_subscribe":
+            self.handle_session_subscribe(client, message)
+
+        elif message_type == "session_attach":
+            self.handle_session_attach(client, message)
+
+        elif message_type == "session_configure":
+            self.handle_session_configure(client, message)
+
+        elif message_type == "session_sequence_request":
+            self.handle_session_sequence_request(client, message)
+
+        elif message_type == "session_journal_request":
+            self.handle_session_journal_request(client, message)
+
+        elif message_type == "negotiate":
+            self.handle_negotiate(client, message)
+
         elif message_type == "shutdown":
             self.handle_shutdown(client, message)
 
-        elif message_type == "reset":
-            self.handle_reset(client, message)
+        elif message_type == "reset":
+            self.handle_reset(client, message)
+
+        else:
+            logging.critical("Unknown message type: %s" % message_type)
+        return
+
+    def handle_frame(self, control: ControlSession, frame: BinaryFrame):
+        """Process a received binary frame.
+
+        :param control: Control session.
+        :param frame: Binary frame."""
+
+        opcode = frame.opcode
+        name = self._handles.get(frame.handle)
+        request = {"request_id": frame.request_id}
+
+        if opcode in (OP_CLIENT_SEND, OP_CLIENT_GET, OP_CLIENT_GET_ALL):
+            entity = self._clients.get(name)
+            error = "No such client handle: %d" % frame.handle
+        else:
+            entity = self._server_sessions.get(name)
+            error = "No such session handle: %d" % frame.handle
+
+        # A bad payload length is refused like a bad handle.
+        if opcode in FRAME_PAYLOAD_LENGTHS and \
+                len(frame.payload) not in FRAME_PAYLOAD_LENGTHS[opcode]:
+            entity = None
+            error = "Bad payload length for opcode %d: %d" \
+                % (opcode, len(frame.payload))
+
+        if opcode == OP_CLIENT_SEND or opcode == OP_SESSION_SEND:
+            response_class = ClientSentMessage \
+                if opcode == OP_CLIENT_SEND else SessionSentMessage
+            if entity is None:
+                control.reply(request, response_class(name, False, error))
+                return
+            try:
+                entity.send_message(frame.payload)
+            except OSError as e:
+                control.reply(request, response_class(name, False, str(e)))
+                return
+            payload = struct.pack(">L", entity.write_buffer().buffered())
+
+        elif opcode == OP_CLIENT_GET or opcode == OP_SESSION_GET:
+            if entity is None:
+                response_class = ClientGotMessage \
+                    if opcode == OP_CLIENT_GET else SessionGotMessage
+                control.reply(request,
+                              response_class(name, False, error, None))
+                return
+
+            # Optional timeout, in milliseconds.  If the queue is empty,
+            # check for received data before replying, even without one.
+            if entity.receive_queue_length() < 1:
+                timeout = 0
+                if frame.payload:
+                    timeout = struct.unpack(">L", frame.payload)[0] / 1000.0
+                asyncio.ensure_future(self.complete_frame_get(
+                    control, frame, entity, timeout))
+                return
+
+            self.reply_frame_get(control, frame, entity)
+            return
+
+        elif opcode == OP_CLIENT_GET_ALL or opcode == OP_SESSION_GET_ALL:
+            if entity is None:
+                response_class = ClientGotAllMessage \
+                    if opcode == OP_CLIENT_GET_ALL else SessionGotAllMessage
+                control.reply(request,
+                              response_class(name, False, error, []))
+                return
+
+            if entity.receive_queue_length() < 1:
+                asyncio.ensure_future(self.complete_frame_get_all(
+                    control, frame, entity))
+                return
+
+            self.reply_frame_get_all(control, frame, entity)
+            return
+
+        else:
+            logging.critical("Unknown binary opcode: %d" % opcode)
+            return
+
+        response = BinaryFrame(opcode | OP_RESPONSE, frame.handle,
+                               frame.request_id, payload)
+        control.send_frame(response)
+        return
+
+    async def complete_frame_get(self, control: ControlSession,
+                                 frame: BinaryFrame, entity, timeout: float):
+        """Wait for a message to be queued, then reply to a get frame.
+
+        :param control: Control session.
+        :param frame: Binary frame.
+        :param entity: Client or server session.
+        :param timeout: Maximum time to wait, in seconds."""
+        await entity.wait_for_message(timeout)
+        self.reply_frame_get(control, frame, entity)
+        return
+
+    def reply_frame_get(self, control: ControlSession, frame: BinaryFrame,
+                        entity):
+        """Reply to a get frame.
+
+        :param control: Control session.
+        :param frame: Binary frame.
+        :param entity: Client or server session."""
+        opcode = frame.opcode | OP_RESPONSE
+        payload = entity.get_message()
+        if payload is None:
+            opcode |= OP_EMPTY
+            payload = b''
+
+        response = BinaryFrame(opcode, frame.handle, frame.request_id,
+                               payload)
+        control.send_frame(response)
+        return
+
+    async def complete_frame_get_all(self, control: ControlSession,
+                                     frame: BinaryFrame, entity):
+        """Check for received data, then reply to a get all frame.
+
+        :param control: Control session.
+        :param frame: Binary frame.
+        :param entity: Client or server session."""
+        await entity.settle()
+        self.reply_frame_get_all(control, frame, entity)
+        return
+
+    def reply_frame_get_all(self, control: ControlSession,
+                            frame: BinaryFrame, entity):
+        """Reply to a get all frame.
+
+        :param control: Control session.
+        :param frame: Binary frame.
+        :param entity: Client or server session."""
+        max_count, max_bytes = struct.unpack(">LL", frame.payload)
+        messages = entity.get_messages(max_count or None, max_bytes or None)
+        response = BinaryFrame(frame.opcode | OP_RESPONSE, frame.handle,
+                               frame.request_id, pack_messages(messages))
+        control.send_frame(response)
+        return
+
+    def handle_negotiate(self, control: ControlSession, message: dict):
+        """Handle a 'negotiate' request message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        binary = bool(message.get("binary"))
+        logging.info("negotiate(binary=%s)", binary)
+        control.set_binary(binary)
+
+        response = NegotiatedMessage(True, '', binary)
+        control.reply(message, response)
+        return
+
+    def handle_shutdown(self, control: ControlSession, message: dict):
+        """Handle a 'shutdown' request message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        # pylint: disable=unused-argument
+        logging.info("agent shutdown() requested")
+        self.stop()
+        return
+
+    def handle_reset(self, control: ControlSession, message: dict):
+        """Handle a 'reset' request message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        logging.info("agent reset() requested.")
+        self.reset()
+        return
+
+    def handle_client_create(self, control: ControlSession, message: dict):
+        """Handler a 'client_create' request message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        logging.info("client_create(%s)", name)
+        if name in self._clients:
+            response = ClientCreatedMessage(name, False,
+                                            "Client %s already exists" % name)
+            control.reply(message, response)
+            return
+
+        self._clients[name] = Client(name, self._timers)
+        handle = self._next_handle
+        self._next_handle += 1
+        self._handles[handle] = name
+        self._client_handles[name] = handle
+
+        response = ClientCreatedMessage(name, True, '', handle)
+        control.reply(message, response)
+        return
+
+    def handle_client_destroy(self, control: ControlSession, message: dict):
+        """Handle a 'client_destroy' message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        client = self._clients.get(name)
+        if client is None:
+            response = ClientDestroyedMessage(name, False,
+                                              "No such client '$s'" % name)
+            control.reply(message, response)
+            return
+
+        self.detach(client)
+        client.destroy()
+        del self._clients[name]
+        del self._handles[self._client_handles.pop(name)]
+
+        response = ClientDestroyedMessage(name, True, '')
+        control.reply(message, response)
+        return
+
+    def handle_client_connect(self, control: ControlSession, message: dict):
+        """Handle a 'client_connect' message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        client = self._clients.get(name)
+        if client is None:
+            response = ClientConnectedMessage(name, False,
+                                              "No such client '%s'" % name)
+            control.reply(message, response)
+            return
+
+        if client.is_connected():
+            response = ClientConnectedMessage(name, False,
+                                              "Client '%s' is already "
+                                              "connected" % name)
+            control.reply(message, response)
+            return
+
+        if client.is_connecting():
+            response = ClientConnectedMessage(name, False,
+                                              "Client '%s' is already "
+                                              "connecting" % name)
+            control.reply(message, response)
+            return
+
+        host = message.get("host")
+        port = message.get("port")
+        timeout = message.get("timeout")
+        if not isinstance(host, str) or not host or \
+                not isinstance(port, int) or isinstance(port, bool) or \
+                not 0 < port < 65536:
+            response = ClientConnectedMessage(name, False,
+                                              "Bad address: %s:%s"
+                                              % (host, port))
+            control.reply(message, response)
+            return
+        try:
+            self.check_timeout(timeout)
+        except ValueError as e:
+            response = ClientConnectedMessage(name, False, str(e))
+            control.reply(message, response)
+            return
+
+        # Reply once the connection completes, without blocking other
+        # sessions in the meantime.
+        logging.info("client_connect(%s, %s, %s)", name, host, port)
+        connecting = client.connect(host, port, timeout)
+        asyncio.ensure_future(self.complete_client_connect(control, message,
+                                                           connecting))
+        return
+
+    async def complete_client_connect(self, control: ControlSession,
+                                      message: dict, connecting):
+        """Wait for a client to connect, then reply to 'client_connect'.
+
+        :param control: Control session.
+        :param message: Control message.
+        :param connecting: Coroutine returned by Client.connect()."""
+        name = message.get("name")
+        host = message.get("host")
+        port = message.get("port")
+
+        try:
+            await connecting
+        except asyncio.TimeoutError:
+            response = ClientConnectedMessage(name, False,
+                                              "Timed out connecting to "
+                                              "%s:%s" % (host, port))
+            control.reply(message, response)
+            return
+        except (OSError, ValueError) as e:
+            response = ClientConnectedMessage(name, False, str(e))
+            control.reply(message, response)
+            return
+
+        response = ClientConnectedMessage(name, True, '')
+        control.reply(message, response)
+        return
+
+    def handle_client_disconnect(self, control: ControlSession,
+                                 message: dict):
+        """Handle 'client_disconnect' request.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        client = self._clients.get(name)
+        if client is None:
+            response = ClientDisconnectedMessage(name, False,
+                                                 "No such client: %s" % name)
+            control.reply(message, response)
+            return
+
+        if client.is_connected():
+            client.disconnect()
+
+        response = ClientDisconnectedMessage(name, True, '')
+        control.reply(message, response)
+        logging.debug("Client [%s] disconnected." % name)
+        return
+
+    def handle_client_is_connected_request(self, control: ControlSession,
+                                           message: dict):
+        """Handle a 'client_is_connected' request.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        client = self._clients.get(name)
+        if client is None:
+            response = ClientIsConnectedResponse(name, False,
+                                                 "No such client %s" % name,
+                                                 False)
+            control.reply(message, response)
+            return
+
+        is_connected = client.is_connected()
+
+        response = ClientIsConnectedResponse(name, True, '', is_connected)
+        control.reply(message, response)
+        return
+
+    def handle_client_send(self, control: ControlSession, message: dict):
+        """Handle a 'client_send' request.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        client = self._clients.get(name)
+        if client is None:
+            response = ClientSentMessage(name, False,
+                                         "No such client: %s" % name)
+            control.reply(message, response)
+            return
+
+        payload = message.get("payload")
+        buffer = base64.b64decode(payload)
+        try:
+            client.send_message(buffer)
+        except OSError as e:
+            response = ClientSentMessage(name, False, str(e))
+            control.reply(message, response)
+            return
+
+        response = ClientSentMessage(name, True, '',
+                                     client.write_buffer().buffered())
+        control.reply(message, response)
+        return
+
+    def handle_client_send_batch(self, control: ControlSession,
+                                 message: dict):
+        """Handle a 'client_send_batch' request.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        client = self._clients.get(name)
+        if client is None:
+            response = ClientSentBatchMessage(name, False,
+                                              "No such client: %s" % name,
+                                              0)
+            control.reply(message, response)
+            return
+
+        payloads = message.get("payloads", [])
+        buffers = [base64.b64decode(payload) for payload in payloads]
+        try:
+            client.send_messages(buffers)
+        except OSError as e:
+            response = ClientSentBatchMessage(name, False, str(e), 0)
+            control.reply(message, response)
+            return
+
+        response = ClientSentBatchMessage(name, True, '', len(buffers),
+                                          client.write_buffer().buffered())
+        control.reply(message, response)
+        return
+
+    def handle_client_receive_count_request(self,
+                                            control: ControlSession,
+                                            message: dict):
+        """Process a 'client_get' message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        client = self._clients.get(name)
+        if client is None:
+            logging.warning("No sucj client: %s" % name)
+            response = ClientReceiveCountResponse(name, False,
+                                                  "No such client: %s" % name,
+                                                  0)
+            control.reply(message, response)
+            return
+
+        asyncio.ensure_future(self.complete_client_receive_count_request(
+            control, message, client))
+        return
+
+    async def complete_client_receive_count_request(self,
+                                                    control: ControlSession,
+                                                    message: dict,
+                                                    client: Client):
+        """Check for received data, then reply to a receive count request.
+
+        :param control: Control session.
+        :param message: Control message.
+        :param client: Client whose queue is counted."""
+        await client.settle()
+        name = message.get("name")
+        count = client.receive_queue_length()
+        logging.debug("client_receive_count_request(%s): "
+                      "%d" % (name, count))
+        response = ClientReceiveCountResponse(name, True, '', count)
+        control.reply(message, response)
+        return
+
+    def handle_client_get(self, control: ControlSession, message: dict):
+        """Process a 'client_get' message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        client = self._clients.get(name)
+        if client is None:
+            response = ClientGotMessage(name, False,
+                                        "No such client: %s" % name,
+                                        None)
+            control.reply(message, response)
+            return
+
+        timeout = message.get("timeout")
+        try:
+            self.check_timeout(timeout)
+        except ValueError as e:
+            response = ClientGotMessage(name, False, str(e), None)
+            control.reply(message, response)
+            return
+
+        # If the queue is empty, check for received data before replying,
+        # even without a timeout.
+        if client.receive_queue_length() < 1:
+            asyncio.ensure_future(self.complete_client_get(control, message,
+                                                           client,
+                                                           timeout or 0))
+            return
 
-        else:
-            logging.critical("Unknown message type: %s" % message_type)
+        self.reply_client_get(control, message, client)
         return
 
-    def handle_shutdown(self, control: ControlSession, message: dict):
-        """Handle a 'shutdown' request message.
+    async def complete_client_get(self, control: ControlSession,
+                                  message: dict, client: Client,
+                                  timeout: float):
+        """Wait for a message to be queued, then reply to 'client_get'.
 
         :param control: Control session.
-        :param message: Control message."""
-        # pylint: disable=unused-argument
-        logging.info("agent shutdown() requested")
-        self.stop()
+        :param message: Control message.
+        :param client: Client from which to get the message.
+        :param timeout: Maximum time to wait, in seconds."""
+        await client.wait_for_message(timeout)
+        self.reply_client_get(control, message, client)
         return
 
-    def handle_reset(self, control: ControlSession, message: dict):
-        """Handle a 'reset' request message.
+    def reply_client_get(self, control: ControlSession, message: dict,
+                         client: Client):
+        """Reply to a 'client_get' message.
 
         :param control: Control session.
-        :param message: Control message."""
-        logging.info("agent reset() requested.")
-        self.reset()
+        :param message: Control message.
+        :param client: Client from which to get the message."""
+        buffer = None
+        fix_message = client.get_message()
+        if fix_message is not None:
+            buffer = base64.b64encode(fix_message).decode("ascii")
+        response = ClientGotMessage(message.get("name"), True, '', buffer)
+        control.reply(message, response)
         return
 
-    def handle_client_create(self, control: ControlSession, message: dict):
-        """Handler a 'client_create' request message.
+    def handle_client_get_all(self, control: ControlSession, message: dict):
+        """Process a 'client_get_all' message.
 
         :param control: Control session.
         :param message: Control message."""
         name = message.get("name")
-        logging.info("client_create(%s)", name)
-        if name in self._clients:
-            response = ClientCreatedMessage(name, False,
-                                            "Client %s already exists" % name)
-            control.send(response.to_json().encode())
+        client = self._clients.get(name)
+        if client is None:
+            response = ClientGotAllMessage(name, False,
+                                           "No such client: %s" % name,
+                                           [])
+            control.reply(message, response)
             return
 
-        self._clients[name] = Client(name)
+        if client.receive_queue_length() < 1:
+            asyncio.ensure_future(self.complete_client_get_all(
+                control, message, client))
+            return
 
-        response = ClientCreatedMessage(name, True, '')
-        control.send(response.to_json().encode())
+        self.reply_client_get_all(control, message, client)
         return
 
-    def handle_client_destroy(self, control: ControlSession, message: dict):
-        """Handle a 'client_destroy' message.
+    async def complete_client_get_all(self, control: ControlSession,
+                                      message: dict, client: Client):
+        """Check for received data, then reply to 'client_get_all'.
 
         :param control: Control session.
-        :param message: Control message."""
-        name = message.get("name")
-        client = self._clients.get(name)
-        if client is None:
-            response = ClientDestroyedMessage(name, False,
-                                              "No such client '$s'" % name)
-            control.send(response.to_json().encode())
-            return
+        :param message: Control message.
+        :param client: Client from which to get the messages."""
+        await client.settle()
+        self.reply_client_get_all(control, message, client)
+        return
 
-        client.destroy()
-        del self._clients[name]
+    def reply_client_get_all(self, control: ControlSession, message: dict,
+                             client: Client):
+        """Reply to a 'client_get_all' message.
 
-        response = ClientDestroyedMessage(name, True, '')
-        control.send(response.to_json().encode())
+        :param control: Control session.
+        :param message: Control message.
+        :param client: Client from which to get the messages."""
+        fix_messages = client.get_messages(message.get("max_count"),
+                                           message.get("max_bytes"))
+        payloads = [base64.b64encode(m).decode("ascii")
+                    for m in fix_messages]
+        response = ClientGotAllMessage(message.get("name"), True, '',
+                                       payloads)
+        control.reply(message, response)
         return
 
-    def handle_client_connect(self, control: ControlSession, message: dict):
-        """Handle a 'client_connect' message.
+    def handle_client_subscribe(self, control: ControlSession,
+                                message: dict):
+        """Process a 'client_subscribe' message.
 
         :param control: Control session.
         :param message: Control message."""
         name = message.get("name")
         client = self._clients.get(name)
         if client is None:
-            response = ClientConnectedMessage(name, False,
-                                              "No such client '$s'" % name)
-            control.send(response.to_json().encode())
+            response = ClientSubscribedMessage(name, False,
+                                               "No such client: %s" % name,
+                                               False)
+            control.reply(message, response)
             return
 
-        client.connect(message.get("host"), message.get("port"))
+        subscribe = bool(message.get("subscribe"))
+        logging.info("client_subscribe(%s, %s)", name, subscribe)
+        response = ClientSubscribedMessage(name, True, '', subscribe)
+        control.reply(message, response)
 
-        response = ClientConnectedMessage(name, True, '')
-        control.send(response.to_json().encode())
+        if not subscribe:
+            client.unsubscribe(control)
+            return
+
+        handle = self._client_handles[name]
+
+        def push(fix_message):
+            if control.is_binary():
+                frame = BinaryFrame(OP_CLIENT_RECEIVED, handle, 0,
+                                    fix_message)
+                control.send_frame(frame)
+            else:
+                payload = base64.b64encode(fix_message).decode("ascii")
+                push_message = ClientReceivedMessage(name, payload)
+                control.send(push_message.to_json().encode())
+            return
+
+        client.subscribe(control, push)
         return
 
-    def handle_client_is_connected_request(self, control: ControlSession,
-                                           message: dict):
-        """Handle a 'client_is_connected' request.
+    def handle_client_attach(self, control: ControlSession,
+                             message: dict):
+        """Process a 'client_attach' message.
 
         :param control: Control session.
         :param message: Control message."""
         name = message.get("name")
         client = self._clients.get(name)
         if client is None:
-            response = ClientIsConnectedResponse(name, False,
-                                                 "No such client %s" % name,
-                                                 False)
-            control.send(response.to_json().encode())
+            response = ClientAttachedMessage(name, False,
+                                             "No such client: %s" % name,
+                                             False)
+            control.reply(message, response)
             return
 
-        is_connected = client.is_connected()
+        path = message.get("path")
+        logging.info("client_attach(%s, %s)", name, path)
+        if path:
+            # Check the new channel before giving up any existing one.
+            try:
+                ring_size = message.get("ring_size") or DEFAULT_RING_SIZE
+                channel = SharedChannel.open(path, ring_size)
+            except (OSError, ValueError, TypeError) as e:
+                response = ClientAttachedMessage(name, False, str(e), False)
+                control.reply(message, response)
+                return
+
+            self.detach(client)
+            attachment = ChannelAttachment(client, channel)
+            self._attachments[client] = attachment
+        else:
+            self.detach(client)
 
-        response = ClientIsConnectedResponse(name, True, '', is_connected)
-        control.send(response.to_json().encode())
+        response = ClientAttachedMessage(name, True, '', bool(path))
+        control.reply(message, response)
         return
 
-    def handle_client_send(self, control: ControlSession, message: dict):
-        """Handle a 'client_send' request.
+    def handle_client_configure(self, control: ControlSession,
+                                message: dict):
+        """Process a 'client_configure' message.
 
         :param control: Control session.
         :param message: Control message."""
         name = message.get("name")
         client = self._clients.get(name)
         if client is None:
-            response = ClientSentMessage(name, False,
-                                         "No such client: %s" % name)
-            control.send(response.to_json().encode())
+            response = ClientConfiguredMessage(name, False,
+                                               "No such client: %s" % name)
+            control.reply(message, response)
             return
 
-        payload = message.get("payload")
-        buffer = base64.b64decode(payload)
-        client.send_message(buffer)
+        options = message.get("options") or {}
+        logging.info("client_configure(%s, %s)", name, options)
+        try:
+            client.configure(options)
+        except ValueError as e:
+            response = ClientConfiguredMessage(name, False, str(e))
+            control.reply(message, response)
+            return
+
+        if "write_notify" in options:
+            self.set_write_notify(control, client, name,
+                                  ClientWriteStateMessage,
+                                  bool(options["write_notify"]))
 
-        response = ClientSentMessage(name, True, '')
-        control.send(response.to_json().encode())
+        response = ClientConfiguredMessage(name, True, '')
+        control.reply(message, response)
         return
 
-    def handle_client_receive_count_request(self,
-                                            control: ControlSession,
-                                            message: dict):
-        """Process a 'client_get' message.
+    def handle_client_sequence_request(self, control: ControlSession,
+                                       message: dict):
+        """Handle 'client_sequence_request' message.
 
         :param control: Control session.
         :param message: Control message."""
         name = message.get("name")
         client = self._clients.get(name)
         if client is None:
-            logging.warning("No sucj client: %s" % name)
-            response = ClientReceiveCountResponse(name, False,
-                                                  "No such client: %s" % name,
-                                                  0)
-            control.send(response.to_json().encode())
+            response = ClientSequenceResponse(name, False,
+                                              "No such client: %s" % name)
+            control.reply(message, response)
             return
 
-        count = client.receive_queue_length()
-        logging.info("client_receive_count_request(%s): "
-                     "%d" % (name, count))
-        response = ClientReceiveCountResponse(name, True, '', count)
-        control.send(response.to_json().encode())
+        asyncio.ensure_future(self.complete_sequence_request(
+            control, message, client, ClientSequenceResponse))
         return
 
-    def handle_client_get(self, control: ControlSession, message: dict):
-        """Process a 'client_get' message.
+    async def complete_sequence_request(self, control: ControlSession,
+                                        message: dict, entity,
+                                        response_class):
+        """Check for received data, then reply to a sequence request.
+
+        :param control: Control session.
+        :param message: Control message.
+        :param entity: Client or server session.
+        :param response_class: Class of the response message."""
+        await entity.settle()
+        next_send, next_receive, gaps = entity.sequence_numbers()
+        response = response_class(message.get("name"), True, '',
+                                  next_send, next_receive,
+                                  [list(gap) for gap in gaps])
+        control.reply(message, response)
+        return
+
+    def handle_client_journal_request(self, control: ControlSession,
+                                      message: dict):
+        """Handle 'client_journal_request' message.
 
         :param control: Control session.
         :param message: Control message."""
         name = message.get("name")
         client = self._clients.get(name)
         if client is None:
-            response = ClientGotMessage(name, False,
-                                        "No such client: %s" % name,
-                                        None)
-            control.send(response.to_json().encode())
+            response = ClientJournalResponse(name, False,
+                                             "No such client: %s" % name)
+            control.reply(message, response)
             return
 
-        fix_message = client.get_message()
-        buffer = base64.b64encode(fix_message).decode("ascii")
-        response = ClientGotMessage(name, True, '', buffer)
-        control.send(response.to_json().encode())
+        asyncio.ensure_future(self.complete_journal_request(
+            control, message, client, ClientJournalResponse))
+        return
+
+    async def complete_journal_request(self, control: ControlSession,
+                                       message: dict, entity,
+                                       response_class):
+        """Check for received data, then reply to a journal request.
+
+        :param control: Control session.
+        :param message: Control message.
+        :param entity: Client or server session.
+        :param response_class: Class of the response message."""
+        await entity.settle()
+        name = message.get("name")
+        journal = entity.journal()
+        direction = DIRECTIONS.get(message.get("direction", "sent"))
+        begin = message.get("begin")
+        end = message.get("end", 0)
+        max_count = message.get("max_count")
+        if max_count is None:
+            max_count = JOURNAL_MAX_COUNT
+        if journal is None:
+            response = response_class(name, False,
+                                      "Journal not enabled for %s" % name)
+        elif direction is None:
+            response = response_class(name, False,
+                                      "Bad direction: %s" %
+                                      str(message.get("direction")))
+        elif not all(isinstance(value, int) and
+                     not isinstance(value, bool) and value >= 0
+                     for value in (begin, end, max_count)):
+            response = response_class(name, False, "Bad journal range")
+        else:
+            # Only the messages returned are read from the journal, and
+            # no more than JOURNAL_MAX_COUNT go in one response.
+            messages = journal.messages(direction, begin, end)
+            count = min(max_count, JOURNAL_MAX_COUNT)
+            payloads = [base64.b64encode(data).decode("ascii")
+                        for _, data in itertools.islice(messages, count)]
+            response = response_class(name, True, '', journal.path(),
+                                      payloads)
+        control.reply(message, response)
         return
 
     def handle_server_create(self, client: ControlSession, message: dict):
@@ -724,18 +2783,18 @@ class FixToolAgent(object):
         if name in self._servers:
             response = ServerCreatedMessage(name, False,
                                             "Server '%s' already exists" % name)
-            client.send(response.to_json().encode())
+            client.reply(message, response)
             return
 
         # Create server.
-        server = Server()
+        server = Server(self._timers)
 
         # Register in table.
         self._servers[name] = server
 
         # Send reply.
         response = ServerCreatedMessage(name, True, '')
-        client.send(response.to_json().encode())
+        client.reply(message, response)
         return
 
     def handle_server_destroy(self, control: ControlSession, message: dict):
@@ -748,14 +2807,43 @@ class FixToolAgent(object):
         if server is None:
             response = ServerDestroyedMessage(name, False,
                                               "No such server '$s'" % name)
-            control.send(response.to_json().encode())
+            control.reply(message, response)
             return
 
+        for session_name in server.session_names():
+            self.release_session(session_name)
         server.destroy()
         del self._servers[name]
 
         response = ServerDestroyedMessage(name, True, '')
-        control.send(response.to_json().encode())
+        control.reply(message, response)
+        return
+
+    def handle_server_configure(self, control: ControlSession,
+                                message: dict):
+        """Process a 'server_configure' message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        server = self._servers.get(name)
+        if server is None:
+            response = ServerConfiguredMessage(name, False,
+                                               "No such server: %s" % name)
+            control.reply(message, response)
+            return
+
+        options = message.get("options") or {}
+        logging.info("server_configure(%s, %s)", name, options)
+        try:
+            server.configure(options)
+        except ValueError as e:
+            response = ServerConfiguredMessage(name, False, str(e))
+            control.reply(message, response)
+            return
+
+        response = ServerConfiguredMessage(name, True, '')
+        control.reply(message, response)
         return
 
     def handle_server_listen(self, control: ControlSession, message: dict):
@@ -768,8 +2856,9 @@ class FixToolAgent(object):
         if server is None:
             logging.warning("server_listen(%s): no such server." % name)
             response = ServerListenedMessage(name, False,
-                                             "No such server '%s'" % name)
-            control.send(response.to_json().encode())
+                                             "No such server '%s'" % name,
+                                             None)
+            control.reply(message, response)
             return
 
         port = message.get("port")
@@ -777,14 +2866,39 @@ class FixToolAgent(object):
             logging.warning("server_listen(%s, %s): bad port."
                             % (name, str(port)))
             response = ServerListenedMessage(name, False,
-                                             "Bad or missing port")
-            control.send(response.to_json().encode())
+                                             "Bad or missing port", None)
+            control.reply(message, response)
+            return
+
+        backlog = message.get("backlog")
+        workers = message.get("workers") or 1
+        if (backlog is not None and
+                (not isinstance(backlog, int) or backlog < 1)) or \
+                not isinstance(workers, int) or workers < 1:
+            response = ServerListenedMessage(name, False,
+                                             "Bad backlog or workers", None)
+            control.reply(message, response)
+            return
+
+        # Replicas of a server in a sharded agent's workers share the
+        # port using SO_REUSEPORT.
+        reuse_port = workers > 1
+        if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+            response = ServerListenedMessage(name, False,
+                                             "SO_REUSEPORT not supported",
+                                             None)
+            control.reply(message, response)
             return
 
-        actual_port = server.listen(port)
+        try:
+            actual_port = server.listen(port, backlog, reuse_port)
+        except OSError as e:
+            response = ServerListenedMessage(name, False, str(e), None)
+            control.reply(message, response)
+            return
 
         response = ServerListenedMessage(name, True, '', actual_port)
-        control.send(response.to_json().encode())
+        control.reply(message, response)
         return
 
     def handle_server_unlisten(self, control: ControlSession, message: dict):
@@ -797,13 +2911,13 @@ class FixToolAgent(object):
         if server is None:
             response = ServerUnlistenedMessage(name, False,
                                                "No such server '%s'" % name)
-            control.send(response.to_json().encode())
+            control.reply(message, response)
             return
 
         server.unlisten()
 
         response = ServerUnlistenedMessage(name, True, '')
-        control.send(response.to_json().encode())
+        control.reply(message, response)
         return
 
     def handle_server_pending_accept_request(self,
@@ -818,12 +2932,43 @@ class FixToolAgent(object):
         if server is None:
             response = ServerPendingAcceptCountResponse(
                 name, False, "No such server '%s'" % name, 0)
-            control.send(response.to_json().encode())
+            control.reply(message, response)
+            return
+
+        timeout = message.get("timeout")
+        try:
+            self.check_timeout(timeout)
+        except ValueError as e:
+            response = ServerPendingAcceptCountResponse(name, False, str(e),
+                                                        0)
+            control.reply(message, response)
+            return
+
+        if timeout and server.pending_client_count() < 1:
+            asyncio.ensure_future(self.complete_server_pending_accept_request(
+                control, message, server, timeout))
             return
 
         count = server.pending_client_count()
         response = ServerPendingAcceptCountResponse(name, True, '', count)
-        control.send(response.to_json().encode())
+        control.reply(message, response)
+        return
+
+    async def complete_server_pending_accept_request(
+            self, control: ControlSession, message: dict, server: Server,
+            timeout: float):
+        """Wait for a pending session, then reply with the count.
+
+        :param control: Control session.
+        :param message: Control message.
+        :param server: Server whose pending sessions are counted.
+        :param timeout: Maximum time to wait, in seconds."""
+        await server.wait_for_pending(timeout)
+
+        count = server.pending_client_count()
+        response = ServerPendingAcceptCountResponse(message["name"], True,
+                                                    '', count)
+        control.reply(message, response)
         return
 
     def handle_server_accept(self, control: ControlSession, message: dict):
@@ -839,15 +2984,34 @@ class FixToolAgent(object):
         if server is None:
             response = ServerAcceptedMessage(
                 name, False, "No such server '%s'" % name, '')
-            control.send(response.to_json().encode())
+            control.reply(message, response)
             return
 
         logging.debug("GOT server [%s]" % name)
         session_name = message.get("session_name")
+        if session_name in self._server_sessions:
+            response = ServerAcceptedMessage(
+                name, False, "Session '%s' already exists" % session_name,
+                '')
+            control.reply(message, response)
+            return
+
         session = server.accept_client_session(session_name)
+        if session is None:
+            response = ServerAcceptedMessage(
+                name, False, "No pending sessions for '%s'" % name, '')
+            control.reply(message, response)
+            return
+
         self._server_sessions[session_name] = session
-        response = ServerAcceptedMessage(name, True, '', session_name)
-        control.send(response.to_json().encode())
+        handle = self._next_handle
+        self._next_handle += 1
+        self._handles[handle] = session_name
+        self._session_handles[session_name] = handle
+
+        response = ServerAcceptedMessage(name, True, '', session_name,
+                                         handle)
+        control.reply(message, response)
         logging.debug("SENT response")
         return
 
@@ -863,13 +3027,23 @@ class FixToolAgent(object):
             response = ServerIsConnectedResponse(name, False,
                                                  "No such session %s" % name,
                                                  False)
-            control.send(response.to_json().encode())
+            control.reply(message, response)
             return
 
         is_connected = server_session.is_connected()
 
         response = ServerIsConnectedResponse(name, True, '', is_connected)
-        control.send(response.to_json().encode())
+        control.reply(message, response)
+        return
+
+    def release_session(self, name: str):
+        """Forget a server session, releasing its name and handle.
+
+        :param name: Name of the session."""
+        server_session = self._server_sessions.pop(name, None)
+        if server_session is not None:
+            self.detach(server_session)
+            del self._handles[self._session_handles.pop(name)]
         return
 
     def handle_server_disconnect(self, control: ControlSession, message: dict):
@@ -882,13 +3056,14 @@ class FixToolAgent(object):
         if server_session is None:
             response = ServerDisconnectedMessage(name, False,
                                                  "No such session %s" % name)
-            control.send(response.to_json().encode())
+            control.reply(message, response)
             return
 
+        self.detach(server_session)
         server_session.disconnect()
 
         response = ServerDisconnectedMessage(name, True, '')
-        control.send(response.to_json().encode())
+        control.reply(message, response)
         logging.debug("Server session [%s] disconnected." % name)
         return
 
@@ -902,14 +3077,50 @@ class FixToolAgent(object):
         if server_session is None:
             response = SessionSentMessage(name, False,
                                           "No such session %s" % name)
-            control.send(response.to_json().encode())
+            control.reply(message, response)
             return
 
         buffer = base64.b64decode(message.get("payload"))
-        server_session.send_message(buffer)
+        try:
+            server_session.send_message(buffer)
+        except OSError as e:
+            response = SessionSentMessage(name, False, str(e))
+            control.reply(message, response)
+            return
+
+        response = SessionSentMessage(name, True, '',
+                                      server_session.write_buffer().buffered())
+        control.reply(message, response)
+        return
+
+    def handle_session_send_batch(self, control: ControlSession,
+                                  message: dict):
+        """Handle 'session_send_batch' request.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        server_session = self._server_sessions.get(name)
+        if server_session is None:
+            response = SessionSentBatchMessage(name, False,
+                                               "No such session %s" % name,
+                                               0)
+            control.reply(message, response)
+            return
+
+        payloads = message.get("payloads", [])
+        buffers = [base64.b64decode(payload) for payload in payloads]
+        try:
+            server_session.send_messages(buffers)
+        except OSError as e:
+            response = SessionSentBatchMessage(name, False, str(e), 0)
+            control.reply(message, response)
+            return
 
-        response = SessionSentMessage(name, True, '')
-        control.send(response.to_json().encode())
+        buffered = server_session.write_buffer().buffered()
+        response = SessionSentBatchMessage(name, True, '', len(buffers),
+                                           buffered)
+        control.reply(message, response)
         return
 
     def handle_session_receive_count_request(self,
@@ -927,14 +3138,28 @@ class FixToolAgent(object):
             response = SessionReceiveCountResponse(name, False,
                                                    "No such session: "
                                                    "%s" % name, 0)
-            control.send(response.to_json().encode())
+            control.reply(message, response)
             return
 
+        asyncio.ensure_future(self.complete_session_receive_count_request(
+            control, message, server_session))
+        return
+
+    async def complete_session_receive_count_request(
+            self, control: ControlSession, message: dict,
+            server_session: ServerSession):
+        """Check for received data, then reply to a receive count request.
+
+        :param control: Control session.
+        :param message: Control message.
+        :param server_session: Server session whose queue is counted."""
+        await server_session.settle()
+        name = message.get("name")
         count = server_session.receive_queue_length()
         logging.debug("session_receive_count_request(%s): "
                       "%d" % (name, count))
         response = SessionReceiveCountResponse(name, True, '', count)
-        control.send(response.to_json().encode())
+        control.reply(message, response)
         return
 
     def handle_session_get(self, control: ControlSession, message: dict):
@@ -947,17 +3172,271 @@ class FixToolAgent(object):
         if server_session is None:
             response = SessionGotMessage(name, False,
                                          "No such session %s" % name,
-                                         b'')
-            control.send(response.to_json().encode())
+                                         None)
+            control.reply(message, response)
+            return
+
+        timeout = message.get("timeout")
+        try:
+            self.check_timeout(timeout)
+        except ValueError as e:
+            response = SessionGotMessage(name, False, str(e), None)
+            control.reply(message, response)
+            return
+
+        # If the queue is empty, check for received data before replying,
+        # even without a timeout.
+        if server_session.receive_queue_length() < 1:
+            asyncio.ensure_future(self.complete_session_get(
+                control, message, server_session, timeout or 0))
             return
 
+        self.reply_session_get(control, message, server_session)
+        return
+
+    async def complete_session_get(self, control: ControlSession,
+                                   message: dict,
+                                   server_session: ServerSession,
+                                   timeout: float):
+        """Wait for a message to be queued, then reply to 'session_get'.
+
+        :param control: Control session.
+        :param message: Control message.
+        :param server_session: Session from which to get the message.
+        :param timeout: Maximum time to wait, in seconds."""
+        await server_session.wait_for_message(timeout)
+        self.reply_session_get(control, message, server_session)
+        return
+
+    def reply_session_get(self, control: ControlSession, message: dict,
+                          server_session: ServerSession):
+        """Reply to a 'session_get' message.
+
+        :param control: Control session.
+        :param message: Control message.
+        :param server_session: Session from which to get the message."""
+        payload = None
         fix_message = server_session.get_message()
-        payload = base64.b64encode(fix_message).decode("ascii")
-        response = SessionGotMessage(name, True, '', payload)
-        control.send(response.to_json().encode())
+        if fix_message is not None:
+            payload = base64.b64encode(fix_message).decode("ascii")
+        response = SessionGotMessage(message.get("name"), True, '', payload)
+        control.reply(message, response)
+        return
+
+    def handle_session_subscribe(self, control: ControlSession,
+                                 message: dict):
+        """Handle 'session_subscribe' request.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        server_session = self._server_sessions.get(name)
+        if server_session is None:
+            response = SessionSubscribedMessage(name, False,
+                                                "No such session %s" % name,
+                                                False)
+            control.reply(message, response)
+            return
+
+        subscribe = bool(message.get("subscribe"))
+        logging.info("session_subscribe(%s, %s)", name, subscribe)
+        response = SessionSubscribedMessage(name, True, '', subscribe)
+        control.reply(message, response)
+
+        if not subscribe:
+            server_session.unsubscribe(control)
+            return
+
+        handle = self._session_handles[name]
+
+        def push(fix_message):
+            if control.is_binary():
+                frame = BinaryFrame(OP_SESSION_RECEIVED, handle, 0,
+                                    fix_message)
+                control.send_frame(frame)
+            else:
+                payload = base64.b64encode(fix_message).decode("ascii")
+                push_message = SessionReceivedMessage(name, payload)
+                control.send(push_message.to_json().encode())
+            return
+
+        server_session.subscribe(control, push)
+        return
+
+    def handle_session_attach(self, control: ControlSession,
+                              message: dict):
+        """Process a 'session_attach' message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        server_session = self._server_sessions.get(name)
+        if server_session is None:
+            response = SessionAttachedMessage(name, False,
+                                              "No such session: %s" % name,
+                                              False)
+            control.reply(message, response)
+            return
+
+        path = message.get("path")
+        logging.info("session_attach(%s, %s)", name, path)
+        if path:
+            # Check the new channel before giving up any existing one.
+            try:
+                ring_size = message.get("ring_size") or DEFAULT_RING_SIZE
+                channel = SharedChannel.open(path, ring_size)
+            except (OSError, ValueError, TypeError) as e:
+                response = SessionAttachedMessage(name, False, str(e), False)
+                control.reply(message, response)
+                return
+
+            self.detach(server_session)
+            attachment = ChannelAttachment(server_session, channel)
+            self._attachments[server_session] = attachment
+        else:
+            self.detach(server_session)
+
+        response = SessionAttachedMessage(name, True, '', bool(path))
+        control.reply(message, response)
+        return
+
+    def handle_session_configure(self, control: ControlSession,
+                                 message: dict):
+        """Process a 'session_configure' message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        server_session = self._server_sessions.get(name)
+        if server_session is None:
+            response = SessionConfiguredMessage(name, False,
+                                                "No such session: %s" % name)
+            control.reply(message, response)
+            return
+
+        options = message.get("options") or {}
+        logging.info("session_configure(%s, %s)", name, options)
+        try:
+            server_session.configure(options)
+        except ValueError as e:
+            response = SessionConfiguredMessage(name, False, str(e))
+            control.reply(message, response)
+            return
+
+        if "write_notify" in options:
+            self.set_write_notify(control, server_session, name,
+                                  SessionWriteStateMessage,
+                                  bool(options["write_notify"]))
+
+        response = SessionConfiguredMessage(name, True, '')
+        control.reply(message, response)
+        return
+
+    def handle_session_sequence_request(self, control: ControlSession,
+                                        message: dict):
+        """Handle 'session_sequence_request' message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        server_session = self._server_sessions.get(name)
+        if server_session is None:
+            response = SessionSequenceResponse(name, False,
+                                               "No such session: %s" % name)
+            control.reply(message, response)
+            return
+
+        asyncio.ensure_future(self.complete_sequence_request(
+            control, message, server_session, SessionSequenceResponse))
+        return
+
+    def handle_session_journal_request(self, control: ControlSession,
+                                       message: dict):
+        """Handle 'session_journal_request' message.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        server_session = self._server_sessions.get(name)
+        if server_session is None:
+            response = SessionJournalResponse(name, False,
+                                              "No such session: %s" % name)
+            control.reply(message, response)
+            return
+
+        asyncio.ensure_future(self.complete_journal_request(
+            control, message, server_session, SessionJournalResponse))
+        return
+
+    def handle_session_get_all(self, control: ControlSession, message: dict):
+        """Handle 'session_get_all' request.
+
+        :param control: Control session.
+        :param message: Control message."""
+        name = message.get("name")
+        server_session = self._server_sessions.get(name)
+        if server_session is None:
+            response = SessionGotAllMessage(name, False,
+                                            "No such session %s" % name,
+                                            [])
+            control.reply(message, response)
+            return
+
+        if server_session.receive_queue_length() < 1:
+            asyncio.ensure_future(self.complete_session_get_all(
+                control, message, server_session))
+            return
+
+        self.reply_session_get_all(control, message, server_session)
+        return
+
+    async def complete_session_get_all(self, control: ControlSession,
+                                       message: dict,
+                                       server_session: ServerSession):
+        """Check for received data, then reply to 'session_get_all'.
+
+        :param control: Control session.
+        :param message: Control message.
+        :param server_session: Session from which to get the messages."""
+        await server_session.settle()
+        self.reply_session_get_all(control, message, server_session)
+        return
+
+    def reply_session_get_all(self, control: ControlSession, message: dict,
+                              server_session: ServerSession):
+        """Reply to a 'session_get_all' message.
+
+        :param control: Control session.
+        :param message: Control message.
+        :param server_session: Session from which to get the messages."""
+        fix_messages = server_session.get_messages(message.get("max_count"),
+                                                   message.get("max_bytes"))
+        payloads = [base64.b64encode(m).decode("ascii")
+                    for m in fix_messages]
+        response = SessionGotAllMessage(message.get("name"), True, '',
+                                        payloads)
+        control.reply(message, response)
         return
 
 
+def new_event_loop(name: str = "asyncio"):
+    """Create an event loop.
+
+    :param name: Event loop implementation, from EVENT_LOOPS.
+    :returns: Tuple of the new event loop, and the name of the
+    implementation used.  If uvloop isn't installed, it falls back to
+    the standard asyncio event loop."""
+    if name == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning("uvloop is not installed; using asyncio")
+        else:
+            return uvloop.new_event_loop(), name
+
+    return asyncio.new_event_loop(), "asyncio"
+
+
 def main():
     """Main function for agent."""
 
@@ -975,6 +3454,16 @@ def main():
     parser.add_argument("-p", "--port", type=int,
                         default=0,
                         help="TCP port number for control sessions")
+    parser.add_argument("-u", "--unix", type=str,
+                        default=None,
+                        help="Unix socket path for control sessions")
+    parser.add_argument("--loop", type=str,
+                        default="asyncio",
+                        choices=EVENT_LOOPS,
+                        help="Event loop implementation (default asyncio)")
+    parser.add_argument("-w", "--workers", type=int,
+                        default=1,
+                        help="Number of worker processes (default 1)")
     parser.add_argument("action", type=str,
                         choices=("start", "stop", "reset"),
                         help="Action to perform")
@@ -1002,12 +3491,27 @@ def main():
                 os._exit(0)
 
         try:
-            agent = FixToolAgent(args.port)
+            if args.workers > 1:
+                # Imported here, because the router module imports this
+                # one.
+                from fixtool.router import FixToolRouter
+                agent = FixToolRouter(args.port, args.unix, args.workers,
+                                      args.loop)
+            else:
+                loop, loop_name = new_event_loop(args.loop)
+                logging.info("Using %s event loop", loop_name)
+                agent = FixToolAgent(args.port, args.unix, loop)
         except OSError:
-            print("ERROR creating agent on port " + str(args.port))
+            if args.unix:
+                print("ERROR creating agent on socket " + args.unix)
+            else:
+                print("ERROR creating agent on port " + str(args.port))
             sys.exit(1)
 
-        print("OK " + str(agent.port()))
+        if args.unix:
+            print("OK unix:" + agent.unix_path())
+        else:
+            print("OK " + str(agent.port()))
         sys.stdout.flush()
 
         try:
@@ -1019,32 +3523,36 @@ def main():
         sys.exit(0)
 
     elif args.action == "stop":
-        if not args.port:
-            print("ERROR need port number for 'stop' action.")
+        if not args.port and not args.unix:
+            print("ERROR need port number or socket for 'stop' action.")
             sys.exit(1)
 
         try:
-            proxy = FixToolProxy('localhost', args.port)
+            proxy = FixToolProxy('localhost', args.port,
+                                 unix_path=args.unix)
             proxy.shutdown()
             sys.exit(0)
 
-        except ConnectionRefusedError:
-            print("ERROR no agent running on port " + str(args.port))
+        except (ConnectionRefusedError, FileNotFoundError):
+            print("ERROR no agent running on " +
+                  (args.unix or "port " + str(args.port)))
 
         sys.exit(1)
 
     elif args.action == "reset":
-        if not args.port:
-            print("ERROR need port number for 'reset' action.")
+        if not args.port and not args.unix:
+            print("ERROR need port number or socket for 'reset' action.")
             sys.exit(1)
 
         try:
-            proxy = FixToolProxy('localhost', args.port)
+            proxy = FixToolProxy('localhost', args.port,
+                                 unix_path=args.unix)
             proxy.reset()
             sys.exit(0)
 
-        except ConnectionRefusedError:
-            print("ERROR no agent running on port " + str(args.port))
+        except (ConnectionRefusedError, FileNotFoundError):
+            print("ERROR no agent running on " +
+                  (args.unix or "port " + str(args.port)))
 
         sys.exit(1)
 
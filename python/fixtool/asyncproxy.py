@@ -0,0 +1,1003 @@
+#! /usr/bin/env python3
+##################################################################
+# fixtool
+# Copyright (C) 2018, David Arnold.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##################################################################
+
+"""Asyncio Python API to fixtool simulator agent."""
+
+import asyncio
+import base64
+import json
+import logging
+import struct
+
+from fixtool.framing import sequence_number
+from fixtool.message import *
+from fixtool.proxy import WriteWatch, decode_response
+
+
+class AsyncSubscription(object):
+    """Stream of FIX messages received by a client or server session.
+
+    Messages are pushed from the agent as they're received.  They are
+    passed to the callback, if one was supplied, or otherwise put on the
+    queue.  The subscription can also be iterated over using 'async for'."""
+
+    def __init__(self, owner, callback=None):
+        """(Internal) Constructor."""
+        self._owner = owner
+        self._callback = callback
+        self.queue = asyncio.Queue()
+        return
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.queue.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def get(self, timeout: float = None):
+        """Return the next received message.
+
+        :param timeout: Maximum time to wait, in seconds, or None to
+        wait indefinitely.
+        :returns: Message, or None if none arrived in time."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        """Cancel this subscription."""
+        await self._owner.unsubscribe()
+        return
+
+    def deliver(self, message):
+        """(Internal) Handle a message pushed from the agent.
+
+        :param message: Received message, or None when closed."""
+        if self._callback is not None and message is not None:
+            self._callback(message)
+        else:
+            self.queue.put_nowait(message)
+        return
+
+
+class AsyncClient(object):
+    """Local proxy for FIX client in agent."""
+
+    def __init__(self, proxy, name: str, handle: int):
+        """(Internal) Constructor.
+
+        Use AsyncFixToolProxy.create_client() to create clients."""
+        self._proxy = proxy
+        self._name = name
+        self._handle = handle
+        self._destroyed = False
+        self._subscription = None
+        self._subscription_key = None
+        return
+
+    async def destroy(self):
+        """Clean up this client, both locally and in the remote agent."""
+        assert not self._destroyed
+
+        request = ClientDestroyMessage(self._name)
+        await self._proxy.request(request)
+
+        self._proxy.remove_client(self._name)
+        self._destroyed = True
+        return
+
+    async def connect(self, host: str, port: int, timeout: float = None):
+        """Connect the client to the specified host and port.
+
+        :param host: String host name or IP address.
+        :param port: Integer TCP port number.
+        :param timeout: Maximum time for the agent to wait for the
+        connection to complete, in seconds, or None to wait indefinitely."""
+        assert not self._destroyed
+
+        request = ClientConnectMessage(self._name, host, port, timeout)
+        await self._proxy.request(request)
+        return
+
+    async def disconnect(self):
+        """Disconnect the client from its server peer."""
+        assert not self._destroyed
+
+        request = ClientDisconnectMessage(self._name)
+        await self._proxy.request(request)
+        return
+
+    async def is_connected(self):
+        """Returns True if connected to a peer server."""
+        assert not self._destroyed
+
+        request = ClientIsConnectedRequest(self._name)
+        response = await self._proxy.request(request)
+        return response.connected
+
+    async def send(self, message: bytes):
+        """Send a FIX message to the connected server peer.
+
+        :param message: Byte array containing formatted FIX message to send."""
+        assert not self._destroyed
+
+        if self._proxy.is_binary():
+            await self._proxy.request_frame(OP_CLIENT_SEND, self._handle,
+                                            message)
+        else:
+            payload = base64.b64encode(message).decode("ascii")
+            request = ClientSendMessage(self._name, payload)
+            await self._proxy.request(request)
+        return
+
+    async def send_batch(self, messages: list):
+        """Send several FIX messages to the connected server peer.
+
+        :param messages: List of byte arrays containing formatted FIX
+        messages to send, in order."""
+        assert not self._destroyed
+
+        if self._proxy.is_binary():
+            await self._proxy.request_frame(OP_CLIENT_SEND, self._handle,
+                                            b''.join(messages))
+        else:
+            payloads = [base64.b64encode(m).decode("ascii")
+                        for m in messages]
+            request = ClientSendBatchMessage(self._name, payloads)
+            await self._proxy.request(request)
+        return
+
+    async def subscribe(self, callback=None):
+        """Have received FIX messages pushed from the agent as they arrive.
+
+        :param callback: Optional function, called with each message.
+        :returns: AsyncSubscription."""
+        assert not self._destroyed
+        assert self._subscription is None
+
+        if self._proxy.is_binary():
+            key = (OP_CLIENT_RECEIVED, self._handle)
+        else:
+            key = ("client_received", self._name)
+
+        subscription = AsyncSubscription(self, callback)
+        self._proxy.add_subscription(key, subscription)
+        try:
+            await self._proxy.request(ClientSubscribeMessage(self._name,
+                                                             True))
+        except (RuntimeError, ConnectionError):
+            self._proxy.remove_subscription(key)
+            raise
+
+        self._subscription = subscription
+        self._subscription_key = key
+        return subscription
+
+    async def unsubscribe(self):
+        """Cancel the subscription to received messages."""
+        assert self._subscription is not None
+
+        await self._proxy.request(ClientSubscribeMessage(self._name, False))
+
+        self._proxy.remove_subscription(self._subscription_key)
+        self._subscription.deliver(None)
+        self._subscription = None
+        return
+
+    async def configure(self, **options):
+        """Change the client's configurable options, in the agent.
+
+        :param options: Option values, by name.  Options not given are
+        left unchanged.
+
+        - queue_capacity: maximum number of received messages the agent
+          holds in memory, or None for no limit.
+        - queue_policy: what happens to received messages when the
+          queue is full; one of "block" (stop reading from the socket),
+          "drop_oldest", "drop_newest", or "spill" (to a file).
+        - write_high_watermark: size, in bytes, at which the outbound
+          buffer is reported as paused.
+        - write_low_watermark: size, in bytes, at which the outbound
+          buffer is reported as resumed.
+        - raw: if True, the agent never reads received messages' fields.
+        - heartbeat_interval: HeartBtInt, in seconds, for automatic
+          Heartbeats and TestRequests, or zero (the default) for none.
+          Implies auto_sequence.
+        - auto_heartbeat: if False, automatic heartbeats are disabled.
+        - auto_sequence: if True, the agent sets MsgSeqNum, SendingTime,
+          BodyLength and CheckSum in sent messages, and checks the
+          MsgSeqNum of received messages for gaps.
+        - next_send_sequence: MsgSeqNum for the next message sent.
+        - next_receive_sequence: MsgSeqNum expected next from the peer.
+        - session_layer: if True, the agent handles Logon, Logout,
+          Heartbeat, TestRequest, ResendRequest and SequenceReset
+          messages itself, and only passes on application messages.
+        - begin_string, sender_comp_id, target_comp_id: header fields
+          for session-level messages.  A server session takes any not
+          configured from the client's Logon.
+        - journal: True to record sent and received messages in a new
+          journal file in the system's temporary directory, a directory
+          name for the file, or False to close the journal.
+        - journal_sync_interval: None (the default) to leave writing
+          the journal to the operating system, zero to flush each
+          message to disk, or the maximum time, in seconds, before
+          messages are flushed together."""
+        assert not self._destroyed
+
+        request = ClientConfigureMessage(self._name, options)
+        await self._proxy.request(request)
+        return
+
+    async def sequence_numbers(self):
+        """Return the client's sequence numbers.
+
+        :returns: Tuple of the MsgSeqNum for the next message sent, the
+        MsgSeqNum expected next from the peer, and a list of (first,
+        last) ranges of MsgSeqNums missing from received messages."""
+        assert not self._destroyed
+
+        request = ClientSequenceRequest(self._name)
+        response = await self._proxy.request(request)
+        return (response.next_send_sequence, response.next_receive_sequence,
+                [tuple(gap) for gap in response.gaps])
+
+    async def journal(self, begin: int = 1, end: int = 0,
+                      direction: str = "sent", max_count: int = None):
+        """Return messages recorded in the client's journal.
+
+        :param begin: First MsgSeqNum.
+        :param end: Last MsgSeqNum, or zero for no limit.
+        :param direction: "sent" or "received".
+        :param max_count: Maximum number of messages to return, or None
+        for no limit.  The agent returns at most JOURNAL_MAX_COUNT per
+        request, so long ranges take several requests.
+        :returns: List of the recorded messages' bytes, in MsgSeqNum
+        order.  Numbers not recorded are skipped.
+
+        The journal must be enabled with configure(journal=...)."""
+        assert not self._destroyed
+
+        # The agent returns a limited number of messages per request,
+        # so a long range is fetched in pieces.
+        messages = []
+        while max_count is None or len(messages) < max_count:
+            count = None if max_count is None else max_count - len(messages)
+            request = ClientJournalRequest(self._name, begin, end, direction,
+                                           count)
+            response = await self._proxy.request(request)
+            if not response.payloads:
+                break
+            messages.extend(base64.b64decode(payload)
+                            for payload in response.payloads)
+            last = sequence_number(messages[-1])
+            if last is None or (end and last >= end):
+                break
+            begin = last + 1
+        return messages
+
+    async def journal_path(self) -> str:
+        """Return the path of the client's journal file."""
+        assert not self._destroyed
+
+        request = ClientJournalRequest(self._name, 1, 0, "sent", 0)
+        response = await self._proxy.request(request)
+        return response.path
+
+    async def watch_writes(self, callback=None):
+        """Have the agent report when its outbound buffer for this client
+        crosses the high or low watermark.
+
+        :param callback: Optional function, called with the paused flag
+        and the number of bytes buffered for each report.
+        :returns: WriteWatch."""
+        assert not self._destroyed
+
+        watch = WriteWatch(None, callback)
+        key = ("client_write_state", self._name)
+        self._proxy.add_subscription(key, watch)
+        await self.configure(write_notify=True)
+        return watch
+
+    async def receive_queue_length(self) -> int:
+        """Return number of messages waiting to be collected."""
+        assert not self._destroyed
+
+        request = ClientReceiveCountRequest(self._name)
+        response = await self._proxy.request(request)
+        return response.count
+
+    async def receive(self, timeout: float = None) -> bytes:
+        """Return a FIX message received from the connected server.
+
+        :param timeout: If no messages are queued, the maximum time to
+        wait for one to arrive, in seconds.
+
+        If no messages are queued (after waiting), returns None."""
+        assert not self._destroyed
+
+        if self._proxy.is_binary():
+            payload = b''
+            if timeout:
+                payload = struct.pack(">L", int(timeout * 1000))
+            response = await self._proxy.request_frame(OP_CLIENT_GET,
+                                                       self._handle, payload)
+            if response.opcode & OP_EMPTY:
+                return None
+            return response.payload
+
+        request = ClientGetMessage(self._name, timeout)
+        response = await self._proxy.request(request)
+        if response.payload is None:
+            return None
+        return base64.b64decode(response.payload)
+
+    async def receive_all(self, max_count: int = None,
+                          max_bytes: int = None):
+        """Return all FIX messages received from the connected server.
+
+        :param max_count: Maximum number of messages to return.
+        :param max_bytes: Maximum total size of messages to return.
+        :returns: List of messages, in the order they were received."""
+        assert not self._destroyed
+
+        if self._proxy.is_binary():
+            limits = struct.pack(">LL", max_count or 0, max_bytes or 0)
+            response = await self._proxy.request_frame(OP_CLIENT_GET_ALL,
+                                                       self._handle, limits)
+            return unpack_messages(response.payload)
+
+        request = ClientGetAllMessage(self._name, max_count, max_bytes)
+        response = await self._proxy.request(request)
+        return [base64.b64decode(p) for p in response.payloads]
+
+
+class AsyncServer(object):
+    """Local proxy for FIX server in agent."""
+
+    def __init__(self, proxy, name: str):
+        """(Internal) Constructor.
+
+        Use AsyncFixToolProxy.create_server() to create servers."""
+        self._proxy = proxy
+        self._name = name
+        self._clients = {}
+        self._ports = []
+        self._destroyed = False
+        return
+
+    async def destroy(self):
+        """Clean up this server, both locally and in remote agent."""
+        assert not self._destroyed
+
+        for session in list(self._clients.values()):
+            await session.destroy()
+        self._clients = {}
+
+        for port in self._ports[:]:
+            await self.stop_listening(port)
+
+        request = ServerDestroyMessage(self._name)
+        await self._proxy.request(request)
+
+        self._proxy.remove_server(self._name)
+        self._destroyed = True
+        return
+
+    async def configure(self, **options):
+        """Change configurable options for sessions accepted from now on.
+
+        :param options: Option values, by name, as for
+        AsyncServerSession.configure()."""
+        assert not self._destroyed
+
+        request = ServerConfigureMessage(self._name, options)
+        await self._proxy.request(request)
+        return
+
+    async def listen(self, port: int = 0, backlog: int = None,
+                     workers: int = None):
+        """Listen for connections on specified port.
+
+        :param port: TCP port number on which to listen for connections.
+        :param backlog: Maximum number of connections waiting to be
+        accepted by the agent, or None for the agent's default.
+        :param workers: Number of agent worker processes accepting
+        connections for the port, using SO_REUSEPORT.
+        :returns: Listening port number."""
+        assert not self._destroyed
+
+        request = ServerListenMessage(self._name, port, backlog, workers)
+        response = await self._proxy.request(request)
+
+        actual_port = response.port
+        self._ports.append(actual_port)
+        return actual_port
+
+    async def stop_listening(self, port: int):
+        """Stop listening for connections on specified port.
+
+        :param port: TCP port number on which to stop listening."""
+        assert not self._destroyed
+
+        request = ServerUnlistenMessage(self._name, port)
+        await self._proxy.request(request)
+
+        self._ports.remove(port)
+        return
+
+    async def pending_accept_count(self):
+        """Return the number of sessions waiting to be accepted."""
+        assert not self._destroyed
+
+        request = ServerPendingAcceptCountRequest(self._name)
+        response = await self._proxy.request(request)
+        return response.count
+
+    async def wait_for_pending_accept(self, timeout: float):
+        """Wait for a session to be ready to accept.
+
+        :param timeout: Maximum time to wait, in seconds.
+        :returns: The number of sessions waiting to be accepted."""
+        assert not self._destroyed
+
+        request = ServerPendingAcceptCountRequest(self._name, timeout)
+        response = await self._proxy.request(request)
+        return response.count
+
+    async def accept(self, new_name: str):
+        """Accept connection from a client.
+
+        :param new_name: Name by which this session should become known."""
+        assert not self._destroyed
+
+        request = ServerAcceptMessage(self._name, new_name)
+        response = await self._proxy.request(request)
+
+        session = AsyncServerSession(self, self._proxy,
+                                     response.session_name, response.handle)
+        self._clients[response.session_name] = session
+        return session
+
+
+class AsyncServerSession(object):
+    """Local proxy for server-side session with connected client."""
+
+    def __init__(self, server, proxy, name: str, handle: int):
+        """(Internal) Constructor."""
+        self._server = server
+        self._proxy = proxy
+        self._name = name
+        self._handle = handle
+        self._connected = True
+        self._subscription = None
+        self._subscription_key = None
+        return
+
+    async def destroy(self):
+        """Clean up this session, both locally and in remote agent."""
+        if self._connected:
+            await self.disconnect()
+        return
+
+    async def is_connected(self):
+        """Return True if the session remains connected."""
+        request = ServerIsConnectedRequest(self._name)
+        response = await self._proxy.request(request)
+        return response.connected
+
+    async def disconnect(self):
+        """Disconnect this session from its client."""
+        request = ServerDisconnectMessage(self._name)
+        await self._proxy.request(request)
+
+        self._connected = False
+        return
+
+    async def send(self, message: bytes):
+        """Send a message to the connected FIX client.
+
+        :param message: Byte array of formatted FIX message to send."""
+        assert self._connected
+
+        if self._proxy.is_binary():
+            await self._proxy.request_frame(OP_SESSION_SEND, self._handle,
+                                            message)
+        else:
+            payload = base64.b64encode(message).decode("ascii")
+            request = SessionSendMessage(self._name, payload)
+            await self._proxy.request(request)
+        return
+
+    async def send_batch(self, messages: list):
+        """Send several messages to the connected FIX client.
+
+        :param messages: List of byte arrays of formatted FIX messages
+        to send, in order."""
+        assert self._connected
+
+        if self._proxy.is_binary():
+            await self._proxy.request_frame(OP_SESSION_SEND, self._handle,
+                                            b''.join(messages))
+        else:
+            payloads = [base64.b64encode(m).decode("ascii")
+                        for m in messages]
+            request = SessionSendBatchMessage(self._name, payloads)
+            await self._proxy.request(request)
+        return
+
+    async def subscribe(self, callback=None):
+        """Have received FIX messages pushed from the agent as they arrive.
+
+        :param callback: Optional function, called with each message.
+        :returns: AsyncSubscription."""
+        assert self._connected
+        assert self._subscription is None
+
+        if self._proxy.is_binary():
+            key = (OP_SESSION_RECEIVED, self._handle)
+        else:
+            key = ("session_received", self._name)
+
+        subscription = AsyncSubscription(self, callback)
+        self._proxy.add_subscription(key, subscription)
+        try:
+            await self._proxy.request(SessionSubscribeMessage(self._name,
+                                                              True))
+        except (RuntimeError, ConnectionError):
+            self._proxy.remove_subscription(key)
+            raise
+
+        self._subscription = subscription
+        self._subscription_key = key
+        return subscription
+
+    async def unsubscribe(self):
+        """Cancel the subscription to received messages."""
+        assert self._subscription is not None
+
+        await self._proxy.request(SessionSubscribeMessage(self._name, False))
+
+        self._proxy.remove_subscription(self._subscription_key)
+        self._subscription.deliver(None)
+        self._subscription = None
+        return
+
+    async def configure(self, **options):
+        """Change the session's configurable options, in the agent.
+
+        :param options: Option values, by name.  Options not given are
+        left unchanged.
+
+        - queue_capacity: maximum number of received messages the agent
+          holds in memory, or None for no limit.
+        - queue_policy: what happens to received messages when the
+          queue is full; one of "block" (stop reading from the socket),
+          "drop_oldest", "drop_newest", or "spill" (to a file).
+        - write_high_watermark: size, in bytes, at which the outbound
+          buffer is reported as paused.
+        - write_low_watermark: size, in bytes, at which the outbound
+          buffer is reported as resumed.
+        - raw: if True, the agent never reads received messages' fields.
+        - heartbeat_interval: HeartBtInt, in seconds, for automatic
+          Heartbeats and TestRequests, or zero (the default) for none.
+          Implies auto_sequence.
+        - auto_heartbeat: if False, automatic heartbeats are disabled.
+        - auto_sequence: if True, the agent sets MsgSeqNum, SendingTime,
+          BodyLength and CheckSum in sent messages, and checks the
+          MsgSeqNum of received messages for gaps.
+        - next_send_sequence: MsgSeqNum for the next message sent.
+        - next_receive_sequence: MsgSeqNum expected next from the peer.
+        - session_layer: if True, the agent handles Logon, Logout,
+          Heartbeat, TestRequest, ResendRequest and SequenceReset
+          messages itself, and only passes on application messages.
+        - begin_string, sender_comp_id, target_comp_id: header fields
+          for session-level messages.  A server session takes any not
+          configured from the client's Logon.
+        - journal: True to record sent and received messages in a new
+          journal file in the system's temporary directory, a directory
+          name for the file, or False to close the journal.
+        - journal_sync_interval: None (the default) to leave writing
+          the journal to the operating system, zero to flush each
+          message to disk, or the maximum time, in seconds, before
+          messages are flushed together."""
+        assert self._connected
+
+        request = SessionConfigureMessage(self._name, options)
+        await self._proxy.request(request)
+        return
+
+    async def sequence_numbers(self):
+        """Return the session's sequence numbers.
+
+        :returns: Tuple of the MsgSeqNum for the next message sent, the
+        MsgSeqNum expected next from the peer, and a list of (first,
+        last) ranges of MsgSeqNums missing from received messages."""
+        assert self._connected
+
+        request = SessionSequenceRequest(self._name)
+        response = await self._proxy.request(request)
+        return (response.next_send_sequence, response.next_receive_sequence,
+                [tuple(gap) for gap in response.gaps])
+
+    async def journal(self, begin: int = 1, end: int = 0,
+                      direction: str = "sent", max_count: int = None):
+        """Return messages recorded in the session's journal.
+
+        :param begin: First MsgSeqNum.
+        :param end: Last MsgSeqNum, or zero for no limit.
+        :param direction: "sent" or "received".
+        :param max_count: Maximum number of messages to return, or None
+        for no limit.  The agent returns at most JOURNAL_MAX_COUNT per
+        request, so long ranges take several requests.
+        :returns: List of the recorded messages' bytes, in MsgSeqNum
+        order.  Numbers not recorded are skipped.
+
+        The journal must be enabled with configure(journal=...)."""
+        # The agent returns a limited number of messages per request,
+        # so a long range is fetched in pieces.
+        messages = []
+        while max_count is None or len(messages) < max_count:
+            count = None if max_count is None else max_count - len(messages)
+            request = SessionJournalRequest(self._name, begin, end, direction,
+                                            count)
+            response = await self._proxy.request(request)
+            if not response.payloads:
+                break
+            messages.extend(base64.b64decode(payload)
+                            for payload in response.payloads)
+            last = sequence_number(messages[-1])
+            if last is None or (end and last >= end):
+                break
+            begin = last + 1
+        return messages
+
+    async def journal_path(self) -> str:
+        """Return the path of the session's journal file."""
+        request = SessionJournalRequest(self._name, 1, 0, "sent", 0)
+        response = await self._proxy.request(request)
+        return response.path
+
+    async def watch_writes(self, callback=None):
+        """Have the agent report when its outbound buffer for this session
+        crosses the high or low watermark.
+
+        :param callback: Optional function, called with the paused flag
+        and the number of bytes buffered for each report.
+        :returns: WriteWatch."""
+        assert self._connected
+
+        watch = WriteWatch(None, callback)
+        key = ("session_write_state", self._name)
+        self._proxy.add_subscription(key, watch)
+        await self.configure(write_notify=True)
+        return watch
+
+    async def receive_queue_length(self):
+        """Return the number of messages queued from the connected client."""
+        assert self._connected
+
+        request = SessionReceiveCountRequest(self._name)
+        response = await self._proxy.request(request)
+        return response.count
+
+    async def receive(self, timeout: float = None) -> bytes:
+        """Return a message received from the connected client.
+
+        :param timeout: If no messages are queued, the maximum time to
+        wait for one to arrive, in seconds.
+
+        If no messages are queued (after waiting), returns None."""
+        assert self._connected
+
+        if self._proxy.is_binary():
+            payload = b''
+            if timeout:
+                payload = struct.pack(">L", int(timeout * 1000))
+            response = await self._proxy.request_frame(OP_SESSION_GET,
+                                                       self._handle, payload)
+            if response.opcode & OP_EMPTY:
+                return None
+            return response.payload
+
+        request = SessionGetMessage(self._name, timeout)
+        response = await self._proxy.request(request)
+        if response.payload is None:
+            return None
+        return base64.b64decode(response.payload)
+
+    async def receive_all(self, max_count: int = None,
+                          max_bytes: int = None):
+        """Return all messages received from the connected client.
+
+        :param max_count: Maximum number of messages to return.
+        :param max_bytes: Maximum total size of messages to return.
+        :returns: List of messages, in the order they were received."""
+        assert self._connected
+
+        if self._proxy.is_binary():
+            limits = struct.pack(">LL", max_count or 0, max_bytes or 0)
+            response = await self._proxy.request_frame(OP_SESSION_GET_ALL,
+                                                       self._handle, limits)
+            return unpack_messages(response.payload)
+
+        request = SessionGetAllMessage(self._name, max_count, max_bytes)
+        response = await self._proxy.request(request)
+        return [base64.b64decode(p) for p in response.payloads]
+
+
+class AsyncFixToolProxy(object):
+    """Asyncio proxy for communication with remote FIX agent.
+
+    Any number of requests can be awaited concurrently: they share a
+    single control connection, and responses are matched to requests
+    using their request identifiers."""
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter):
+        """(Internal) Constructor.
+
+        Use AsyncFixToolProxy.connect() to create a proxy."""
+        self._reader = reader
+        self._writer = writer
+        self._clients = {}
+        self._servers = {}
+        self._binary = False
+
+        self._next_request_id = 1
+        self._pending = {}
+        self._subscriptions = {}
+        self._closed = None
+
+        self._read_task = asyncio.ensure_future(self.read_loop())
+        return
+
+    @staticmethod
+    async def connect(host: str, port: int, binary: bool = False,
+                      unix_path: str = None):
+        """Create a proxy, connected to an agent.
+
+        :param host: String host name or IP address for agent.
+        :param port: Integer TCP port number for agent.
+        :param binary: If True, use binary frames to carry FIX messages.
+        :param unix_path: If set, connect to the agent's Unix domain
+        socket at this path, ignoring host and port."""
+        if unix_path:
+            reader, writer = await asyncio.open_unix_connection(unix_path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        proxy = AsyncFixToolProxy(reader, writer)
+        if binary:
+            response = await proxy.request(NegotiateMessage(True))
+            proxy._binary = response.binary
+        return proxy
+
+    def is_binary(self) -> bool:
+        """Return True if binary frames are in use with the agent."""
+        return self._binary
+
+    async def shutdown(self):
+        """Shutdown the associated agent."""
+        self.send_payload(ShutdownMessage().to_json().encode('UTF-8'))
+        await self.close()
+        return
+
+    async def reset(self):
+        """Reset the associated agent."""
+        self.send_payload(ResetMessage().to_json().encode('UTF-8'))
+        await self._writer.drain()
+
+        self._clients = {}
+        self._servers = {}
+        return
+
+    async def close(self):
+        """Close the connection to the agent, leaving it running.
+
+        Any outstanding requests fail with ConnectionError."""
+        self._read_task.cancel()
+        self._writer.close()
+        self.fail_pending("Proxy closed")
+
+        self._clients = {}
+        self._servers = {}
+        return
+
+    async def create_client(self, name: str):
+        """Create a FIX client.
+
+        :param name: Unique name for this FIX client."""
+        response = await self.request(ClientCreateMessage(name))
+        client = AsyncClient(self, name, response.handle)
+        self._clients[name] = client
+        return client
+
+    async def create_server(self, name: str):
+        """Create a FIX server.
+
+        :param name: Unique name for this FIX server."""
+        await self.request(ServerCreateMessage(name))
+        server = AsyncServer(self, name)
+        self._servers[name] = server
+        return server
+
+    async def request(self, message):
+        """(Internal) Send request to agent, and wait for the response.
+
+        :param message: Request message to send.
+        :returns: Response message.
+
+        Raises RuntimeError if the request failed."""
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        message.request_id = request_id
+
+        payload = message.to_json().encode('UTF-8')
+        return await self.send_and_wait(request_id, payload)
+
+    async def request_frame(self, opcode: int, handle: int,
+                            payload: bytes = b''):
+        """(Internal) Send binary frame to agent, and wait for the response.
+
+        :param opcode: Binary frame opcode.
+        :param handle: Handle of client or server session.
+        :param payload: Raw frame payload.
+        :returns: Response frame.
+
+        Raises RuntimeError if the request failed."""
+        request_id = self._next_request_id
+        self._next_request_id += 1
+
+        frame = BinaryFrame(opcode, handle, request_id, payload)
+        return await self.send_and_wait(request_id, frame.to_bytes())
+
+    async def send_and_wait(self, request_id: int, payload: bytes):
+        """(Internal) Send request payload, and wait for the response.
+
+        Raises ConnectionError if the connection to the agent is closed,
+        before or while waiting."""
+        if self._closed is not None:
+            raise ConnectionError(self._closed)
+
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self.send_payload(payload)
+            await self._writer.drain()
+        except Exception:
+            self._pending.pop(request_id, None)
+            raise
+
+        response = await future
+        if not response.result:
+            raise RuntimeError(response.message)
+        return response
+
+    def send_payload(self, payload: bytes):
+        """(Internal) Write a framed payload to the agent."""
+        self._writer.write(struct.pack(">L", len(payload)) + payload)
+        return
+
+    async def read_loop(self):
+        """(Internal) Read messages from agent, and dispatch them.
+
+        However the loop ends, outstanding requests are failed."""
+        reason = "Connection to agent lost"
+        try:
+            while True:
+                header = await self._reader.readexactly(4)
+                length = struct.unpack(">L", header)[0]
+                payload = await self._reader.readexactly(length)
+                self.dispatch(payload)
+
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            reason = str(e) or reason
+        except asyncio.CancelledError:
+            reason = "Proxy closed"
+            raise
+        except Exception as e:
+            logging.exception("Failed to handle message from agent")
+            reason = str(e) or reason
+        finally:
+            self.fail_pending(reason)
+        return
+
+    def fail_pending(self, reason: str):
+        """(Internal) Fail outstanding and future requests.
+
+        :param reason: Description of why the connection closed.
+
+        Subscriptions are ended too."""
+        if self._closed is None:
+            self._closed = reason
+
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(self._closed))
+
+        for subscription in list(self._subscriptions.values()):
+            subscription.deliver(None)
+        self._subscriptions = {}
+        return
+
+    def dispatch(self, payload: bytes):
+        """(Internal) Handle a message received from the agent."""
+        if BinaryFrame.is_binary(payload):
+            message = BinaryFrame.from_bytes(payload)
+        else:
+            message = decode_response(json.loads(payload.decode()))
+            if message is None:
+                return
+
+        if not message.request_id:
+            # Pushed message for a subscription.
+            if isinstance(message, BinaryFrame):
+                key = (message.opcode, message.handle)
+                fix_message = message.payload
+            elif isinstance(message, (ClientWriteStateMessage,
+                                      SessionWriteStateMessage)):
+                key = (message.type, message.name)
+                fix_message = message
+            else:
+                key = (message.type, message.name)
+                fix_message = base64.b64decode(message.payload)
+
+            subscription = self._subscriptions.get(key)
+            if subscription is None:
+                logging.warning("Unexpected pushed message: %s", str(key))
+            else:
+                subscription.deliver(fix_message)
+            return
+
+        future = self._pending.pop(message.request_id, None)
+        if future is None:
+            logging.warning("Unexpected response: %d", message.request_id)
+        elif not future.done():
+            future.set_result(message)
+        return
+
+    def add_subscription(self, key, subscription: AsyncSubscription):
+        """(Internal) Register subscription for pushed messages."""
+        self._subscriptions[key] = subscription
+        return
+
+    def remove_subscription(self, key):
+        """(Internal) Unregister subscription."""
+        self._subscriptions.pop(key, None)
+        return
+
+    def remove_client(self, name):
+        """(Internal) Remove named client from clients table."""
+        del self._clients[name]
+        return
+
+    def remove_server(self, name):
+        """(Internal) Remove named server from servers table."""
+        del self._servers[name]
+        return
@@ -0,0 +1,436 @@
+#! /usr/bin/env python3
+##################################################################
+# fixtool
+# Copyright (C) 2018, David Arnold.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##################################################################
+
+"""Framing of FIX messages, without parsing them.
+
+A FIX message starts with BeginString (8), followed by BodyLength (9),
+which gives the number of bytes from the end of the BodyLength field to
+the start of the CheckSum (10) field.  The CheckSum field is always
+last.  That's enough to find the end of each message in a stream of
+bytes without splitting it into fields, so the original bytes can be
+passed on unchanged, and without the cost of parsing and re-encoding
+messages that are never inspected.
+
+Where the agent does need a message's fields, a WireMessage locates
+them in the original bytes, the first time any are requested."""
+
+import array
+import time
+
+import simplefix
+from simplefix.parser import RAW_DATA_TAGS, RAW_LEN_TAGS
+
+SOH = b'\x01'
+# BeginString is matched with the start of its value, which is either
+# FIX.x.y or FIXT.1.1, so it's unlikely to match within another field.
+BEGIN_STRING = b'8=FIX'
+BODY_LENGTH = b'9='
+CHECKSUM = b'10='
+# Fields stamped by the agent, matched with their preceding SOH.
+MSG_TYPE = b'\x0135='
+MSG_SEQ_NUM = b'\x0134='
+SENDING_TIME = b'\x0152='
+POSS_DUP_FLAG = b'\x0143=Y\x01'
+ORIG_SENDING_TIME = b'\x01122='
+
+# Longest BodyLength value accepted, in digits.
+MAX_LENGTH_DIGITS = 9
+
+# Largest BodyLength accepted.  A corrupt or hostile length could
+# otherwise have the framer buffer up to a gigabyte, waiting for the
+# rest of a message that never comes.
+MAX_BODY_LENGTH = 16 * 1024 * 1024
+
+# Longest CheckSum value accepted, in digits.
+MAX_CHECKSUM_DIGITS = 3
+
+# Standard header fields, looked up without scanning the index:
+# MsgType, MsgSeqNum, SenderCompID, TargetCompID and SendingTime.
+HEADER_TAGS = (35, 34, 49, 56, 52)
+HEADER_SLOTS = dict((tag, slot) for slot, tag in enumerate(HEADER_TAGS))
+
+
+class FixFramer(object):
+    """Splits a stream of bytes into FIX messages.
+
+    Bytes that don't start a well-formed message are skipped, up to the
+    next BeginString field.  That includes a BodyLength larger than
+    MAX_BODY_LENGTH, so a bad length can't stall the stream."""
+
+    def __init__(self):
+        """Constructor."""
+        self._buffer = bytearray()
+        return
+
+    def pending(self) -> bytes:
+        """Return bytes received, but not yet part of a message."""
+        return bytes(self._buffer)
+
+    def append_buffer(self, buf: bytes):
+        """Append received bytes, and return any complete messages.
+
+        :param buf: Array of received bytes.
+        :returns: List of messages, each the bytes as received."""
+        buffer = self._buffer
+        buffer += buf
+
+        messages = []
+        position = 0
+        available = len(buffer)
+        with memoryview(buffer) as view:
+            while position < available:
+                start = buffer.find(BEGIN_STRING, position)
+                if start < 0:
+                    # Keep trailing bytes that could start BeginString.
+                    position = max(position,
+                                   available - len(BEGIN_STRING) + 1)
+                    break
+
+                end = self.find_end(start)
+                if end == 0:
+                    # Incomplete message.
+                    position = start
+                    break
+
+                if end < 0:
+                    # Not a well-formed message; look for the next one.
+                    position = start + 1
+                    continue
+
+                messages.append(bytes(view[start:end]))
+                position = end
+
+        if position:
+            del buffer[:position]
+        return messages
+
+    def find_end(self, start: int) -> int:
+        """Return the offset following the message at start.
+
+        :param start: Offset of the message's BeginString field.
+        :returns: Offset, or 0 if the message is incomplete, or -1 if
+        it's malformed."""
+        buffer = self._buffer
+        available = len(buffer)
+
+        begin_end = buffer.find(SOH, start)
+        if begin_end < 0:
+            return 0
+
+        length_start = begin_end + 1 + len(BODY_LENGTH)
+        if available < length_start:
+            return 0
+        if buffer[begin_end + 1:length_start] != BODY_LENGTH:
+            return -1
+
+        length_end = buffer.find(SOH, length_start,
+                                 length_start + MAX_LENGTH_DIGITS + 1)
+        if length_end < 0:
+            if available - length_start > MAX_LENGTH_DIGITS:
+                return -1
+            return 0
+
+        digits = buffer[length_start:length_end]
+        if not digits.isdigit():
+            return -1
+        body_length = int(digits)
+        if body_length > MAX_BODY_LENGTH:
+            return -1
+
+        checksum_start = length_end + 1 + body_length
+        checksum_end = checksum_start + len(CHECKSUM)
+        if available < checksum_end:
+            return 0
+        if buffer[checksum_start:checksum_end] != CHECKSUM:
+            return -1
+
+        end = buffer.find(SOH, checksum_end,
+                          checksum_end + MAX_CHECKSUM_DIGITS + 1)
+        if end < 0:
+            if available - checksum_end > MAX_CHECKSUM_DIGITS:
+                return -1
+            return 0
+        return end + 1
+
+
+class SendingTime(object):
+    """Formats SendingTime (52) values.
+
+    The date and time are formatted once per second, and only the
+    milliseconds for each value."""
+
+    def __init__(self):
+        """Constructor."""
+        self._second = None
+        self._prefix = b''
+        return
+
+    def now(self) -> bytes:
+        """Return the current UTC time, with milliseconds."""
+        now = time.time()
+        second = int(now)
+        if second != self._second:
+            self._second = second
+            self._prefix = time.strftime("%Y%m%d-%H:%M:%S.",
+                                         time.gmtime(second)).encode()
+        return self._prefix + b'%03d' % int((now - second) * 1000)
+
+
+def split_messages(buffer: bytes) -> list:
+    """Split concatenated messages at the start of each BeginString.
+
+    :param buffer: Bytes of one or more complete messages.
+    :returns: List of messages.
+
+    Unlike FixFramer, this doesn't need BodyLength fields, so works for
+    messages that are yet to be stamped."""
+    messages = []
+    start = 0
+    end = buffer.find(SOH + BEGIN_STRING)
+    while end >= 0:
+        messages.append(buffer[start:end + 1])
+        start = end + 1
+        end = buffer.find(SOH + BEGIN_STRING, start)
+    messages.append(buffer[start:])
+    return messages
+
+
+def sequence_number(message: bytes):
+    """Return a message's MsgSeqNum, or None if it hasn't got one.
+
+    :param message: Bytes of a complete message.
+
+    The field is found without parsing the rest of the message."""
+    start = message.find(MSG_SEQ_NUM)
+    if start < 0:
+        return None
+    start += len(MSG_SEQ_NUM)
+    digits = message[start:message.find(SOH, start)]
+    if not digits.isdigit():
+        return None
+    return int(digits)
+
+
+def message_type(message: bytes):
+    """Return a message's MsgType, or None if it hasn't got one.
+
+    :param message: Bytes of a complete message.
+
+    The field is found without parsing the rest of the message."""
+    start = message.find(MSG_TYPE)
+    if start < 0:
+        return None
+    start += len(MSG_TYPE)
+    return message[start:message.find(SOH, start)]
+
+
+def stamp(message: bytes, sequence: int, sending_time: bytes,
+          possible_duplicate: bool = False) -> bytes:
+    """Return a message with its MsgSeqNum and SendingTime set.
+
+    :param message: Bytes of a complete message.
+    :param sequence: MsgSeqNum (34) value.
+    :param sending_time: SendingTime (52) value.
+    :param possible_duplicate: If True, the message is being resent:
+    PossDupFlag (43) is added, and the original SendingTime is kept as
+    OrigSendingTime (122), unless they're already present.
+
+    Existing MsgSeqNum and SendingTime fields are replaced, or if
+    missing, added after MsgType.  BodyLength (9) and CheckSum (10) are
+    then (re)calculated, and may be missing or wrong in the original.
+    All other fields are copied unchanged, without being parsed.
+
+    Raises ValueError if the message doesn't start with BeginString,
+    MsgType doesn't follow it (and BodyLength, if present), or the
+    message doesn't end with SOH."""
+    begin_end = message.find(SOH) + 1
+    if not message.startswith(b'8=') or begin_end == 0 or \
+            not message.endswith(SOH):
+        raise ValueError("Message doesn't start with BeginString")
+
+    body_start = begin_end
+    if message.startswith(BODY_LENGTH, body_start):
+        body_start = message.find(SOH, body_start) + 1
+    if not message.startswith(b'35=', body_start):
+        raise ValueError("MsgType doesn't follow BodyLength")
+    type_end = message.find(SOH, body_start) + 1
+
+    body_end = len(message)
+    checksum = message.rfind(SOH + CHECKSUM, body_start - 1) + 1
+    if checksum and message.find(SOH, checksum) == body_end - 1:
+        body_end = checksum
+
+    # Slices of the body to replace, with their new contents.
+    edits = []
+    original_time = None
+    for marker, value in ((MSG_SEQ_NUM, b'%d' % sequence),
+                          (SENDING_TIME, sending_time)):
+        start = message.find(marker, type_end - 1, body_end)
+        if start < 0:
+            edits.append((type_end, type_end,
+                          marker[1:] + value + SOH))
+        else:
+            start += len(marker)
+            end = message.find(SOH, start)
+            if marker == SENDING_TIME:
+                original_time = message[start:end]
+            edits.append((start, end, value))
+
+    if possible_duplicate:
+        added = b''
+        if message.find(POSS_DUP_FLAG, type_end - 1, body_end) < 0:
+            added += POSS_DUP_FLAG[1:]
+        if original_time is not None and \
+                message.find(ORIG_SENDING_TIME, type_end - 1, body_end) < 0:
+            added += ORIG_SENDING_TIME[1:] + original_time + SOH
+        if added:
+            edits.append((type_end, type_end, added))
+    edits.sort()
+
+    parts = []
+    position = body_start
+    for start, end, value in edits:
+        parts.append(message[position:start])
+        parts.append(value)
+        position = end
+    parts.append(message[position:body_end])
+    body = b''.join(parts)
+
+    header = message[:begin_end] + b'9=%d\x01' % len(body)
+    total = (sum(header) + sum(body)) % 256
+    return b''.join((header, body, b'10=%03d\x01' % total))
+
+
+class WireMessage(object):
+    """A FIX message, held as its bytes on the wire.
+
+    The first request for a field scans the message once, building an
+    index of (tag, value start, value end) offset triples, stored flat
+    in a single array.  The standard header fields in HEADER_TAGS are
+    also indexed by position, so looking them up doesn't scan.  Values
+    are sliced from the original bytes, so the message is never
+    re-encoded."""
+
+    __slots__ = ("buffer", "_index", "_header")
+
+    def __init__(self, buffer: bytes):
+        """Constructor.
+
+        :param buffer: Bytes of a complete message."""
+        self.buffer = buffer
+        self._index = None
+        self._header = None
+        return
+
+    def __bytes__(self):
+        return self.buffer
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def index(self) -> array.array:
+        """Return the index of (tag, value start, value end) triples.
+
+        Raises ValueError if the message is malformed."""
+        if self._index is not None:
+            return self._index
+
+        buffer = self.buffer
+        index = array.array("I")
+        header = array.array("I", bytes(len(HEADER_TAGS) *
+                                        index.itemsize))
+        raw_length = None
+        position = 0
+        while position < len(buffer):
+            equals = buffer.find(b'=', position)
+            if equals < 0:
+                raise ValueError("Missing '=' at offset %d" % position)
+            tag = int(buffer[position:equals])
+
+            start = equals + 1
+            if tag in RAW_DATA_TAGS and raw_length is not None:
+                # Data fields can contain SOH, so use the preceding
+                # length field rather than searching for the end.
+                end = start + raw_length
+                if buffer[end:end + 1] != SOH:
+                    raise ValueError("Bad length for data field %d" % tag)
+            else:
+                end = buffer.find(SOH, start)
+                if end < 0:
+                    raise ValueError("Unterminated field %d" % tag)
+
+            raw_length = int(buffer[start:end]) \
+                if tag in RAW_LEN_TAGS else None
+
+            # Header slots hold the field's position in the index, plus
+            # one, so that zero means absent.
+            slot = HEADER_SLOTS.get(tag)
+            if slot is not None and not header[slot]:
+                header[slot] = len(index) + 1
+
+            index.extend((tag, start, end))
+            position = end + 1
+
+        self._index = index
+        self._header = header
+        return index
+
+    def field_count(self) -> int:
+        """Return the number of fields in the message."""
+        return len(self.index()) // 3
+
+    def get(self, tag: int, nth: int = 1):
+        """Return the value of a field, or None if it isn't present.
+
+        :param tag: Field tag number.
+        :param nth: Occurrence of the field to return, counting from
+        one, for repeating groups."""
+        index = self.index()
+        slot = HEADER_SLOTS.get(tag)
+        if slot is not None and nth == 1:
+            position = self._header[slot]
+            if not position:
+                return None
+            return self.buffer[index[position]:index[position + 1]]
+
+        for i in range(0, len(index), 3):
+            if index[i] == tag:
+                nth -= 1
+                if nth == 0:
+                    return self.buffer[index[i + 1]:index[i + 2]]
+        return None
+
+    def fields(self) -> list:
+        """Return a list of (tag, value) pairs, in message order."""
+        index = self.index()
+        return [(index[i], self.buffer[index[i + 1]:index[i + 2]])
+                for i in range(0, len(index), 3)]
+
+    def to_fix_message(self) -> simplefix.FixMessage:
+        """Return a simplefix message with the same fields."""
+        message = simplefix.FixMessage()
+        for tag, value in self.fields():
+            message.append_pair(tag, value)
+        return message
@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+##################################################################
+# fixtool
+# Copyright (C) 2018, David Arnold.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##################################################################
+
+"""Heartbeat and TestRequest engine for simulated sessions."""
+
+import logging
+
+import simplefix
+
+from fixtool.framing import WireMessage
+from fixtool.timerwheel import TimerWheel
+
+# Type markers for TestRequest messages, matched without parsing.
+TEST_REQUEST = b'\x0135=1\x01'
+
+
+class Heartbeat(object):
+    """Keeps an idle session alive, and detects a silent peer.
+
+    When nothing has been sent for HeartBtInt seconds, a Heartbeat (0)
+    is sent.  When nothing has been received for HeartBtInt seconds plus
+    a grace period, a TestRequest (1) is sent, and if nothing has been
+    received within a further HeartBtInt, the session is disconnected.
+    Received TestRequests are answered with a Heartbeat carrying their
+    TestReqID (112).
+
+    Sending and receiving only record the time: the session's single
+    timer checks those times when it expires, and re-arms itself for the
+    next deadline, so busy sessions don't touch the timer wheel at all.
+
+    The header of generated messages is taken from the last message the
+    test sent, or failing that, reversed from the last one received.
+    Nothing can be sent without one, so the timer isn't armed until a
+    header is known.  In raw mode messages are never inspected, so the
+    engine stays idle unless the session layer sets the header."""
+
+    # Grace period before sending a TestRequest, as a fraction of
+    # HeartBtInt.
+    GRACE = 0.2
+
+    def __init__(self, entity, timers: TimerWheel):
+        """Constructor.
+
+        :param entity: Client or ServerSession to keep alive.
+        :param timers: Agent's shared timer wheel."""
+        self._entity = entity
+        self._timers = timers
+        self._loop = timers.loop()
+        self._interval = 0
+        self._timer = None
+        self._last_sent = 0.0
+        self._last_received = 0.0
+        self._test_request_id = None
+        self._test_request_count = 0
+        self._header = None
+        return
+
+    def interval(self):
+        """Return HeartBtInt, in seconds, or zero if disabled."""
+        return self._interval
+
+    @staticmethod
+    def check_interval(interval):
+        """Raise ValueError if a HeartBtInt is invalid.
+
+        :param interval: As for set_interval()."""
+        if isinstance(interval, bool) or \
+                not isinstance(interval, (int, float)) or interval < 0:
+            raise ValueError("Bad heartbeat interval: %s" % str(interval))
+        return
+
+    def set_interval(self, interval):
+        """Set HeartBtInt.
+
+        :param interval: Seconds between heartbeats, or zero to
+        disable the engine.
+
+        Raises ValueError if the interval is invalid."""
+        self.check_interval(interval)
+        self._interval = interval
+        self.start()
+        return
+
+    def set_header(self, begin_string: bytes, sender: bytes,
+                   target: bytes):
+        """Set the header fields for generated messages.
+
+        :param begin_string: BeginString (8) value.
+        :param sender: SenderCompID (49) value.
+        :param target: TargetCompID (56) value."""
+        self.learn_header((begin_string, sender, target))
+        return
+
+    def learn_header(self, header: tuple):
+        """Record the header for generated messages, and arm the timer
+        if it was waiting for the first one.
+
+        :param header: Tuple of BeginString, SenderCompID and
+        TargetCompID values."""
+        waiting = self._header is None
+        self._header = header
+        if waiting and self._timer is None and self._interval > 0 and \
+                self._entity.is_connected():
+            self.arm(self._interval)
+        return
+
+    def start(self):
+        """Start (or restart) the engine, if connected and enabled.
+
+        The timer is armed once a header is known."""
+        self.stop()
+        if self._interval > 0 and self._entity.is_connected():
+            now = self._loop.time()
+            self._last_sent = now
+            self._last_received = now
+            if self._header is not None:
+                self.arm(self._interval)
+        return
+
+    def stop(self):
+        """Stop the engine."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._test_request_id = None
+        return
+
+    def arm(self, delay: float):
+        """Set the session's timer.
+
+        :param delay: Seconds until the timer expires."""
+        self._timer = self._timers.schedule(delay, self.expired)
+        return
+
+    def sent(self, message: bytes, raw: bool):
+        """Record a message sent by the test.
+
+        :param message: Byte array of formatted FIX message.
+        :param raw: If True, don't look inside the message."""
+        if not self._interval:
+            return
+
+        self._last_sent = self._loop.time()
+        if raw:
+            return
+
+        try:
+            wire = WireMessage(message)
+            header = (wire.get(8), wire.get(49), wire.get(56))
+        except ValueError:
+            return
+
+        if None not in header:
+            self.learn_header(header)
+        return
+
+    def received(self, wire: WireMessage, raw: bool):
+        """Record a message received from the peer.
+
+        :param wire: Received FIX message.
+        :param raw: If True, don't look inside the message."""
+        if not self._interval:
+            return
+
+        self._last_received = self._loop.time()
+        self._test_request_id = None
+        if raw or (self._header is not None and
+                   TEST_REQUEST not in wire.buffer):
+            return
+
+        try:
+            if self._header is None:
+                header = (wire.get(8), wire.get(56), wire.get(49))
+                if None not in header:
+                    self.learn_header(header)
+
+            if wire.get(35) == b'1':
+                self.send_heartbeat(wire.get(112))
+        except ValueError:
+            pass
+        return
+
+    def expired(self):
+        """Check the session's deadlines when its timer expires."""
+        self._timer = None
+        if not self._interval or not self._entity.is_connected() or \
+                self._header is None:
+            return
+
+        now = self._loop.time()
+        if now - self._last_sent >= self._interval:
+            self.send_heartbeat()
+
+        silence = now - self._last_received
+        if self._test_request_id is not None:
+            if silence >= self._interval * (2 + self.GRACE):
+                logging.warning("No reply to TestRequest %s; "
+                                "disconnecting",
+                                self._test_request_id.decode())
+                self._entity.disconnect()
+                return
+            receive_deadline = self._interval * (2 + self.GRACE)
+
+        elif silence >= self._interval * (1 + self.GRACE):
+            self.send_test_request()
+            receive_deadline = self._interval * (2 + self.GRACE)
+
+        else:
+            receive_deadline = self._interval * (1 + self.GRACE)
+
+        self.arm(min(self._last_sent + self._interval,
+                     self._last_received + receive_deadline) - now)
+        return
+
+    def send_heartbeat(self, test_request_id: bytes = None):
+        """Send a Heartbeat message.
+
+        :param test_request_id: TestReqID being answered, if any."""
+        message = self.new_message(b'0')
+        if message is None:
+            return
+
+        if test_request_id is not None:
+            message.append_pair(112, test_request_id)
+        self.write(message)
+        return
+
+    def send_test_request(self):
+        """Send a TestRequest message."""
+        message = self.new_message(b'1')
+        if message is None:
+            return
+
+        self._test_request_count += 1
+        self._test_request_id = b'TEST%d' % self._test_request_count
+        message.append_pair(112, self._test_request_id)
+        self.write(message)
+        return
+
+    def new_message(self, message_type: bytes):
+        """Return a new message with the session's header, or None.
+
+        :param message_type: MsgType (35) value.
+
+        MsgSeqNum and SendingTime are left to the entity's automatic
+        sequencing, which heartbeats imply."""
+        if self._header is None:
+            return None
+
+        begin_string, sender, target = self._header
+        message = simplefix.FixMessage()
+        message.append_pair(8, begin_string, header=True)
+        message.append_pair(35, message_type, header=True)
+        message.append_pair(49, sender, header=True)
+        message.append_pair(56, target, header=True)
+        return message
+
+    def write(self, message: simplefix.FixMessage):
+        """Send a generated message.
+
+        :param message: Message to send.
+
+        The message is sent like the test's own, and stamped with the
+        session's next MsgSeqNum."""
+        self._entity.send_message(message.encode())
+        self._last_sent = self._loop.time()
+        return
@@ -0,0 +1,410 @@
+#! /usr/bin/env python3
+##################################################################
+# fixtool
+# Copyright (C) 2018, David Arnold.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##################################################################
+
+"""Memory-mapped, append-only journal of a session's messages.
+
+The file starts with a header: an eight byte magic string, and the
+offset of the end of the last record, as a big-endian 64 bit integer.
+Each record then has a header, giving the length of the message, its
+direction (sent or received), its MsgSeqNum (zero if it has none), and
+the time it was recorded, followed by the message bytes.
+
+The file is mapped into memory, and grown (and remapped) as needed, so
+appending a record is a copy into the map.  For each direction, a
+SequenceIndex maps MsgSeqNum to the offset of the latest record with
+that number, so a range of messages can be read without scanning or
+loading the rest of the file."""
+
+import array
+import heapq
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from fixtool.framing import sequence_number, split_messages
+from fixtool.timerwheel import TimerWheel
+
+MAGIC = b'FIXJRNL1'
+FILE_HEADER = struct.Struct(">8sQ")
+RECORD_HEADER = struct.Struct(">LBLd")
+
+# Largest MsgSeqNum a record can hold.  Messages with larger numbers are
+# recorded, but not indexed.
+MAX_SEQUENCE = (1 << 32) - 1
+
+# Record directions.
+SENT = 0
+RECEIVED = 1
+DIRECTIONS = {"sent": SENT, "received": RECEIVED}
+
+# Initial size of the file, in bytes.  It doubles each time it's full.
+INITIAL_SIZE = 1024 * 1024
+
+
+def check_sync_interval(sync_interval):
+    """Raise ValueError if a sync interval is invalid.
+
+    :param sync_interval: None, or a number of seconds."""
+    if sync_interval is not None and (
+            isinstance(sync_interval, bool) or
+            not isinstance(sync_interval, (int, float)) or
+            sync_interval < 0):
+        raise ValueError("Bad journal sync interval: %s" %
+                         str(sync_interval))
+    return
+
+
+def open_journal(location, sync_interval: float, timers: TimerWheel,
+                 prefix: str):
+    """Create a journal with a new, unique file name.
+
+    :param location: Directory for the file, or True for the system's
+    temporary directory.
+    :param sync_interval: As for Journal.
+    :param timers: Timer wheel.
+    :param prefix: Included in the file name, after 'fixtool-'.
+    :returns: Journal.
+
+    Raises ValueError if the location or interval is invalid, or the
+    file can't be created."""
+    if location is not True and not isinstance(location, str):
+        raise ValueError("Bad journal location: %s" % str(location))
+    check_sync_interval(sync_interval)
+
+    try:
+        fd, path = tempfile.mkstemp(
+            prefix="fixtool-%s-" % prefix, suffix=".journal",
+            dir=None if location is True else location)
+        os.close(fd)
+        return Journal(path, sync_interval, timers)
+    except OSError as e:
+        raise ValueError("Failed to create journal: %s" % str(e))
+
+
+class SequenceIndex(object):
+    """Map from MsgSeqNum to record offset, for one direction.
+
+    Offsets are held in an array, indexed from the first MsgSeqNum
+    recorded, so a session starting at a high number costs no more than
+    one starting at one.  Numbers below the first, or too far beyond the
+    end of the array, are kept in a dictionary instead: a peer's bogus
+    MsgSeqNum can't make the array huge."""
+
+    # Maximum number of entries the array grows by to hold one number,
+    # beyond doubling.
+    MAX_GROWTH = 1 << 16
+
+    def __init__(self):
+        """Constructor."""
+        self._base = None
+        self._offsets = array.array('Q')
+        self._outliers = {}
+        return
+
+    def set(self, sequence: int, offset: int):
+        """Record the offset of a message.
+
+        :param sequence: Message's MsgSeqNum.
+        :param offset: Offset of its record."""
+        if self._base is None:
+            self._base = sequence
+        offsets = self._offsets
+        position = sequence - self._base
+        if 0 <= position < len(offsets) + self.MAX_GROWTH:
+            if position >= len(offsets):
+                count = max(position + 1, len(offsets) * 2) - len(offsets)
+                offsets.frombytes(bytes(count * offsets.itemsize))
+            offsets[position] = offset
+            self._outliers.pop(sequence, None)
+        else:
+            self._outliers[sequence] = offset
+        return
+
+    def get(self, sequence: int) -> int:
+        """Return the offset of a message, or zero if not recorded.
+
+        :param sequence: MsgSeqNum."""
+        if self._base is None:
+            return 0
+        position = sequence - self._base
+        if 0 <= position < len(self._offsets) and self._offsets[position]:
+            return self._offsets[position]
+        return self._outliers.get(sequence, 0)
+
+    def last(self) -> int:
+        """Return the highest MsgSeqNum recorded, or zero."""
+        last = max(self._outliers, default=0)
+        for position in range(len(self._offsets) - 1, -1, -1):
+            if self._offsets[position]:
+                return max(last, self._base + position)
+        return last
+
+    def items(self, begin: int, end: int = 0):
+        """Generate the recorded numbers in a range, in order.
+
+        :param begin: First MsgSeqNum.
+        :param end: Last MsgSeqNum, or zero for no limit.
+        :returns: Generator of (MsgSeqNum, offset) tuples."""
+        outliers = sorted(sequence for sequence in self._outliers
+                          if sequence >= begin and
+                          (not end or sequence <= end))
+        last = 0
+        for sequence in heapq.merge(self.array_range(begin, end), outliers):
+            if sequence > last:
+                offset = self.get(sequence)
+                if offset:
+                    last = sequence
+                    yield sequence, offset
+        return
+
+    def array_range(self, begin: int, end: int):
+        """Generate the numbers in a range covered by the array.
+
+        :param begin: First MsgSeqNum.
+        :param end: Last MsgSeqNum, or zero for no limit."""
+        if self._base is None:
+            return
+        sequence = max(begin, self._base)
+        while sequence - self._base < len(self._offsets) and \
+                (not end or sequence <= end):
+            yield sequence
+            sequence += 1
+        return
+
+
+class Journal(object):
+    """Append-only journal of the messages sent and received by a
+    session."""
+
+    def __init__(self, path: str, sync_interval: float = None,
+                 timers: TimerWheel = None):
+        """Constructor.
+
+        :param path: Journal file.  An existing journal is reopened,
+        and appended to.
+        :param sync_interval: None to leave writing the file to the
+        operating system, zero to flush each record to disk as it's
+        appended, or the maximum time, in seconds, before a record is
+        flushed.  Records appended within the interval are flushed
+        together.
+        :param timers: Timer wheel, for a non-zero sync interval.
+
+        Raises OSError if the file can't be opened, or ValueError if
+        it's not a journal."""
+        self._path = path
+        self._sync_interval = sync_interval
+        self._timers = timers
+        self._timer = None
+        self._indexes = (SequenceIndex(), SequenceIndex())
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(self._fd).st_size
+            if size == 0:
+                size = INITIAL_SIZE
+                os.ftruncate(self._fd, size)
+                self._map = mmap.mmap(self._fd, size)
+                self._end = FILE_HEADER.size
+                FILE_HEADER.pack_into(self._map, 0, MAGIC, self._end)
+            else:
+                self._map = mmap.mmap(self._fd, size)
+                magic, self._end = FILE_HEADER.unpack_from(self._map, 0)
+                if magic != MAGIC or self._end > size:
+                    self._map.close()
+                    raise ValueError("Not a journal: %s" % path)
+                self.rebuild_index()
+        except (OSError, ValueError):
+            os.close(self._fd)
+            raise
+        return
+
+    def path(self) -> str:
+        """Return the journal's file path."""
+        return self._path
+
+    def set_sync_interval(self, sync_interval: float):
+        """Change the sync interval.
+
+        :param sync_interval: As for the constructor."""
+        check_sync_interval(sync_interval)
+        self._sync_interval = sync_interval
+        self.sync()
+        return
+
+    def size(self) -> int:
+        """Return the number of bytes of records in the journal."""
+        return self._end - FILE_HEADER.size
+
+    def rebuild_index(self):
+        """Index the records of a reopened journal."""
+        offset = FILE_HEADER.size
+        while offset < self._end:
+            length, direction, sequence, _ = \
+                RECORD_HEADER.unpack_from(self._map, offset)
+            if sequence:
+                self.index(direction, sequence, offset)
+            offset += RECORD_HEADER.size + length
+        return
+
+    def index(self, direction: int, sequence: int, offset: int):
+        """Record the offset of a message.
+
+        :param direction: SENT or RECEIVED.
+        :param sequence: Message's MsgSeqNum.
+        :param offset: Offset of its record."""
+        self._indexes[direction].set(sequence, offset)
+        return
+
+    def append(self, direction: int, buffer: bytes, indexed: bool = True):
+        """Append messages to the journal.
+
+        :param direction: SENT or RECEIVED.
+        :param buffer: Bytes of one or more complete messages.
+        :param indexed: If False, the messages are recorded, but not
+        indexed by MsgSeqNum.  Resent messages aren't, so the index
+        keeps the originals."""
+        for message in split_messages(buffer):
+            self.append_record(direction, message,
+                               indexed and sequence_number(message) or 0)
+        self.appended()
+        return
+
+    def appended(self):
+        """Sync appended records, as the sync interval requires."""
+        if self._sync_interval == 0:
+            self.sync()
+        elif self._sync_interval and self._timer is None:
+            self._timer = self._timers.schedule(self._sync_interval,
+                                                self.sync)
+        return
+
+    def append_record(self, direction: int, message: bytes, sequence: int):
+        """Append a single message to the journal, without syncing.
+
+        :param direction: SENT or RECEIVED.
+        :param message: Bytes of the message.
+        :param sequence: Its MsgSeqNum, or zero if it hasn't got one.
+        A number too large for the record header is recorded as zero."""
+        if not 0 <= sequence <= MAX_SEQUENCE:
+            logging.warning("%s: MsgSeqNum %d out of range; not indexed",
+                            self._path, sequence)
+            sequence = 0
+
+        offset = self._end
+        end = offset + RECORD_HEADER.size + len(message)
+        if end > len(self._map):
+            self.grow(end)
+
+        RECORD_HEADER.pack_into(self._map, offset, len(message), direction,
+                                sequence, time.time())
+        self._map[offset + RECORD_HEADER.size:end] = message
+        self._end = end
+        FILE_HEADER.pack_into(self._map, 0, MAGIC, end)
+        if sequence:
+            self.index(direction, sequence, offset)
+        return
+
+    def grow(self, needed: int):
+        """Extend the file, and remap it.
+
+        :param needed: Minimum size of the file, in bytes."""
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+
+        self._map.close()
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        return
+
+    def read(self, offset: int):
+        """Return the record at an offset.
+
+        :param offset: Offset of the record.
+        :returns: Tuple of direction, MsgSeqNum, time recorded, and
+        message bytes."""
+        length, direction, sequence, when = \
+            RECORD_HEADER.unpack_from(self._map, offset)
+        start = offset + RECORD_HEADER.size
+        return direction, sequence, when, self._map[start:start + length]
+
+    def get(self, direction: int, sequence: int):
+        """Return the latest message with a MsgSeqNum, or None.
+
+        :param direction: SENT or RECEIVED.
+        :param sequence: MsgSeqNum."""
+        offset = self._indexes[direction].get(sequence)
+        if offset:
+            return self.read(offset)[3]
+        return None
+
+    def last_sequence(self, direction: int) -> int:
+        """Return the highest MsgSeqNum indexed, or zero.
+
+        :param direction: SENT or RECEIVED."""
+        return self._indexes[direction].last()
+
+    def messages(self, direction: int, begin: int, end: int = 0):
+        """Generate the messages in a range of MsgSeqNums.
+
+        :param direction: SENT or RECEIVED.
+        :param begin: First MsgSeqNum.
+        :param end: Last MsgSeqNum, or zero for no limit.
+        :returns: Generator of (MsgSeqNum, message bytes) tuples, for
+        the numbers in the range that have been recorded.
+
+        Each message is read from the file as it's generated, so the
+        range needn't fit in memory."""
+        for sequence, offset in self._indexes[direction].items(begin, end):
+            yield sequence, self.read(offset)[3]
+        return
+
+    def sync(self):
+        """Flush appended records to disk."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._map.flush()
+        return
+
+    def close(self):
+        """Flush and close the journal."""
+        if self._map is None:
+            return
+
+        self.sync()
+        self._map.close()
+        self._map = None
+        try:
+            # Drop the unused space, so the file holds just the records.
+            os.ftruncate(self._fd, self._end)
+        except OSError as e:
+            logging.warning("Failed to truncate journal %s: %s",
+                            self._path, str(e))
+        os.close(self._fd)
+        return
@@ -24,25 +24,67 @@
 ##################################################################
 
 import json
-
-__all__ = ["ShutdownMessage",
+import struct
+
+# Maximum number of messages returned by one journal request.
+JOURNAL_MAX_COUNT = 1000
+
+__all__ = ["JOURNAL_MAX_COUNT",
+           "ControlMessage",
+           "BinaryFrame",
+           "OP_CLIENT_SEND",
+           "OP_SESSION_SEND",
+           "OP_CLIENT_GET",
+           "OP_SESSION_GET",
+           "OP_CLIENT_GET_ALL",
+           "OP_SESSION_GET_ALL",
+           "OP_CLIENT_RECEIVED",
+           "OP_SESSION_RECEIVED",
+           "OP_RESPONSE",
+           "OP_EMPTY",
+           "pack_messages",
+           "unpack_messages",
+           "NegotiateMessage",
+           "NegotiatedMessage",
+           "ShutdownMessage",
            "ResetMessage",
+           "BadRequestMessage",
            "ClientCreateMessage",
            "ClientCreatedMessage",
            "ClientDestroyMessage",
            "ClientDestroyedMessage",
            "ClientConnectMessage",
            "ClientConnectedMessage",
+           "ClientDisconnectMessage",
+           "ClientDisconnectedMessage",
            "ClientIsConnectedRequest",
            "ClientIsConnectedResponse",
            "ClientSendMessage",
            "ClientSentMessage",
+           "ClientSendBatchMessage",
+           "ClientSentBatchMessage",
            "ClientReceiveCountRequest",
            "ClientReceiveCountResponse",
            "ClientGetMessage",
            "ClientGotMessage",
+           "ClientGetAllMessage",
+           "ClientGotAllMessage",
+           "ClientSubscribeMessage",
+           "ClientSubscribedMessage",
+           "ClientReceivedMessage",
+           "ClientAttachMessage",
+           "ClientAttachedMessage",
+           "ClientConfigureMessage",
+           "ClientConfiguredMessage",
+           "ClientWriteStateMessage",
+           "ClientSequenceRequest",
+           "ClientSequenceResponse",
+           "ClientJournalRequest",
+           "ClientJournalResponse",
            "ServerCreateMessage",
            "ServerCreatedMessage",
+           "ServerConfigureMessage",
+           "ServerConfiguredMessage",
            "ServerListenMessage",
            "ServerListenedMessage",
            "ServerUnlistenMessage",
@@ -59,13 +101,184 @@ __all__ = ["ShutdownMessage",
            "ServerDestroyedMessage",
            "SessionSendMessage",
            "SessionSentMessage",
+           "SessionSendBatchMessage",
+           "SessionSentBatchMessage",
            "SessionReceiveCountRequest",
            "SessionReceiveCountResponse",
            "SessionGetMessage",
-           "SessionGotMessage"]
+           "SessionGotMessage",
+           "SessionGetAllMessage",
+           "SessionGotAllMessage",
+           "SessionSubscribeMessage",
+           "SessionSubscribedMessage",
+           "SessionReceivedMessage",
+           "SessionAttachMessage",
+           "SessionAttachedMessage",
+           "SessionConfigureMessage",
+           "SessionConfiguredMessage",
+           "SessionWriteStateMessage",
+           "SessionSequenceRequest",
+           "SessionSequenceResponse",
+           "SessionJournalRequest",
+           "SessionJournalResponse"]
+
+
+class ControlMessage(object):
+    """Base class for control protocol messages."""
+
+    # Correlation identifier.  Set by the proxy on requests, and echoed
+    # by the agent on the matching response.
+    request_id = None
+
+    def encode(self, d: dict):
+        """(Internal) Encode message dictionary as JSON.
+
+        :param d: Dictionary of message fields."""
+        if self.request_id is not None:
+            d["request_id"] = self.request_id
+        return json.dumps(d)
+
+
+# Binary frames carry FIX messages without JSON or BASE64 encoding.  The
+# first byte of a binary frame's payload is always zero, which can't be
+# the start of a JSON payload.
+BINARY_HEADER = struct.Struct(">BBLL")
+
+# Binary frame opcodes.
+OP_CLIENT_SEND = 1
+OP_SESSION_SEND = 2
+OP_CLIENT_GET = 3
+OP_SESSION_GET = 4
+OP_CLIENT_GET_ALL = 5
+OP_SESSION_GET_ALL = 6
+
+# Binary frame opcodes for messages pushed to subscribers.  These have
+# a request identifier of zero.
+OP_CLIENT_RECEIVED = 7
+OP_SESSION_RECEIVED = 8
+
+# Flags set in the opcode of response frames.
+OP_RESPONSE = 0x80
+OP_EMPTY = 0x40
+
+
+class BinaryFrame(object):
+    """Binary control protocol frame.
+
+    Binary frames have a ten byte header, followed by the raw FIX
+    message bytes (if any).  The header is:
+
+    * a zero byte, marking this as a binary frame,
+    * a one byte opcode,
+    * a four byte entity handle, as returned when the client or server
+      session was created, and
+    * a four byte request identifier.
+
+    Successful responses echo the opcode, with the OP_RESPONSE flag set,
+    and the handle and request identifier of their request.  Errors are
+    reported using the JSON response message for the equivalent request."""
+
+    def __init__(self, opcode: int, handle: int, request_id: int,
+                 payload: bytes = b''):
+        self.opcode = opcode
+        self.handle = handle
+        self.request_id = request_id
+        self.payload = payload
+        self.result = True
+        self.message = ''
+        return
+
+    def to_bytes(self):
+        """Encode as bytes."""
+        header = BINARY_HEADER.pack(0, self.opcode, self.handle,
+                                    self.request_id)
+        return header + self.payload
+
+    @staticmethod
+    def is_binary(buffer: bytes):
+        """Return True if payload buffer is a binary frame."""
+        return len(buffer) > 0 and buffer[0] == 0
+
+    @staticmethod
+    def from_bytes(buffer: bytes):
+        """Create from bytes.
+
+        :param buffer: Frame payload (not including length header)."""
+        _, opcode, handle, request_id = BINARY_HEADER.unpack_from(buffer)
+        return BinaryFrame(opcode, handle, request_id,
+                           bytes(buffer[BINARY_HEADER.size:]))
+
+
+def pack_messages(messages: list):
+    """Encode a list of FIX messages as a binary frame payload.
+
+    :param messages: List of byte arrays.
+
+    Each message is preceded by its length, as a four byte big-endian
+    integer."""
+    parts = []
+    for message in messages:
+        parts.append(struct.pack(">L", len(message)))
+        parts.append(message)
+    return b''.join(parts)
+
+
+def unpack_messages(buffer: bytes):
+    """Decode a binary frame payload into a list of FIX messages.
+
+    :param buffer: Payload encoded by pack_messages()."""
+    messages = []
+    view = memoryview(buffer)
+    offset = 0
+    while offset < len(view):
+        length = struct.unpack_from(">L", view, offset)[0]
+        offset += 4
+        messages.append(bytes(view[offset:offset + length]))
+        offset += length
+    return messages
 
 
-class ShutdownMessage:
+class NegotiateMessage(ControlMessage):
+    """Request optional control protocol features."""
+
+    def __init__(self, binary: bool):
+        self.type = "negotiate"
+        self.binary = binary
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "binary": self.binary})
+
+    @staticmethod
+    def from_dict(d):
+        return NegotiateMessage(d.get("binary"))
+
+
+class NegotiatedMessage(ControlMessage):
+    """Confirm optional control protocol features."""
+
+    def __init__(self, result: bool, message: str, binary: bool):
+        self.type = "negotiated"
+        self.result = result
+        self.message = message
+        self.binary = binary
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "result": self.result,
+                            "message": self.message,
+                            "binary": self.binary})
+
+    @staticmethod
+    def from_dict(d):
+        return NegotiatedMessage(d.get("result"),
+                                 d.get("message"),
+                                 d.get("binary"))
+
+
+class ShutdownMessage(ControlMessage):
     """Request agent shutdown."""
 
     def __init__(self):
@@ -75,7 +288,7 @@ class ShutdownMessage:
 
     def to_json(self):
         """Encode as JSON."""
-        return json.dumps({"type": self.type})
+        return self.encode({"type": self.type})
 
     @staticmethod
     def from_dict(d):
@@ -86,7 +299,7 @@ class ShutdownMessage:
         return ShutdownMessage()
 
 
-class ResetMessage:
+class ResetMessage(ControlMessage):
     """Request agent reset."""
 
     def __init__(self):
@@ -96,7 +309,7 @@ class ResetMessage:
 
     def to_json(self):
         """Encode as JSON."""
-        return json.dumps({"type": self.type})
+        return self.encode({"type": self.type})
 
     @staticmethod
     def from_dict(d):
@@ -107,15 +320,41 @@ class ResetMessage:
         return ResetMessage()
 
 
-class ClientCreateMessage:
+class BadRequestMessage(ControlMessage):
+    """Refuse a request that couldn't be decoded."""
+
+    def __init__(self, message: str):
+        """Constructor.
+
+        :param message: Description of the problem."""
+        self.type = "bad_request"
+        self.result = False
+        self.message = message
+        return
+
+    def to_json(self):
+        """Encode as JSON."""
+        return self.encode({"type": self.type,
+                            "result": self.result,
+                            "message": self.message})
+
+    @staticmethod
+    def from_dict(d):
+        """Create from dictionary.
+
+        :param d: Dictionary from which to create message."""
+        return BadRequestMessage(d.get("message"))
+
+
+class ClientCreateMessage(ControlMessage):
     def __init__(self, name: str):
         self.type = "client_create"
         self.name = name
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name})
 
     @staticmethod
     def from_dict(d):
@@ -125,43 +364,47 @@ class ClientCreateMessage:
         return ClientCreateMessage(d.get("name"))
 
 
-class ClientCreatedMessage:
-    def __init__(self, name: str, result: bool, message: str):
+class ClientCreatedMessage(ControlMessage):
+    def __init__(self, name: str, result: bool, message: str,
+                 handle: int = None):
         self.type = "client_created"
         self.name = name
         self.result = result
         self.message = message
+        self.handle = handle
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "handle": self.handle})
 
     @staticmethod
     def from_dict(d):
         return ClientCreatedMessage(d.get("name"),
                                     d.get("result"),
-                                    d.get("message"))
+                                    d.get("message"),
+                                    d.get("handle"))
 
 
-class ClientDestroyMessage:
+class ClientDestroyMessage(ControlMessage):
     def __init__(self, name: str):
         self.type = "client_destroy"
         self.name = name
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name})
 
     @staticmethod
     def from_dict(d):
         return ClientDestroyMessage(d.get("name"))
 
 
-class ClientDestroyedMessage:
+class ClientDestroyedMessage(ControlMessage):
     def __init__(self, name: str, result: bool, message: str):
         self.type = "client_destroyed"
         self.name = name
@@ -170,10 +413,10 @@ class ClientDestroyedMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message})
 
     @staticmethod
     def from_dict(d):
@@ -182,64 +425,108 @@ class ClientDestroyedMessage:
                                       d.get("message"))
 
 
-class ClientConnectMessage:
-    def __init__(self, name: str, host: str, port: int):
+class ClientConnectMessage(ControlMessage):
+    def __init__(self, name: str, host: str, port: int,
+                 timeout: float = None):
         self.type = "client_connect"
         self.name = name
         self.host = host
         self.port = port
+        self.timeout = timeout
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "host": self.host,
-                           "port": self.port})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "host": self.host,
+                            "port": self.port,
+                            "timeout": self.timeout})
 
     @staticmethod
     def from_dict(d):
         return ClientConnectMessage(d.get("name"),
                                     d.get("host"),
-                                    d.get("port"))
+                                    d.get("port"),
+                                    d.get("timeout"))
 
 
-class ClientConnectedMessage:
+class ClientConnectedMessage(ControlMessage):
     def __init__(self, name: str, result: bool, message: str):
-        self.type = "client_created"
+        self.type = "client_connected"
         self.name = name
         self.result = result
         self.message = message
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message})
 
     @staticmethod
     def from_dict(d):
-        return ClientCreatedMessage(d.get("name"),
-                                    d.get("result"),
-                                    d.get("message"))
+        return ClientConnectedMessage(d.get("name"),
+                                      d.get("result"),
+                                      d.get("message"))
+
+
+class ClientDisconnectMessage(ControlMessage):
+    """Request client disconnection from its server."""
 
+    def __init__(self, name: str):
+        self.type = "client_disconnect"
+        self.name = name
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientDisconnectMessage(d.get("name"))
+
+
+class ClientDisconnectedMessage(ControlMessage):
+    """Confirm client disconnection."""
+
+    def __init__(self, name: str, result: bool, message: str):
+        self.type = "client_disconnected"
+        self.name = name
+        self.result = result
+        self.message = message
+        return
 
-class ClientIsConnectedRequest:
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientDisconnectedMessage(d.get("name"),
+                                         d.get("result"),
+                                         d.get("message"))
+
+
+class ClientIsConnectedRequest(ControlMessage):
     def __init__(self, name: str):
         self.type = "client_is_connected_request"
         self.name = name
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name})
 
     @staticmethod
     def from_dict(d):
         return ClientIsConnectedRequest(d.get("name"))
 
 
-class ClientIsConnectedResponse:
+class ClientIsConnectedResponse(ControlMessage):
     def __init__(self, name: str, result: bool, message: str, connected: bool):
         self.type = "client_is_connected_response"
         self.name = name
@@ -249,11 +536,11 @@ class ClientIsConnectedResponse:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message,
-                           "connected": self.connected})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "connected": self.connected})
 
     @staticmethod
     def from_dict(d):
@@ -263,7 +550,7 @@ class ClientIsConnectedResponse:
                                          d.get("connected"))
 
 
-class ClientSendMessage:
+class ClientSendMessage(ControlMessage):
     """Request message be sent from client to server."""
 
     def __init__(self, name: str, payload: str):
@@ -273,9 +560,9 @@ class ClientSendMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "payload": self.payload})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "payload": self.payload})
 
     @staticmethod
     def from_dict(d):
@@ -283,30 +570,84 @@ class ClientSendMessage:
                                  d.get("payload"))
 
 
-class ClientSentMessage:
+class ClientSentMessage(ControlMessage):
     """Acknowledge message was sent from client to server."""
 
-    def __init__(self, name: str, result: bool, message: str):
+    def __init__(self, name: str, result: bool, message: str,
+                 buffered: int = None):
         self.type = "client_sent"
         self.name = name
         self.result = result
         self.message = message
+        self.buffered = buffered
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "buffered": self.buffered})
 
     @staticmethod
     def from_dict(d):
         return ClientSentMessage(d.get("name"),
                                  d.get("result"),
-                                 d.get("message"))
+                                 d.get("message"),
+                                 d.get("buffered"))
+
 
+class ClientSendBatchMessage(ControlMessage):
+    """Request several messages be sent from client to server."""
 
-class ClientReceiveCountRequest:
+    def __init__(self, name: str, payloads: list):
+        self.type = "client_send_batch"
+        self.name = name
+        self.payloads = payloads
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "payloads": self.payloads})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientSendBatchMessage(d.get("name"),
+                                      d.get("payloads"))
+
+
+class ClientSentBatchMessage(ControlMessage):
+    """Acknowledge several messages were sent from client to server."""
+
+    def __init__(self, name: str, result: bool, message: str, count: int,
+                 buffered: int = None):
+        self.type = "client_sent_batch"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.count = count
+        self.buffered = buffered
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "count": self.count,
+                            "buffered": self.buffered})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientSentBatchMessage(d.get("name"),
+                                      d.get("result"),
+                                      d.get("message"),
+                                      d.get("count"),
+                                      d.get("buffered"))
+
+
+class ClientReceiveCountRequest(ControlMessage):
     """Request count of client's received messages."""
 
     def __init__(self, name: str):
@@ -315,15 +656,15 @@ class ClientReceiveCountRequest:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name})
 
     @staticmethod
     def from_dict(d):
         return ClientReceiveCountRequest(d.get("name"))
 
 
-class ClientReceiveCountResponse:
+class ClientReceiveCountResponse(ControlMessage):
     """Return count of client's received messages."""
 
     def __init__(self, name: str, result: bool, message: str, count: int):
@@ -335,11 +676,11 @@ class ClientReceiveCountResponse:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message,
-                           "count": self.count})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "count": self.count})
 
     @staticmethod
     def from_dict(d):
@@ -349,22 +690,25 @@ class ClientReceiveCountResponse:
                                           d.get("count"))
 
 
-class ClientGetMessage:
-    def __init__(self, name: str):
+class ClientGetMessage(ControlMessage):
+    def __init__(self, name: str, timeout: float = None):
         self.type = "client_get"
         self.name = name
+        self.timeout = timeout
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "timeout": self.timeout})
 
     @staticmethod
     def from_dict(d):
-        return ClientGetMessage(d.get("name"))
+        return ClientGetMessage(d.get("name"),
+                                d.get("timeout"))
 
 
-class ClientGotMessage:
+class ClientGotMessage(ControlMessage):
     def __init__(self, name: str, result: bool, message: str,
                  payload):
         self.type = "client_got"
@@ -375,11 +719,11 @@ class ClientGotMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message,
-                           "payload": self.payload})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "payload": self.payload})
 
     @staticmethod
     def from_dict(d):
@@ -389,22 +733,368 @@ class ClientGotMessage:
                                 d.get("payload"))
 
 
-class ServerCreateMessage:
+class ClientGetAllMessage(ControlMessage):
+    """Request all messages received by client."""
+
+    def __init__(self, name: str, max_count: int = None,
+                 max_bytes: int = None):
+        self.type = "client_get_all"
+        self.name = name
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "max_count": self.max_count,
+                            "max_bytes": self.max_bytes})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientGetAllMessage(d.get("name"),
+                                   d.get("max_count"),
+                                   d.get("max_bytes"))
+
+
+class ClientGotAllMessage(ControlMessage):
+    """Deliver messages received by client to controller."""
+
+    def __init__(self, name: str, result: bool, message: str,
+                 payloads: list):
+        self.type = "client_got_all"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.payloads = payloads
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "payloads": self.payloads})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientGotAllMessage(d.get("name"),
+                                   d.get("result"),
+                                   d.get("message"),
+                                   d.get("payloads"))
+
+
+class ClientSubscribeMessage(ControlMessage):
+    """Request (or cancel) delivery of messages as client receives them."""
+
+    def __init__(self, name: str, subscribe: bool):
+        self.type = "client_subscribe"
+        self.name = name
+        self.subscribe = subscribe
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "subscribe": self.subscribe})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientSubscribeMessage(d.get("name"),
+                                      d.get("subscribe"))
+
+
+class ClientSubscribedMessage(ControlMessage):
+    """Confirm change to client's subscription."""
+
+    def __init__(self, name: str, result: bool, message: str,
+                 subscribed: bool):
+        self.type = "client_subscribed"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.subscribed = subscribed
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "subscribed": self.subscribed})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientSubscribedMessage(d.get("name"),
+                                       d.get("result"),
+                                       d.get("message"),
+                                       d.get("subscribed"))
+
+
+class ClientReceivedMessage(ControlMessage):
+    """Deliver message received by client to subscriber."""
+
+    def __init__(self, name: str, payload: str):
+        self.type = "client_received"
+        self.name = name
+        self.payload = payload
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "payload": self.payload})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientReceivedMessage(d.get("name"),
+                                     d.get("payload"))
+
+
+class ClientAttachMessage(ControlMessage):
+    """Attach (or detach) client's shared memory channel."""
+
+    def __init__(self, name: str, path: str, ring_size: int):
+        self.type = "client_attach"
+        self.name = name
+        self.path = path
+        self.ring_size = ring_size
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "path": self.path,
+                            "ring_size": self.ring_size})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientAttachMessage(d.get("name"),
+                                   d.get("path"),
+                                   d.get("ring_size"))
+
+
+class ClientAttachedMessage(ControlMessage):
+    """Confirm change to client's shared memory channel."""
+
+    def __init__(self, name: str, result: bool, message: str,
+                 attached: bool):
+        self.type = "client_attached"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.attached = attached
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "attached": self.attached})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientAttachedMessage(d.get("name"),
+                                     d.get("result"),
+                                     d.get("message"),
+                                     d.get("attached"))
+
+
+class ClientConfigureMessage(ControlMessage):
+    """Change configurable options of client."""
+
+    def __init__(self, name: str, options: dict):
+        self.type = "client_configure"
+        self.name = name
+        self.options = options
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "options": self.options})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientConfigureMessage(d.get("name"),
+                                      d.get("options"))
+
+
+class ClientConfiguredMessage(ControlMessage):
+    """Confirm change to client's options."""
+
+    def __init__(self, name: str, result: bool, message: str):
+        self.type = "client_configured"
+        self.name = name
+        self.result = result
+        self.message = message
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientConfiguredMessage(d.get("name"),
+                                       d.get("result"),
+                                       d.get("message"))
+
+
+class ClientWriteStateMessage(ControlMessage):
+    """Report client's outbound buffer crossing a watermark."""
+
+    def __init__(self, name: str, paused: bool, buffered: int):
+        self.type = "client_write_state"
+        self.name = name
+        self.paused = paused
+        self.buffered = buffered
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "paused": self.paused,
+                            "buffered": self.buffered})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientWriteStateMessage(d.get("name"),
+                                       d.get("paused"),
+                                       d.get("buffered"))
+
+
+class ClientSequenceRequest(ControlMessage):
+    """Request client's sequence numbers."""
+
+    def __init__(self, name: str):
+        self.type = "client_sequence_request"
+        self.name = name
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientSequenceRequest(d.get("name"))
+
+
+class ClientSequenceResponse(ControlMessage):
+    """Return client's sequence numbers, and any inbound gaps."""
+
+    def __init__(self, name: str, result: bool, message: str,
+                 next_send_sequence: int = None,
+                 next_receive_sequence: int = None, gaps: list = None):
+        self.type = "client_sequence_response"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.next_send_sequence = next_send_sequence
+        self.next_receive_sequence = next_receive_sequence
+        self.gaps = gaps or []
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "next_send_sequence": self.next_send_sequence,
+                            "next_receive_sequence":
+                                self.next_receive_sequence,
+                            "gaps": self.gaps})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientSequenceResponse(d.get("name"),
+                                      d.get("result"),
+                                      d.get("message"),
+                                      d.get("next_send_sequence"),
+                                      d.get("next_receive_sequence"),
+                                      d.get("gaps"))
+
+
+class ClientJournalRequest(ControlMessage):
+    """Request a range of messages from client's journal."""
+
+    def __init__(self, name: str, begin: int, end: int = 0,
+                 direction: str = "sent", max_count: int = None):
+        self.type = "client_journal_request"
+        self.name = name
+        self.begin = begin
+        self.end = end
+        self.direction = direction
+        self.max_count = max_count
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "begin": self.begin,
+                            "end": self.end,
+                            "direction": self.direction,
+                            "max_count": self.max_count})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientJournalRequest(d.get("name"),
+                                    d.get("begin"),
+                                    d.get("end", 0),
+                                    d.get("direction", "sent"),
+                                    d.get("max_count"))
+
+
+class ClientJournalResponse(ControlMessage):
+    """Return messages from client's journal, base64 encoded."""
+
+    def __init__(self, name: str, result: bool, message: str,
+                 path: str = None, payloads: list = None):
+        self.type = "client_journal_response"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.path = path
+        self.payloads = payloads or []
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "path": self.path,
+                            "payloads": self.payloads})
+
+    @staticmethod
+    def from_dict(d):
+        return ClientJournalResponse(d.get("name"),
+                                     d.get("result"),
+                                     d.get("message"),
+                                     d.get("path"),
+                                     d.get("payloads"))
+
+
+class ServerCreateMessage(ControlMessage):
     def __init__(self, name: str):
         self.type = "server_create"
         self.name = name
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name})
 
     @staticmethod
     def from_dict(d):
         return ServerCreateMessage(d.get("name"))
 
 
-class ServerCreatedMessage:
+class ServerCreatedMessage(ControlMessage):
     def __init__(self, name: str, result: bool, message: str):
         self.type = "server_created"
         self.name = name
@@ -413,10 +1103,10 @@ class ServerCreatedMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message})
 
     @staticmethod
     def from_dict(d):
@@ -425,25 +1115,75 @@ class ServerCreatedMessage:
                                     d.get("message"))
 
 
-class ServerListenMessage:
-    def __init__(self, name: str, port: int):
+class ServerConfigureMessage(ControlMessage):
+    """Change configurable options of server's future sessions."""
+
+    def __init__(self, name: str, options: dict):
+        self.type = "server_configure"
+        self.name = name
+        self.options = options
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "options": self.options})
+
+    @staticmethod
+    def from_dict(d):
+        return ServerConfigureMessage(d.get("name"),
+                                      d.get("options"))
+
+
+class ServerConfiguredMessage(ControlMessage):
+    """Confirm change to server's session options."""
+
+    def __init__(self, name: str, result: bool, message: str):
+        self.type = "server_configured"
+        self.name = name
+        self.result = result
+        self.message = message
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message})
+
+    @staticmethod
+    def from_dict(d):
+        return ServerConfiguredMessage(d.get("name"),
+                                       d.get("result"),
+                                       d.get("message"))
+
+
+class ServerListenMessage(ControlMessage):
+    def __init__(self, name: str, port: int, backlog: int = None,
+                 workers: int = None):
         self.type = "server_listen"
         self.name = name
         self.port = port
+        self.backlog = backlog
+        self.workers = workers
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "port": self.port})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "port": self.port,
+                            "backlog": self.backlog,
+                            "workers": self.workers})
 
     @staticmethod
     def from_dict(d):
         return ServerListenMessage(d.get("name"),
-                                   d.get("port"))
+                                   d.get("port"),
+                                   d.get("backlog"),
+                                   d.get("workers"))
 
 
-class ServerListenedMessage:
+class ServerListenedMessage(ControlMessage):
     def __init__(self, name: str, result: bool, message: str, port: int):
         self.type = "server_listened"
         self.name = name
@@ -453,11 +1193,11 @@ class ServerListenedMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message,
-                           "port": self.port})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "port": self.port})
 
     @staticmethod
     def from_dict(d):
@@ -467,7 +1207,7 @@ class ServerListenedMessage:
                                      d.get("port"))
 
 
-class ServerUnlistenMessage:
+class ServerUnlistenMessage(ControlMessage):
     def __init__(self, name: str, port: int):
         self.type = "server_unlisten"
         self.name = name
@@ -475,9 +1215,9 @@ class ServerUnlistenMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "port": self.port})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "port": self.port})
 
     @staticmethod
     def from_dict(d):
@@ -485,7 +1225,7 @@ class ServerUnlistenMessage:
                                      d.get("port"))
 
 
-class ServerUnlistenedMessage:
+class ServerUnlistenedMessage(ControlMessage):
     def __init__(self, name: str, result: bool, message: str):
         self.type = "server_unlistened"
         self.name = name
@@ -494,10 +1234,10 @@ class ServerUnlistenedMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message})
 
     @staticmethod
     def from_dict(d):
@@ -506,22 +1246,25 @@ class ServerUnlistenedMessage:
                                        d.get("message"))
 
 
-class ServerPendingAcceptCountRequest:
-    def __init__(self, name: str):
+class ServerPendingAcceptCountRequest(ControlMessage):
+    def __init__(self, name: str, timeout: float = None):
         self.type = "server_pending_accept_request"
         self.name = name
+        self.timeout = timeout
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "timeout": self.timeout})
 
     @staticmethod
     def from_dict(d):
-        return ServerPendingAcceptCountRequest(d.get("name"))
+        return ServerPendingAcceptCountRequest(d.get("name"),
+                                               d.get("timeout"))
 
 
-class ServerPendingAcceptCountResponse:
+class ServerPendingAcceptCountResponse(ControlMessage):
     def __init__(self, name: str, result: bool, message: str, count: int):
         self.type = "server_pending_accept_response"
         self.name = name
@@ -531,11 +1274,11 @@ class ServerPendingAcceptCountResponse:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message,
-                           "count": self.count})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "count": self.count})
 
     @staticmethod
     def from_dict(d):
@@ -545,7 +1288,7 @@ class ServerPendingAcceptCountResponse:
                                                 d.get("count"))
 
 
-class ServerAcceptMessage:
+class ServerAcceptMessage(ControlMessage):
     def __init__(self, name: str, session_name: str):
         self.type = "server_accept"
         self.name = name
@@ -553,9 +1296,9 @@ class ServerAcceptMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "session_name": self.session_name})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "session_name": self.session_name})
 
     @staticmethod
     def from_dict(d):
@@ -563,47 +1306,50 @@ class ServerAcceptMessage:
                                    d.get("session_name"))
 
 
-class ServerAcceptedMessage:
+class ServerAcceptedMessage(ControlMessage):
     def __init__(self, name: str, result: bool, message: str,
-                 session_name: str):
+                 session_name: str, handle: int = None):
         self.type = "server_accepted"
         self.name = name
         self.result = result
         self.message = message
         self.session_name = session_name
+        self.handle = handle
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message,
-                           "session_name": self.session_name})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "session_name": self.session_name,
+                            "handle": self.handle})
 
     @staticmethod
     def from_dict(d):
         return ServerAcceptedMessage(d.get("name"),
                                      d.get("result"),
                                      d.get("message"),
-                                     d.get("session_name"))
+                                     d.get("session_name"),
+                                     d.get("handle"))
 
 
-class ServerIsConnectedRequest:
+class ServerIsConnectedRequest(ControlMessage):
     def __init__(self, name: str):
         self.type = "server_is_connected_request"
         self.name = name
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name})
 
     @staticmethod
     def from_dict(d):
         return ServerIsConnectedRequest(d.get("name"))
 
 
-class ServerIsConnectedResponse:
+class ServerIsConnectedResponse(ControlMessage):
     def __init__(self, name: str, result: bool, message: str, connected: bool):
         self.type = "server_is_connected_response"
         self.name = name
@@ -613,11 +1359,11 @@ class ServerIsConnectedResponse:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message,
-                           "connected": self.connected})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "connected": self.connected})
 
     @staticmethod
     def from_dict(d):
@@ -627,22 +1373,22 @@ class ServerIsConnectedResponse:
                                          d.get("connected"))
 
 
-class ServerDisconnectMessage:
+class ServerDisconnectMessage(ControlMessage):
     def __init__(self, name: str):
         self.type = "server_disconnect"
         self.name = name
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name})
 
     @staticmethod
     def from_dict(d):
         return ServerDisconnectMessage(d.get("name"))
 
 
-class ServerDisconnectedMessage:
+class ServerDisconnectedMessage(ControlMessage):
     def __init__(self, name: str, result: bool, message: str):
         self.type = "server_disconnected"
         self.name = name
@@ -651,10 +1397,10 @@ class ServerDisconnectedMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message})
 
     @staticmethod
     def from_dict(d):
@@ -663,22 +1409,22 @@ class ServerDisconnectedMessage:
                                          d.get("message"))
 
 
-class ServerDestroyMessage:
+class ServerDestroyMessage(ControlMessage):
     def __init__(self, name: str):
         self.type = "server_destroy"
         self.name = name
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name})
 
     @staticmethod
     def from_dict(d):
         return ServerDestroyMessage(d.get("name"))
 
 
-class ServerDestroyedMessage:
+class ServerDestroyedMessage(ControlMessage):
     def __init__(self, name: str, result: bool, message: str):
         self.type = "server_destroyed"
         self.name = name
@@ -687,10 +1433,10 @@ class ServerDestroyedMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message})
 
     @staticmethod
     def from_dict(d):
@@ -699,7 +1445,7 @@ class ServerDestroyedMessage:
                                       d.get("message"))
 
 
-class SessionSendMessage:
+class SessionSendMessage(ControlMessage):
     """Request message be sent from server to client."""
     def __init__(self, name: str, payload: str):
         self.type = "session_send"
@@ -708,9 +1454,9 @@ class SessionSendMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "payload": self.payload})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "payload": self.payload})
 
     @staticmethod
     def from_dict(d):
@@ -718,29 +1464,83 @@ class SessionSendMessage:
                                   d.get("payload"))
 
 
-class SessionSentMessage:
+class SessionSentMessage(ControlMessage):
     """Acknowledge message was sent from server to client."""
-    def __init__(self, name: str, result: bool, message: str):
+    def __init__(self, name: str, result: bool, message: str,
+                 buffered: int = None):
         self.type = "session_sent"
         self.name = name
         self.result = result
         self.message = message
+        self.buffered = buffered
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "buffered": self.buffered})
 
     @staticmethod
     def from_dict(d):
         return SessionSentMessage(d.get("name"),
                                   d.get("result"),
-                                  d.get("message"))
+                                  d.get("message"),
+                                  d.get("buffered"))
+
+
+class SessionSendBatchMessage(ControlMessage):
+    """Request several messages be sent from server to client."""
+
+    def __init__(self, name: str, payloads: list):
+        self.type = "session_send_batch"
+        self.name = name
+        self.payloads = payloads
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "payloads": self.payloads})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionSendBatchMessage(d.get("name"),
+                                       d.get("payloads"))
+
+
+class SessionSentBatchMessage(ControlMessage):
+    """Acknowledge several messages were sent from server to client."""
+
+    def __init__(self, name: str, result: bool, message: str, count: int,
+                 buffered: int = None):
+        self.type = "session_sent_batch"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.count = count
+        self.buffered = buffered
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "count": self.count,
+                            "buffered": self.buffered})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionSentBatchMessage(d.get("name"),
+                                       d.get("result"),
+                                       d.get("message"),
+                                       d.get("count"),
+                                       d.get("buffered"))
 
 
-class SessionReceiveCountRequest:
+class SessionReceiveCountRequest(ControlMessage):
     """Request count of server's received messages."""
 
     def __init__(self, name: str):
@@ -749,15 +1549,15 @@ class SessionReceiveCountRequest:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name})
 
     @staticmethod
     def from_dict(d):
         return SessionReceiveCountRequest(d.get("name"))
 
 
-class SessionReceiveCountResponse:
+class SessionReceiveCountResponse(ControlMessage):
     """Return count of server's received messages."""
 
     def __init__(self, name: str, result: bool, message: str, count: int):
@@ -769,11 +1569,11 @@ class SessionReceiveCountResponse:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message,
-                           "count": self.count})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "count": self.count})
 
     @staticmethod
     def from_dict(d):
@@ -783,24 +1583,27 @@ class SessionReceiveCountResponse:
                                            d.get("count"))
 
 
-class SessionGetMessage:
+class SessionGetMessage(ControlMessage):
     """Request message received by server."""
 
-    def __init__(self, name: str):
+    def __init__(self, name: str, timeout: float = None):
         self.type = "session_get"
         self.name = name
+        self.timeout = timeout
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "timeout": self.timeout})
 
     @staticmethod
     def from_dict(d):
-        return SessionGetMessage(d.get("name"))
+        return SessionGetMessage(d.get("name"),
+                                 d.get("timeout"))
 
 
-class SessionGotMessage:
+class SessionGotMessage(ControlMessage):
     """Deliver message received by server to controller."""
 
     def __init__(self, name: str, result: bool, message: str, payload: bytes):
@@ -812,11 +1615,11 @@ class SessionGotMessage:
         return
 
     def to_json(self):
-        return json.dumps({"type": self.type,
-                           "name": self.name,
-                           "result": self.result,
-                           "message": self.message,
-                           "payload": self.payload})
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "payload": self.payload})
 
     @staticmethod
     def from_dict(d):
@@ -824,3 +1627,349 @@ class SessionGotMessage:
                                  d.get("result"),
                                  d.get("message"),
                                  d.get("payload"))
+
+
+class SessionGetAllMessage(ControlMessage):
+    """Request all messages received by server."""
+
+    def __init__(self, name: str, max_count: int = None,
+                 max_bytes: int = None):
+        self.type = "session_get_all"
+        self.name = name
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "max_count": self.max_count,
+                            "max_bytes": self.max_bytes})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionGetAllMessage(d.get("name"),
+                                    d.get("max_count"),
+                                    d.get("max_bytes"))
+
+
+class SessionGotAllMessage(ControlMessage):
+    """Deliver messages received by server to controller."""
+
+    def __init__(self, name: str, result: bool, message: str,
+                 payloads: list):
+        self.type = "session_got_all"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.payloads = payloads
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "payloads": self.payloads})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionGotAllMessage(d.get("name"),
+                                    d.get("result"),
+                                    d.get("message"),
+                                    d.get("payloads"))
+
+
+class SessionSubscribeMessage(ControlMessage):
+    """Request (or cancel) delivery of messages as session receives them."""
+
+    def __init__(self, name: str, subscribe: bool):
+        self.type = "session_subscribe"
+        self.name = name
+        self.subscribe = subscribe
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "subscribe": self.subscribe})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionSubscribeMessage(d.get("name"),
+                                       d.get("subscribe"))
+
+
+class SessionSubscribedMessage(ControlMessage):
+    """Confirm change to session's subscription."""
+
+    def __init__(self, name: str, result: bool, message: str,
+                 subscribed: bool):
+        self.type = "session_subscribed"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.subscribed = subscribed
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "subscribed": self.subscribed})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionSubscribedMessage(d.get("name"),
+                                        d.get("result"),
+                                        d.get("message"),
+                                        d.get("subscribed"))
+
+
+class SessionReceivedMessage(ControlMessage):
+    """Deliver message received by session to subscriber."""
+
+    def __init__(self, name: str, payload: str):
+        self.type = "session_received"
+        self.name = name
+        self.payload = payload
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "payload": self.payload})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionReceivedMessage(d.get("name"),
+                                      d.get("payload"))
+
+
+class SessionAttachMessage(ControlMessage):
+    """Attach (or detach) server session's shared memory channel."""
+
+    def __init__(self, name: str, path: str, ring_size: int):
+        self.type = "session_attach"
+        self.name = name
+        self.path = path
+        self.ring_size = ring_size
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "path": self.path,
+                            "ring_size": self.ring_size})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionAttachMessage(d.get("name"),
+                                    d.get("path"),
+                                    d.get("ring_size"))
+
+
+class SessionAttachedMessage(ControlMessage):
+    """Confirm change to server session's shared memory channel."""
+
+    def __init__(self, name: str, result: bool, message: str,
+                 attached: bool):
+        self.type = "session_attached"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.attached = attached
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "attached": self.attached})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionAttachedMessage(d.get("name"),
+                                      d.get("result"),
+                                      d.get("message"),
+                                      d.get("attached"))
+
+
+class SessionConfigureMessage(ControlMessage):
+    """Change configurable options of server session."""
+
+    def __init__(self, name: str, options: dict):
+        self.type = "session_configure"
+        self.name = name
+        self.options = options
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "options": self.options})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionConfigureMessage(d.get("name"),
+                                       d.get("options"))
+
+
+class SessionConfiguredMessage(ControlMessage):
+    """Confirm change to server session's options."""
+
+    def __init__(self, name: str, result: bool, message: str):
+        self.type = "session_configured"
+        self.name = name
+        self.result = result
+        self.message = message
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionConfiguredMessage(d.get("name"),
+                                        d.get("result"),
+                                        d.get("message"))
+
+
+class SessionWriteStateMessage(ControlMessage):
+    """Report server session's outbound buffer crossing a watermark."""
+
+    def __init__(self, name: str, paused: bool, buffered: int):
+        self.type = "session_write_state"
+        self.name = name
+        self.paused = paused
+        self.buffered = buffered
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "paused": self.paused,
+                            "buffered": self.buffered})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionWriteStateMessage(d.get("name"),
+                                        d.get("paused"),
+                                        d.get("buffered"))
+
+
+class SessionSequenceRequest(ControlMessage):
+    """Request server session's sequence numbers."""
+
+    def __init__(self, name: str):
+        self.type = "session_sequence_request"
+        self.name = name
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionSequenceRequest(d.get("name"))
+
+
+class SessionSequenceResponse(ControlMessage):
+    """Return server session's sequence numbers, and any inbound gaps."""
+
+    def __init__(self, name: str, result: bool, message: str,
+                 next_send_sequence: int = None,
+                 next_receive_sequence: int = None, gaps: list = None):
+        self.type = "session_sequence_response"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.next_send_sequence = next_send_sequence
+        self.next_receive_sequence = next_receive_sequence
+        self.gaps = gaps or []
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "next_send_sequence": self.next_send_sequence,
+                            "next_receive_sequence":
+                                self.next_receive_sequence,
+                            "gaps": self.gaps})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionSequenceResponse(d.get("name"),
+                                       d.get("result"),
+                                       d.get("message"),
+                                       d.get("next_send_sequence"),
+                                       d.get("next_receive_sequence"),
+                                       d.get("gaps"))
+
+
+class SessionJournalRequest(ControlMessage):
+    """Request a range of messages from session's journal."""
+
+    def __init__(self, name: str, begin: int, end: int = 0,
+                 direction: str = "sent", max_count: int = None):
+        self.type = "session_journal_request"
+        self.name = name
+        self.begin = begin
+        self.end = end
+        self.direction = direction
+        self.max_count = max_count
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "begin": self.begin,
+                            "end": self.end,
+                            "direction": self.direction,
+                            "max_count": self.max_count})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionJournalRequest(d.get("name"),
+                                     d.get("begin"),
+                                     d.get("end", 0),
+                                     d.get("direction", "sent"),
+                                     d.get("max_count"))
+
+
+class SessionJournalResponse(ControlMessage):
+    """Return messages from session's journal, base64 encoded."""
+
+    def __init__(self, name: str, result: bool, message: str,
+                 path: str = None, payloads: list = None):
+        self.type = "session_journal_response"
+        self.name = name
+        self.result = result
+        self.message = message
+        self.path = path
+        self.payloads = payloads or []
+        return
+
+    def to_json(self):
+        return self.encode({"type": self.type,
+                            "name": self.name,
+                            "result": self.result,
+                            "message": self.message,
+                            "path": self.path,
+                            "payloads": self.payloads})
+
+    @staticmethod
+    def from_dict(d):
+        return SessionJournalResponse(d.get("name"),
+                                      d.get("result"),
+                                      d.get("message"),
+                                      d.get("path"),
+                                      d.get("payloads"))
@@ -26,12 +26,254 @@
 """Python API to fixtool simulator agent."""
 
 import base64
+import collections
 import json
 import logging
+import select
 import socket
 import struct
+import time
 
+from fixtool.framing import sequence_number
 from fixtool.message import *
+from fixtool.shmring import DEFAULT_RING_SIZE, SharedChannel, temporary_path
+
+
+def decode_response(d: dict):
+    """(Internal) Create response message from dictionary.
+
+    :param d: Dictionary decoded from JSON payload.
+    :returns: Message instance, or None if the type is unknown."""
+    message = None
+    message_type = d.get("type")
+    if message_type == "negotiated":
+        message = NegotiatedMessage.from_dict(d)
+
+    elif message_type == "bad_request":
+        message = BadRequestMessage.from_dict(d)
+
+    elif message_type == "client_created":
+        message = ClientCreatedMessage.from_dict(d)
+
+    elif message_type == "client_destroyed":
+        message = ClientDestroyedMessage.from_dict(d)
+
+    elif message_type == "client_connected":
+        message = ClientConnectedMessage.from_dict(d)
+
+    elif message_type == "client_disconnected":
+        message = ClientDisconnectedMessage.from_dict(d)
+
+    elif message_type == "client_is_connected_response":
+        message = ClientIsConnectedResponse.from_dict(d)
+
+    elif message_type == "client_sent":
+        message = ClientSentMessage.from_dict(d)
+
+    elif message_type == "client_sent_batch":
+        message = ClientSentBatchMessage.from_dict(d)
+
+    elif message_type == "client_receive_count_response":
+        message = ClientReceiveCountResponse.from_dict(d)
+
+    elif message_type == "client_got":
+        message = ClientGotMessage.from_dict(d)
+
+    elif message_type == "client_got_all":
+        message = ClientGotAllMessage.from_dict(d)
+
+    elif message_type == "client_subscribed":
+        message = ClientSubscribedMessage.from_dict(d)
+
+    elif message_type == "client_received":
+        message = ClientReceivedMessage.from_dict(d)
+
+    elif message_type == "client_attached":
+        message = ClientAttachedMessage.from_dict(d)
+
+    elif message_type == "client_configured":
+        message = ClientConfiguredMessage.from_dict(d)
+
+    elif message_type == "client_write_state":
+        message = ClientWriteStateMessage.from_dict(d)
+
+    elif message_type == "client_sequence_response":
+        message = ClientSequenceResponse.from_dict(d)
+
+    elif message_type == "client_journal_response":
+        message = ClientJournalResponse.from_dict(d)
+
+    elif message_type == "server_created":
+        message = ServerCreatedMessage.from_dict(d)
+
+    elif message_type == "server_destroyed":
+        message = ServerDestroyedMessage.from_dict(d)
+
+    elif message_type == "server_configured":
+        message = ServerConfiguredMessage.from_dict(d)
+
+    elif message_type == "server_listened":
+        message = ServerListenedMessage.from_dict(d)
+
+    elif message_type == "server_unlistened":
+        message = ServerUnlistenedMessage.from_dict(d)
+
+    elif message_type == "server_pending_accept_response":
+        message = ServerPendingAcceptCountResponse.from_dict(d)
+
+    elif message_type == "server_accepted":
+        message = ServerAcceptedMessage.from_dict(d)
+
+    elif message_type == "server_is_connected_response":
+        message = ServerIsConnectedResponse.from_dict(d)
+
+    elif message_type == "server_disconnected":
+        message = ServerDisconnectedMessage.from_dict(d)
+
+    elif message_type == "session_receive_count_response":
+        message = SessionReceiveCountResponse.from_dict(d)
+
+    elif message_type == "session_sent":
+        message = SessionSentMessage.from_dict(d)
+
+    elif message_type == "session_sent_batch":
+        message = SessionSentBatchMessage.from_dict(d)
+
+    elif message_type == "session_got":
+        message = SessionGotMessage.from_dict(d)
+
+    elif message_type == "session_got_all":
+        message = SessionGotAllMessage.from_dict(d)
+
+    elif message_type == "session_subscribed":
+        message = SessionSubscribedMessage.from_dict(d)
+
+    elif message_type == "session_received":
+        message = SessionReceivedMessage.from_dict(d)
+
+    elif message_type == "session_attached":
+        message = SessionAttachedMessage.from_dict(d)
+
+    elif message_type == "session_configured":
+        message = SessionConfiguredMessage.from_dict(d)
+
+    elif message_type == "session_write_state":
+        message = SessionWriteStateMessage.from_dict(d)
+
+    elif message_type == "session_sequence_response":
+        message = SessionSequenceResponse.from_dict(d)
+
+    elif message_type == "session_journal_response":
+        message = SessionJournalResponse.from_dict(d)
+
+    else:
+        logging.critical("Unknown message type: %s" % message_type)
+        return None
+
+    message.request_id = d.get("request_id")
+    return message
+
+
+class Subscription(object):
+    """Stream of FIX messages received by a client or server session.
+
+    Messages are pushed from the agent as they're received.  They are
+    passed to the callback, if one was supplied, or otherwise appended
+    to the queue.  Iterating over the subscription returns the queued
+    messages, waiting for more to arrive as needed."""
+
+    def __init__(self, proxy, owner, callback=None):
+        """(Internal) Constructor."""
+        self._proxy = proxy
+        self._owner = owner
+        self._callback = callback
+        self._closed = False
+        self.queue = collections.deque()
+        return
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.queue:
+            if self._closed or not self._proxy.read_response():
+                raise StopIteration
+        return self.queue.popleft()
+
+    def get(self, timeout: float = None):
+        """Return the next received message.
+
+        :param timeout: Maximum time to wait, in seconds, or None to
+        wait indefinitely.
+        :returns: Message, or None if none arrived in time."""
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.queue:
+            if self._closed:
+                return None
+
+            if deadline is None:
+                if not self._proxy.read_response():
+                    return None
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._proxy.poll(remaining):
+                    return None
+        return self.queue.popleft()
+
+    def close(self):
+        """Cancel this subscription.
+
+        Messages received after this are queued in the agent again."""
+        if not self._closed:
+            self._owner.unsubscribe()
+        return
+
+    def deliver(self, message: bytes):
+        """(Internal) Handle a message pushed from the agent."""
+        if self._callback is not None:
+            self._callback(message)
+        else:
+            self.queue.append(message)
+        return
+
+    def set_closed(self):
+        """(Internal) Mark this subscription as closed."""
+        self._closed = True
+        return
+
+
+class WriteWatch(object):
+    """Outbound buffer state of a client or server session.
+
+    The agent reports when its buffer of data waiting to be sent to the
+    FIX peer rises to the high watermark ('paused'), and when it drains
+    back to the low watermark.  Senders should hold off while paused."""
+
+    def __init__(self, proxy, callback=None):
+        """(Internal) Constructor."""
+        self._proxy = proxy
+        self._callback = callback
+        self.paused = False
+        self.buffered = 0
+        return
+
+    def is_paused(self) -> bool:
+        """Return True if the agent's outbound buffer is over its high
+        watermark, after processing any reports from the agent."""
+        if self._proxy is not None:
+            while self._proxy.poll(0):
+                pass
+        return self.paused
+
+    def deliver(self, message):
+        """(Internal) Handle a report pushed from the agent.
+
+        :param message: Write state message."""
+        self.paused = message.paused
+        self.buffered = message.buffered
+        if self._callback is not None:
+            self._callback(message.paused, message.buffered)
+        return
 
 
 class Client(object):
@@ -44,12 +286,17 @@ class Client(object):
         self._host = None
         self._port = None
         self._destroyed = False
+        self._subscription = None
+        self._subscription_key = None
+        self._channel = None
 
         msg = ClientCreateMessage(self._name)
-        self._proxy.send_request(msg)
-        response = self._proxy.await_response()
+        request_id = self._proxy.send_request(msg)
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
+
+        self._handle = response.handle
         return
 
     def destroy(self):
@@ -57,40 +304,49 @@ class Client(object):
         assert not self._destroyed
 
         request = ClientDestroyMessage(self._name)
-        self._proxy.send_request(request)
+        request_id = self._proxy.send_request(request)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
 
         self._proxy.remove_client(self._name)
+        self.close_channel()
         self._destroyed = True
         return
 
-    def connect(self, host: str, port: int):
+    def connect(self, host: str, port: int, timeout: float = None):
         """Connect the client to the specified host and port.
 
         :param host: String host name or IP address.
-        :param port: Integer TCP port number."""
+        :param port: Integer TCP port number.
+        :param timeout: Maximum time for the agent to wait for the
+        connection to complete, in seconds, or None to wait indefinitely."""
 
         assert not self._destroyed
 
         self._host = host
         self._port = port
 
-        msg = ClientConnectMessage(self._name, self._host, self._port)
-        self._proxy.send_request(msg)
+        msg = ClientConnectMessage(self._name, self._host, self._port,
+                                   timeout)
+        request_id = self._proxy.send_request(msg)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
         return
 
     def disconnect(self):
-        """Disconnect the client for its server peer."""
+        """Disconnect the client from its server peer."""
         assert not self._destroyed
 
-        self._proxy.send_request({"message": "client_disconnect"})
+        request = ClientDisconnectMessage(self._name)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
         return
 
     def is_connected(self):
@@ -98,56 +354,391 @@ class Client(object):
         assert not self._destroyed
 
         request = ClientIsConnectedRequest(self._name)
-        self._proxy.send_request(request)
+        request_id = self._proxy.send_request(request)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
 
         return response.connected
 
-    def send(self, message: bytes):
+    def send(self, message: bytes, wait: bool = True):
         """Send a FIX message to the connected server peer.
 
-        :param message: Byte array containing formatted FIX message to send."""
+        :param message: Byte array containing formatted FIX message to send.
+        :param wait: If False, don't wait for the agent's response; any
+        error is instead reported by the proxy's sync() method."""
         assert not self._destroyed
 
-        payload = base64.b64encode(message).decode("ascii")
-        request = ClientSendMessage(self._name, payload)
-        self._proxy.send_request(request)
+        if self._channel is not None:
+            self._channel.send([message], alive=self._proxy.is_alive)
+            return
+
+        if self._proxy.is_binary() and self._handle is not None:
+            request_id = self._proxy.send_frame(OP_CLIENT_SEND, self._handle,
+                                                message)
+        else:
+            payload = base64.b64encode(message).decode("ascii")
+            request = ClientSendMessage(self._name, payload)
+            request_id = self._proxy.send_request(request)
+        if not wait:
+            self._proxy.defer_response(request_id)
+            return
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+        return
+
+    def send_batch(self, messages: list, wait: bool = True):
+        """Send several FIX messages to the connected server peer.
 
-        response = self._proxy.await_response()
+        :param messages: List of byte arrays containing formatted FIX
+        messages to send, in order.
+        :param wait: If False, don't wait for the agent's response; any
+        error is instead reported by the proxy's sync() method.
+
+        The messages are sent to the agent in a single request."""
+        assert not self._destroyed
+
+        if self._channel is not None:
+            self._channel.send(messages, alive=self._proxy.is_alive)
+            return
+
+        if self._proxy.is_binary() and self._handle is not None:
+            # Binary frames carry raw bytes, so the batch is just the
+            # concatenated messages.
+            request_id = self._proxy.send_frame(OP_CLIENT_SEND, self._handle,
+                                                b''.join(messages))
+        else:
+            payloads = [base64.b64encode(m).decode("ascii")
+                        for m in messages]
+            request = ClientSendBatchMessage(self._name, payloads)
+            request_id = self._proxy.send_request(request)
+        if not wait:
+            self._proxy.defer_response(request_id)
+            return
+
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
         return
 
+    def subscribe(self, callback=None):
+        """Have received FIX messages pushed from the agent as they arrive.
+
+        :param callback: Optional function, called with each message.
+        :returns: Subscription, which can be iterated over to collect
+        messages if no callback was given.
+
+        While subscribed, received messages are no longer queued in
+        the agent, and any already queued are pushed immediately."""
+        assert not self._destroyed
+        assert self._subscription is None
+
+        if self._proxy.is_binary() and self._handle is not None:
+            key = (OP_CLIENT_RECEIVED, self._handle)
+        else:
+            key = ("client_received", self._name)
+
+        subscription = Subscription(self._proxy, self, callback)
+        self._proxy.add_subscription(key, subscription)
+
+        request = ClientSubscribeMessage(self._name, True)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            self._proxy.remove_subscription(key)
+            raise RuntimeError(response.message)
+
+        self._subscription = subscription
+        self._subscription_key = key
+        return subscription
+
+    def unsubscribe(self):
+        """Cancel the subscription to received messages."""
+        assert self._subscription is not None
+
+        request = ClientSubscribeMessage(self._name, False)
+        request_id = self._proxy.send_request(request)
+
+        # Messages pushed before the agent processed the request are
+        # still delivered to the subscription.
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+
+        self._proxy.remove_subscription(self._subscription_key)
+        self._subscription.set_closed()
+        self._subscription = None
+        return
+
+    def attach_shared_memory(self, ring_size: int = DEFAULT_RING_SIZE):
+        """Send and receive FIX messages using shared memory.
+
+        :param ring_size: Size of each direction's ring buffer, in bytes.
+
+        This is only possible when the agent is on the same host.  Once
+        attached, messages are passed through ring buffers shared with
+        the agent, rather than through the control session, and
+        received messages are no longer queued in the agent."""
+        assert not self._destroyed
+        assert self._channel is None
+
+        channel = SharedChannel.create(temporary_path(), ring_size)
+        request = ClientAttachMessage(self._name, channel.path(), ring_size)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            channel.close()
+            channel.unlink()
+            raise RuntimeError(response.message)
+
+        channel.connect_doorbell()
+        self._channel = channel
+        return
+
+    def detach_shared_memory(self):
+        """Stop using shared memory to send and receive FIX messages.
+
+        Any received messages not yet collected from the channel are
+        discarded."""
+        assert self._channel is not None
+
+        request = ClientAttachMessage(self._name, None, None)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+
+        self.close_channel()
+        return
+
+    def close_channel(self):
+        """(Internal) Release the local end of the shared memory channel."""
+        if self._channel is not None:
+            self._channel.close()
+            self._channel.unlink()
+            self._channel = None
+        return
+
+    def configure(self, **options):
+        """Change the client's configurable options, in the agent.
+
+        :param options: Option values, by name.  Options not given are
+        left unchanged.
+
+        - queue_capacity: maximum number of received messages the agent
+          holds in memory, or None for no limit.
+        - queue_policy: what happens to received messages when the
+          queue is full; one of "block" (stop reading from the socket),
+          "drop_oldest", "drop_newest", or "spill" (to a file).
+        - write_high_watermark: size, in bytes, at which the outbound
+          buffer is reported as paused.
+        - write_low_watermark: size, in bytes, at which the outbound
+          buffer is reported as resumed.
+        - raw: if True, the agent never reads received messages' fields.
+        - heartbeat_interval: HeartBtInt, in seconds, for automatic
+          Heartbeats and TestRequests, or zero (the default) for none.
+          Implies auto_sequence.
+        - auto_heartbeat: if False, automatic heartbeats are disabled.
+        - auto_sequence: if True, the agent sets MsgSeqNum, SendingTime,
+          BodyLength and CheckSum in sent messages, and checks the
+          MsgSeqNum of received messages for gaps.
+        - next_send_sequence: MsgSeqNum for the next message sent.
+        - next_receive_sequence: MsgSeqNum expected next from the peer.
+        - session_layer: if True, the agent handles Logon, Logout,
+          Heartbeat, TestRequest, ResendRequest and SequenceReset
+          messages itself, and only passes on application messages.
+        - begin_string, sender_comp_id, target_comp_id: header fields
+          for session-level messages.  A server session takes any not
+          configured from the client's Logon.
+        - journal: True to record sent and received messages in a new
+          journal file in the system's temporary directory, a directory
+          name for the file, or False to close the journal.
+        - journal_sync_interval: None (the default) to leave writing
+          the journal to the operating system, zero to flush each
+          message to disk, or the maximum time, in seconds, before
+          messages are flushed together."""
+        assert not self._destroyed
+
+        request = ClientConfigureMessage(self._name, options)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+        return
+
+    def sequence_numbers(self):
+        """Return the client's sequence numbers.
+
+        :returns: Tuple of the MsgSeqNum for the next message sent, the
+        MsgSeqNum expected next from the peer, and a list of (first,
+        last) ranges of MsgSeqNums missing from received messages.
+
+        Received messages are only checked with auto_sequence set."""
+        assert not self._destroyed
+
+        request = ClientSequenceRequest(self._name)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+        return (response.next_send_sequence, response.next_receive_sequence,
+                [tuple(gap) for gap in response.gaps])
+
+    def journal(self, begin: int = 1, end: int = 0,
+                direction: str = "sent", max_count: int = None):
+        """Return messages recorded in the client's journal.
+
+        :param begin: First MsgSeqNum.
+        :param end: Last MsgSeqNum, or zero for no limit.
+        :param direction: "sent" or "received".
+        :param max_count: Maximum number of messages to return, or None
+        for no limit.  The agent returns at most JOURNAL_MAX_COUNT per
+        request, so long ranges take several requests.
+        :returns: List of the recorded messages' bytes, in MsgSeqNum
+        order.  Numbers not recorded are skipped.
+
+        The journal must be enabled with configure(journal=...)."""
+        assert not self._destroyed
+
+        # The agent returns a limited number of messages per request,
+        # so a long range is fetched in pieces.
+        messages = []
+        while max_count is None or len(messages) < max_count:
+            count = None if max_count is None else max_count - len(messages)
+            request = ClientJournalRequest(self._name, begin, end, direction,
+                                           count)
+            request_id = self._proxy.send_request(request)
+
+            response = self._proxy.await_response(request_id)
+            if not response.result:
+                raise RuntimeError(response.message)
+            if not response.payloads:
+                break
+            messages.extend(base64.b64decode(payload)
+                            for payload in response.payloads)
+            last = sequence_number(messages[-1])
+            if last is None or (end and last >= end):
+                break
+            begin = last + 1
+        return messages
+
+    def journal_path(self) -> str:
+        """Return the path of the client's journal file."""
+        assert not self._destroyed
+
+        request = ClientJournalRequest(self._name, 1, 0, "sent", 0)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+        return response.path
+
+    def watch_writes(self, callback=None):
+        """Have the agent report when its outbound buffer for this client
+        crosses the high or low watermark.
+
+        :param callback: Optional function, called with the paused flag
+        and the number of bytes buffered for each report.
+        :returns: WriteWatch."""
+        assert not self._destroyed
+
+        watch = WriteWatch(self._proxy, callback)
+        key = ("client_write_state", self._name)
+        self._proxy.add_subscription(key, watch)
+        self.configure(write_notify=True)
+        return watch
+
     def receive_queue_length(self) -> int:
         """Return number of messages waiting to be collected from the client."""
         assert not self._destroyed
 
+        if self._channel is not None:
+            return self._channel.inbound.count()
+
         request = ClientReceiveCountRequest(self._name)
-        self._proxy.send_request(request)
+        request_id = self._proxy.send_request(request)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
         return response.count
 
-    def receive(self) -> bytes:
+    def receive(self, timeout: float = None) -> bytes:
         """Return a FIX message received from the connected server.
 
-        If no messages are queued, returns None."""
+        :param timeout: If no messages are queued, the maximum time to
+        wait for one to arrive, in seconds.
+
+        If no messages are queued (after waiting), returns None."""
+
+        if self._channel is not None:
+            return self._channel.receive(timeout)
 
-        request = ClientGetMessage(self._name)
-        self._proxy.send_request(request)
+        if self._proxy.is_binary() and self._handle is not None:
+            # Timeout is sent in milliseconds.
+            payload = b''
+            if timeout:
+                payload = struct.pack(">L", int(timeout * 1000))
+            request_id = self._proxy.send_frame(OP_CLIENT_GET, self._handle,
+                                                payload)
+        else:
+            request = ClientGetMessage(self._name, timeout)
+            request_id = self._proxy.send_request(request)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
 
+        if isinstance(response, BinaryFrame):
+            if response.opcode & OP_EMPTY:
+                return None
+            return response.payload
+
+        if response.payload is None:
+            return None
+
         message = base64.b64decode(response.payload)
         return message
 
+    def receive_all(self, max_count: int = None, max_bytes: int = None):
+        """Return all FIX messages received from the connected server.
+
+        :param max_count: Maximum number of messages to return.
+        :param max_bytes: Maximum total size of messages to return.
+        :returns: List of messages, in the order they were received.
+
+        The messages are collected from the agent in a single request.
+        If no messages are queued, returns an empty list."""
+        assert not self._destroyed
+
+        if self._channel is not None:
+            return self._channel.inbound.read_many(max_count, max_bytes)
+
+        if self._proxy.is_binary() and self._handle is not None:
+            limits = struct.pack(">LL", max_count or 0, max_bytes or 0)
+            request_id = self._proxy.send_frame(OP_CLIENT_GET_ALL,
+                                                self._handle, limits)
+        else:
+            request = ClientGetAllMessage(self._name, max_count, max_bytes)
+            request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+
+        if isinstance(response, BinaryFrame):
+            return unpack_messages(response.payload)
+        return [base64.b64decode(p) for p in response.payloads]
+
 
 class Server(object):
     """Local proxy for FIX server in agent."""
@@ -161,9 +752,9 @@ class Server(object):
         self._destroyed = False
 
         msg = ServerCreateMessage(self._name)
-        self._proxy.send_request(msg)
+        request_id = self._proxy.send_request(msg)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
         return
@@ -183,9 +774,9 @@ class Server(object):
         assert len(self._ports) == 0
 
         request = ServerDestroyMessage(self._name)
-        self._proxy.send_request(request)
+        request_id = self._proxy.send_request(request)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
 
@@ -193,17 +784,40 @@ class Server(object):
         self._destroyed = True
         return
 
-    def listen(self, port: int = 0):
+    def configure(self, **options):
+        """Change configurable options for sessions accepted from now on.
+
+        :param options: Option values, by name, as for
+        ServerSession.configure().  Each accepted session is configured
+        before it reads anything, so this is the way to enable the
+        session layer for the peer's Logon."""
+        assert not self._destroyed
+
+        request = ServerConfigureMessage(self._name, options)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+        return
+
+    def listen(self, port: int = 0, backlog: int = None,
+               workers: int = None):
         """Listen for connections on specified port.
 
         :param port: TCP port number on which to listen for connections.
+        :param backlog: Maximum number of connections waiting to be
+        accepted by the agent, or None for the agent's default.
+        :param workers: Number of agent worker processes accepting
+        connections for the port, using SO_REUSEPORT.  Only a sharded
+        agent has more than one worker.
         :returns: Listening port number."""
         assert not self._destroyed
 
-        msg = ServerListenMessage(self._name, port)
-        self._proxy.send_request(msg)
+        msg = ServerListenMessage(self._name, port, backlog, workers)
+        request_id = self._proxy.send_request(msg)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
 
@@ -218,9 +832,9 @@ class Server(object):
         assert not self._destroyed
 
         request = ServerUnlistenMessage(self._name, port)
-        self._proxy.send_request(request)
+        request_id = self._proxy.send_request(request)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
 
@@ -232,9 +846,25 @@ class Server(object):
         assert not self._destroyed
 
         msg = ServerPendingAcceptCountRequest(self._name)
-        self._proxy.send_request(msg)
+        request_id = self._proxy.send_request(msg)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+        return response.count
+
+    def wait_for_pending_accept(self, timeout: float):
+        """Wait for a session to be ready to accept.
+
+        :param timeout: Maximum time to wait, in seconds.
+        :returns: The number of sessions waiting to be accepted, which
+        is zero if none arrived in time."""
+        assert not self._destroyed
 
-        response = self._proxy.await_response()
+        msg = ServerPendingAcceptCountRequest(self._name, timeout)
+        request_id = self._proxy.send_request(msg)
+
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
         return response.count
@@ -246,14 +876,15 @@ class Server(object):
         assert not self._destroyed
 
         msg = ServerAcceptMessage(self._name, new_name)
-        self._proxy.send_request(msg)
+        request_id = self._proxy.send_request(msg)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         logging.info("GOT accept response from agent")
         if not response.result:
             raise RuntimeError(response.message)
 
-        client = ServerSession(self, self._proxy, response.session_name)
+        client = ServerSession(self, self._proxy, response.session_name,
+                               response.handle)
         self._clients[response.session_name] = client
         return client
 
@@ -261,12 +892,16 @@ class Server(object):
 class ServerSession(object):
     """Local proxy for server-side session with connected client."""
 
-    def __init__(self, server, proxy, name):
+    def __init__(self, server, proxy, name, handle=None):
         """(Internal) Constructor."""
         self._server = server
         self._proxy = proxy
         self._name = name
+        self._handle = handle
         self._connected = True
+        self._subscription = None
+        self._subscription_key = None
+        self._channel = None
         return
 
     def destroy(self):
@@ -281,9 +916,9 @@ class ServerSession(object):
     def is_connected(self):
         """Return True if the session remains connected."""
         request = ServerIsConnectedRequest(self._name)
-        self._proxy.send_request(request)
+        request_id = self._proxy.send_request(request)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
 
@@ -292,81 +927,442 @@ class ServerSession(object):
     def disconnect(self):
         """Disconnect this session from its client."""
         request = ServerDisconnectMessage(self._name)
-        self._proxy.send_request(request)
+        request_id = self._proxy.send_request(request)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
 
         self._connected = False
+        self.close_channel()
         return
 
-    def send(self, message: bytes):
+    def send(self, message: bytes, wait: bool = True):
         """Send a message to the connected FIX client.
 
-        :param message: Byte array of formatted FIX message to send."""
+        :param message: Byte array of formatted FIX message to send.
+        :param wait: If False, don't wait for the agent's response; any
+        error is instead reported by the proxy's sync() method."""
 
         assert message
         assert self._connected
 
-        payload = base64.b64encode(message).decode("ascii")
-        request = SessionSendMessage(self._name, payload)
-        self._proxy.send_request(request)
+        if self._channel is not None:
+            self._channel.send([message], alive=self._proxy.is_alive)
+            return
+
+        if self._proxy.is_binary() and self._handle is not None:
+            request_id = self._proxy.send_frame(OP_SESSION_SEND, self._handle,
+                                                message)
+        else:
+            payload = base64.b64encode(message).decode("ascii")
+            request = SessionSendMessage(self._name, payload)
+            request_id = self._proxy.send_request(request)
+        if not wait:
+            self._proxy.defer_response(request_id)
+            return
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+        return
+
+    def send_batch(self, messages: list, wait: bool = True):
+        """Send several messages to the connected FIX client.
+
+        :param messages: List of byte arrays of formatted FIX messages
+        to send, in order.
+        :param wait: If False, don't wait for the agent's response; any
+        error is instead reported by the proxy's sync() method.
+
+        The messages are sent to the agent in a single request."""
+
+        assert self._connected
+
+        if self._channel is not None:
+            self._channel.send(messages, alive=self._proxy.is_alive)
+            return
+
+        if self._proxy.is_binary() and self._handle is not None:
+            # Binary frames carry raw bytes, so the batch is just the
+            # concatenated messages.
+            request_id = self._proxy.send_frame(OP_SESSION_SEND, self._handle,
+                                                b''.join(messages))
+        else:
+            payloads = [base64.b64encode(m).decode("ascii")
+                        for m in messages]
+            request = SessionSendBatchMessage(self._name, payloads)
+            request_id = self._proxy.send_request(request)
+        if not wait:
+            self._proxy.defer_response(request_id)
+            return
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+        return
+
+    def subscribe(self, callback=None):
+        """Have received FIX messages pushed from the agent as they arrive.
 
-        response = self._proxy.await_response()
+        :param callback: Optional function, called with each message.
+        :returns: Subscription, which can be iterated over to collect
+        messages if no callback was given.
+
+        While subscribed, received messages are no longer queued in
+        the agent, and any already queued are pushed immediately."""
+        assert self._connected
+        assert self._subscription is None
+
+        if self._proxy.is_binary() and self._handle is not None:
+            key = (OP_SESSION_RECEIVED, self._handle)
+        else:
+            key = ("session_received", self._name)
+
+        subscription = Subscription(self._proxy, self, callback)
+        self._proxy.add_subscription(key, subscription)
+
+        request = SessionSubscribeMessage(self._name, True)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
         if not response.result:
+            self._proxy.remove_subscription(key)
             raise RuntimeError(response.message)
+
+        self._subscription = subscription
+        self._subscription_key = key
+        return subscription
+
+    def unsubscribe(self):
+        """Cancel the subscription to received messages."""
+        assert self._subscription is not None
+
+        request = SessionSubscribeMessage(self._name, False)
+        request_id = self._proxy.send_request(request)
+
+        # Messages pushed before the agent processed the request are
+        # still delivered to the subscription.
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+
+        self._proxy.remove_subscription(self._subscription_key)
+        self._subscription.set_closed()
+        self._subscription = None
+        return
+
+    def attach_shared_memory(self, ring_size: int = DEFAULT_RING_SIZE):
+        """Send and receive FIX messages using shared memory.
+
+        :param ring_size: Size of each direction's ring buffer, in bytes.
+
+        This is only possible when the agent is on the same host.  Once
+        attached, messages are passed through ring buffers shared with
+        the agent, rather than through the control session, and
+        received messages are no longer queued in the agent."""
+        assert self._connected
+        assert self._channel is None
+
+        channel = SharedChannel.create(temporary_path(), ring_size)
+        request = SessionAttachMessage(self._name, channel.path(), ring_size)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            channel.close()
+            channel.unlink()
+            raise RuntimeError(response.message)
+
+        channel.connect_doorbell()
+        self._channel = channel
         return
 
+    def detach_shared_memory(self):
+        """Stop using shared memory to send and receive FIX messages.
+
+        Any received messages not yet collected from the channel are
+        discarded."""
+        assert self._channel is not None
+
+        request = SessionAttachMessage(self._name, None, None)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+
+        self.close_channel()
+        return
+
+    def close_channel(self):
+        """(Internal) Release the local end of the shared memory channel."""
+        if self._channel is not None:
+            self._channel.close()
+            self._channel.unlink()
+            self._channel = None
+        return
+
+    def configure(self, **options):
+        """Change the session's configurable options, in the agent.
+
+        :param options: Option values, by name.  Options not given are
+        left unchanged.
+
+        - queue_capacity: maximum number of received messages the agent
+          holds in memory, or None for no limit.
+        - queue_policy: what happens to received messages when the
+          queue is full; one of "block" (stop reading from the socket),
+          "drop_oldest", "drop_newest", or "spill" (to a file).
+        - write_high_watermark: size, in bytes, at which the outbound
+          buffer is reported as paused.
+        - write_low_watermark: size, in bytes, at which the outbound
+          buffer is reported as resumed.
+        - raw: if True, the agent never reads received messages' fields.
+        - heartbeat_interval: HeartBtInt, in seconds, for automatic
+          Heartbeats and TestRequests, or zero (the default) for none.
+          Implies auto_sequence.
+        - auto_heartbeat: if False, automatic heartbeats are disabled.
+        - auto_sequence: if True, the agent sets MsgSeqNum, SendingTime,
+          BodyLength and CheckSum in sent messages, and checks the
+          MsgSeqNum of received messages for gaps.
+        - next_send_sequence: MsgSeqNum for the next message sent.
+        - next_receive_sequence: MsgSeqNum expected next from the peer.
+        - session_layer: if True, the agent handles Logon, Logout,
+          Heartbeat, TestRequest, ResendRequest and SequenceReset
+          messages itself, and only passes on application messages.
+        - begin_string, sender_comp_id, target_comp_id: header fields
+          for session-level messages.  A server session takes any not
+          configured from the client's Logon.
+        - journal: True to record sent and received messages in a new
+          journal file in the system's temporary directory, a directory
+          name for the file, or False to close the journal.
+        - journal_sync_interval: None (the default) to leave writing
+          the journal to the operating system, zero to flush each
+          message to disk, or the maximum time, in seconds, before
+          messages are flushed together."""
+        assert self._connected
+
+        request = SessionConfigureMessage(self._name, options)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+        return
+
+    def sequence_numbers(self):
+        """Return the session's sequence numbers.
+
+        :returns: Tuple of the MsgSeqNum for the next message sent, the
+        MsgSeqNum expected next from the peer, and a list of (first,
+        last) ranges of MsgSeqNums missing from received messages.
+
+        Received messages are only checked with auto_sequence set."""
+        assert self._connected
+
+        request = SessionSequenceRequest(self._name)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+        return (response.next_send_sequence, response.next_receive_sequence,
+                [tuple(gap) for gap in response.gaps])
+
+    def journal(self, begin: int = 1, end: int = 0,
+                direction: str = "sent", max_count: int = None):
+        """Return messages recorded in the session's journal.
+
+        :param begin: First MsgSeqNum.
+        :param end: Last MsgSeqNum, or zero for no limit.
+        :param direction: "sent" or "received".
+        :param max_count: Maximum number of messages to return, or None
+        for no limit.  The agent returns at most JOURNAL_MAX_COUNT per
+        request, so long ranges take several requests.
+        :returns: List of the recorded messages' bytes, in MsgSeqNum
+        order.  Numbers not recorded are skipped.
+
+        The journal must be enabled with configure(journal=...)."""
+        # The agent returns a limited number of messages per request,
+        # so a long range is fetched in pieces.
+        messages = []
+        while max_count is None or len(messages) < max_count:
+            count = None if max_count is None else max_count - len(messages)
+            request = SessionJournalRequest(self._name, begin, end, direction,
+                                            count)
+            request_id = self._proxy.send_request(request)
+
+            response = self._proxy.await_response(request_id)
+            if not response.result:
+                raise RuntimeError(response.message)
+            if not response.payloads:
+                break
+            messages.extend(base64.b64decode(payload)
+                            for payload in response.payloads)
+            last = sequence_number(messages[-1])
+            if last is None or (end and last >= end):
+                break
+            begin = last + 1
+        return messages
+
+    def journal_path(self) -> str:
+        """Return the path of the session's journal file."""
+        request = SessionJournalRequest(self._name, 1, 0, "sent", 0)
+        request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+        return response.path
+
+    def watch_writes(self, callback=None):
+        """Have the agent report when its outbound buffer for this session
+        crosses the high or low watermark.
+
+        :param callback: Optional function, called with the paused flag
+        and the number of bytes buffered for each report.
+        :returns: WriteWatch."""
+        assert self._connected
+
+        watch = WriteWatch(self._proxy, callback)
+        key = ("session_write_state", self._name)
+        self._proxy.add_subscription(key, watch)
+        self.configure(write_notify=True)
+        return watch
+
     def receive_queue_length(self):
         """Return the number of messages queued from the connected client."""
 
         assert self._connected
 
+        if self._channel is not None:
+            return self._channel.inbound.count()
+
         request = SessionReceiveCountRequest(self._name)
-        self._proxy.send_request(request)
+        request_id = self._proxy.send_request(request)
 
-        response = self._proxy.await_response()
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
         return response.count
 
-    def receive(self) -> bytes:
+    def receive(self, timeout: float = None) -> bytes:
         """Return a message received from the connected client.
 
-        If no messages are queued, returns None."""
-        assert self._connected
+        :param timeout: If no messages are queued, the maximum time to
+        wait for one to arrive, in seconds.
 
-        request = SessionGetMessage(self._name)
-        self._proxy.send_request(request)
+        If no messages are queued (after waiting), returns None."""
+        assert self._connected
 
-        response = self._proxy.await_response()
+        if self._channel is not None:
+            return self._channel.receive(timeout)
+
+        if self._proxy.is_binary() and self._handle is not None:
+            # Timeout is sent in milliseconds.
+            payload = b''
+            if timeout:
+                payload = struct.pack(">L", int(timeout * 1000))
+            request_id = self._proxy.send_frame(OP_SESSION_GET, self._handle,
+                                                payload)
+        else:
+            request = SessionGetMessage(self._name, timeout)
+            request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
         if not response.result:
             raise RuntimeError(response.message)
 
+        if isinstance(response, BinaryFrame):
+            if response.opcode & OP_EMPTY:
+                return None
+            return response.payload
+
+        if response.payload is None:
+            return None
+
         message = base64.b64decode(response.payload)
         return message
 
+    def receive_all(self, max_count: int = None, max_bytes: int = None):
+        """Return all messages received from the connected client.
+
+        :param max_count: Maximum number of messages to return.
+        :param max_bytes: Maximum total size of messages to return.
+        :returns: List of messages, in the order they were received.
+
+        The messages are collected from the agent in a single request.
+        If no messages are queued, returns an empty list."""
+        assert self._connected
+
+        if self._channel is not None:
+            return self._channel.inbound.read_many(max_count, max_bytes)
+
+        if self._proxy.is_binary() and self._handle is not None:
+            limits = struct.pack(">LL", max_count or 0, max_bytes or 0)
+            request_id = self._proxy.send_frame(OP_SESSION_GET_ALL,
+                                                self._handle, limits)
+        else:
+            request = SessionGetAllMessage(self._name, max_count, max_bytes)
+            request_id = self._proxy.send_request(request)
+
+        response = self._proxy.await_response(request_id)
+        if not response.result:
+            raise RuntimeError(response.message)
+
+        if isinstance(response, BinaryFrame):
+            return unpack_messages(response.payload)
+        return [base64.b64decode(p) for p in response.payloads]
+
 
 class FixToolProxy(object):
     """Proxy for communication with remote FIX agent."""
 
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, binary: bool = False,
+                 unix_path: str = None):
         """Constructor.
 
-        :param host: String host name or IP address for agent."""
+        :param host: String host name or IP address for agent.
+        :param port: Integer TCP port number for agent.
+        :param binary: If True, use binary frames to carry FIX messages
+        to and from the agent, rather than BASE64-encoded JSON.
+        :param unix_path: If set, connect to the agent's Unix domain
+        socket at this path, ignoring host and port."""
         self._host = host
         self._port = port
+        self._unix_path = unix_path
         self._clients = {}
         self._servers = {}
 
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.connect((host, port))
+        if unix_path:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(unix_path)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.connect((host, port))
         self._socket.setblocking(True)
 
         self._buffer = b''
+        self._next_request_id = 1
+        self._responses = {}
+        self._deferred = set()
+        self._failures = []
+        self._subscriptions = {}
+
+        self._binary = False
+        if binary:
+            request_id = self.send_request(NegotiateMessage(True))
+            response = self.await_response(request_id)
+            if not response.result:
+                raise RuntimeError(response.message)
+            self._binary = response.binary
         return
 
+    def is_binary(self) -> bool:
+        """Return True if binary frames are in use with the agent."""
+        return self._binary
+
     def shutdown(self):
         """Shutdown the associated agent."""
         message = ShutdownMessage()
@@ -404,95 +1400,183 @@ class FixToolProxy(object):
         self._servers[name] = server
         return server
 
-    def send_request(self, message):
-        """(Internal) Send message to agent."""
+    def send_request(self, message) -> int:
+        """(Internal) Send message to agent.
+
+        :param message: Request message to send.
+        :returns: Identifier to be used to collect the response."""
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        message.request_id = request_id
+
         payload = message.to_json().encode('UTF-8')
         payload_length = len(payload)
         header = struct.pack(">L", payload_length)
         self._socket.sendall(header + payload)
-        return
-
-    def await_response(self):
-        """(Internal) Wait for message from agent."""
-        while True:
-            buf = self._socket.recv(65536)
-            if len(buf) == 0:
-                # Disconnected.
-                return None
-
-            self._buffer += buf
-            if len(self._buffer) <= 4:
-                continue
+        return request_id
 
-            message_length = struct.unpack(">L", self._buffer[:4])[0]
-            self._buffer = self._buffer[4:]
-            if len(self._buffer) < message_length:
-                continue
+    def send_frame(self, opcode: int, handle: int, payload: bytes = b''):
+        """(Internal) Send binary frame to agent.
 
-            message_buf = self._buffer[:message_length]
-            self._buffer = self._buffer[message_length:]
+        :param opcode: Binary frame opcode.
+        :param handle: Handle of client or server session.
+        :param payload: Raw frame payload.
+        :returns: Identifier to be used to collect the response."""
+        request_id = self._next_request_id
+        self._next_request_id += 1
 
-            d = json.loads(message_buf.decode())
-            message = None
-            message_type = d.get("type")
-            if message_type == "client_created":
-                message = ClientCreatedMessage.from_dict(d)
+        payload = BinaryFrame(opcode, handle, request_id, payload).to_bytes()
+        header = struct.pack(">L", len(payload))
+        self._socket.sendall(header + payload)
+        return request_id
 
-            elif message_type == "client_destroyed":
-                message = ClientDestroyedMessage.from_dict(d)
+    def await_response(self, request_id: int = None):
+        """(Internal) Wait for message from agent.
 
-            elif message_type == "client_connected":
-                message = ClientConnectedMessage.from_dict(d)
+        :param request_id: Identifier of the request whose response
+        should be returned, or None for the next response received.
 
-            elif message_type == "client_is_connected_response":
-                message = ClientIsConnectedResponse.from_dict(d)
+        Responses to other requests that arrive in the meantime are
+        kept, and returned when they're awaited."""
+        while True:
+            if request_id is None:
+                if self._responses:
+                    first = next(iter(self._responses))
+                    return self._responses.pop(first)
 
-            elif message_type == "client_sent":
-                message = ClientSentMessage.from_dict(d)
+            elif request_id in self._responses:
+                return self._responses.pop(request_id)
 
-            elif message_type == "client_receive_count_response":
-                message = ClientReceiveCountResponse.from_dict(d)
+            if not self.read_response():
+                # Disconnected.
+                return None
 
-            elif message_type == "client_got":
-                message = ClientGotMessage.from_dict(d)
+    def defer_response(self, request_id: int):
+        """(Internal) Don't wait for the response to a request.
 
-            elif message_type == "server_created":
-                message = ServerCreatedMessage.from_dict(d)
+        :param request_id: Identifier of the request.
 
-            elif message_type == "server_destroyed":
-                message = ServerDestroyedMessage.from_dict(d)
+        Deferred responses are discarded as they arrive, except for
+        failures, which are reported by sync()."""
+        self._deferred.add(request_id)
+        return
 
-            elif message_type == "server_listened":
-                message = ServerListenedMessage.from_dict(d)
+    def sync(self):
+        """Wait for responses to all outstanding deferred requests.
 
-            elif message_type == "server_unlistened":
-                message = ServerUnlistenedMessage.from_dict(d)
+        Raises RuntimeError if any of those requests failed."""
+        while self._deferred:
+            if not self.read_response():
+                raise RuntimeError("Agent disconnected")
 
-            elif message_type == "server_pending_accept_response":
-                message = ServerPendingAcceptCountResponse.from_dict(d)
+        failures = self._failures
+        self._failures = []
+        if failures:
+            raise RuntimeError(failures[0])
+        return
 
-            elif message_type == "server_accepted":
-                message = ServerAcceptedMessage.from_dict(d)
+    def poll(self, timeout: float = 0) -> bool:
+        """Process a message from the agent, if one arrives in time.
+
+        :param timeout: Maximum time to wait, in seconds.
+        :returns: True if a message was processed.
+
+        This is useful to collect pushed messages for subscriptions
+        with a callback."""
+        if not self.has_message():
+            readable, _, _ = select.select([self._socket], [], [], timeout)
+            if not readable:
+                return False
+        return self.read_response()
+
+    def is_alive(self) -> bool:
+        """(Internal) Return False if the agent has closed the connection."""
+        readable, _, _ = select.select([self._socket], [], [], 0)
+        if not readable:
+            return True
+        try:
+            return self._socket.recv(1, socket.MSG_PEEK) != b''
+        except OSError:
+            return False
+
+    def has_message(self) -> bool:
+        """(Internal) Return True if a whole message is buffered."""
+        if len(self._buffer) < 4:
+            return False
+        message_length = struct.unpack(">L", self._buffer[:4])[0]
+        return len(self._buffer) >= 4 + message_length
+
+    def add_subscription(self, key, subscription: Subscription):
+        """(Internal) Register subscription for pushed messages."""
+        self._subscriptions[key] = subscription
+        return
 
-            elif message_type == "server_is_connected_response":
-                message = ServerIsConnectedResponse.from_dict(d)
+    def remove_subscription(self, key):
+        """(Internal) Unregister subscription."""
+        del self._subscriptions[key]
+        return
 
-            elif message_type == "server_disconnected":
-                message = ServerDisconnectedMessage.from_dict(d)
+    def read_response(self) -> bool:
+        """(Internal) Read a single message from the agent.
+
+        :returns: False if the agent disconnected, otherwise True."""
+        message = self.read_message()
+        if message is None:
+            return False
+
+        if not message.request_id:
+            # Pushed message for a subscription.
+            if isinstance(message, BinaryFrame):
+                key = (message.opcode, message.handle)
+                payload = message.payload
+            elif isinstance(message, (ClientWriteStateMessage,
+                                      SessionWriteStateMessage)):
+                key = (message.type, message.name)
+                payload = message
+            else:
+                key = (message.type, message.name)
+                payload = base64.b64decode(message.payload)
 
-            elif message_type == "session_receive_count_response":
-                message = SessionReceiveCountResponse.from_dict(d)
+            subscription = self._subscriptions.get(key)
+            if subscription is None:
+                logging.warning("Unexpected pushed message: %s", str(key))
+            else:
+                subscription.deliver(payload)
+            return True
+
+        if message.request_id in self._deferred:
+            self._deferred.remove(message.request_id)
+            if not message.result:
+                self._failures.append(message.message)
+        else:
+            self._responses[message.request_id] = message
+        return True
+
+    def read_message(self):
+        """(Internal) Read and decode the next message from the agent."""
+        while True:
+            if len(self._buffer) >= 4:
+                message_length = struct.unpack(">L", self._buffer[:4])[0]
+                if len(self._buffer) >= 4 + message_length:
+                    break
 
-            elif message_type == "session_sent":
-                message = SessionSentMessage.from_dict(d)
+            buf = self._socket.recv(65536)
+            if len(buf) == 0:
+                # Disconnected.
+                return None
+            self._buffer += buf
 
-            elif message_type == "session_got":
-                message = SessionGotMessage.from_dict(d)
+        message_buf = self._buffer[4:4 + message_length]
+        self._buffer = self._buffer[4 + message_length:]
 
-            else:
-                logging.critical("Unknown message type: %s" % message_type)
+        if BinaryFrame.is_binary(message_buf):
+            return BinaryFrame.from_bytes(message_buf)
 
-            return message
+        d = json.loads(message_buf.decode())
+        message = decode_response(d)
+        if message is None:
+            return self.read_message()
+        return message
 
     def remove_client(self, name):
         """(Iinternal) Remove named client from clients table."""
@@ -0,0 +1,751 @@
+#! /usr/bin/env python3
+##################################################################
+# fixtool
+# Copyright (C) 2018, David Arnold.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##################################################################
+
+"""Front process for an agent sharded across worker processes.
+
+A single agent process is limited to one core.  In sharded mode, the
+front process owns the control socket and runs no FIX connections
+itself.  Clients and servers are assigned to worker agents by a hash of
+their name, and server sessions live with the server that accepted
+them.  Each control session gets its own connection to every worker,
+and requests are forwarded over it, so subscriptions and pushed
+messages work as they do with a single agent.
+
+Binary frames carry handles allocated by each worker, so the front
+process translates them to handles that are unique across all workers."""
+
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+import zlib
+
+from fixtool.agent import BaseProtocol, ControlProtocol, ControlSession, \
+    FRAME_HEADER, FixToolAgent, WriteBuffer, new_event_loop
+from fixtool.message import BINARY_HEADER, BinaryFrame
+
+
+# Request types routed by the name of a server session, rather than by
+# the name of a client or server.
+SESSION_REQUESTS = ("server_is_connected_request", "server_disconnect")
+
+# Seconds to wait for workers to exit cleanly, before killing them.
+WORKER_EXIT_TIMEOUT = 5.0
+
+
+def run_worker(sock: socket.SocketType, unix_path: str, loop_name: str):
+    """Run a worker agent in a forked child process.
+
+    :param sock: Bound, listening socket for the worker's control
+    sessions.
+    :param unix_path: Path of the socket, if it's a Unix domain socket.
+    :param loop_name: Event loop implementation.
+
+    Never returns."""
+    status = 1
+    try:
+        loop, _ = new_event_loop(loop_name)
+        agent = FixToolAgent(unix_path=unix_path, loop=loop, sock=sock)
+        try:
+            agent.run()
+        finally:
+            agent.shutdown()
+        status = 0
+    except Exception:
+        logging.exception("Worker %d failed", os.getpid())
+    finally:
+        # Don't run the parent's cleanup code in the child.
+        os._exit(status)
+
+
+class WorkerLink(BaseProtocol):
+    """Connection to a worker agent, for one control session.
+
+    Requests written before the connection completes are held until it
+    does."""
+
+    def __init__(self, router, route, index: int):
+        """Constructor.
+
+        :param router: FixToolRouter.
+        :param route: Route for the control session.
+        :param index: Worker index."""
+        self._router = router
+        self._route = route
+        self._index = index
+        self._transport = None
+        self._frames = ControlSession(None)
+        self._writer = WriteBuffer()
+        self._writer.hold()
+        return
+
+    def send(self, payload: bytes):
+        """Send a frame payload to the worker.
+
+        :param payload: Array of bytes to send."""
+        self._writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+        return
+
+    def close(self):
+        """Close the connection."""
+        self._route = None
+        self._writer.detach()
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        return
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._writer.attach(transport)
+        return
+
+    def connection_lost(self, exc):
+        self._transport = None
+        if self._route is not None:
+            self._router.worker_lost(self._route, self._index)
+        return
+
+    def get_buffer(self, sizehint):
+        return self._frames.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        if self._route is not None:
+            self._router.forward(self._route, self._index,
+                                 self._frames.buffer_updated(nbytes))
+        return
+
+    def data_received(self, data):
+        if self._route is not None:
+            self._router.forward(self._route, self._index,
+                                 self._frames.append_bytes(data))
+        return
+
+
+class Route(object):
+    """A control session, and its connections to each worker."""
+
+    def __init__(self, control: ControlSession):
+        """Constructor.
+
+        :param control: Control session."""
+        self.control = control
+        self.links = []
+
+        # Requests made by the router itself use negative identifiers,
+        # so their responses can't be mistaken for the client's.  The
+        # callbacks for their responses, by request identifier.
+        self.callbacks = {}
+        self.next_request_id = -1
+        return
+
+    def request(self, index: int, message: dict, callback=None):
+        """Send a request to a worker on the router's behalf.
+
+        :param index: Worker index.
+        :param message: Request message.  It's copied, not modified.
+        :param callback: Function called with the worker index and the
+        decoded response, or None to discard the response."""
+        request_id = self.next_request_id
+        self.next_request_id -= 1
+        if callback is not None:
+            self.callbacks[request_id] = callback
+
+        message = dict(message, request_id=request_id)
+        self.links[index].send(json.dumps(message).encode())
+        return
+
+    def reply(self, request: dict, response: dict):
+        """Send a response to the client.
+
+        :param request: Client's request.
+        :param response: Response message, from a worker."""
+        response["request_id"] = request.get("request_id")
+        self.control.send(json.dumps(response).encode())
+        return
+
+
+class FixToolRouter(FixToolAgent):
+    """Front process for a sharded agent.
+
+    Accepts control sessions like an agent, but forwards their requests
+    to worker agents, rather than handling them itself."""
+
+    def __init__(self, port=0, unix_path=None, workers=2,
+                 loop_name="asyncio"):
+        """Constructor.
+
+        :param port: TCP port number for accepting control sessions.
+        :param unix_path: If set, accept control sessions on a Unix
+        domain socket at this path, rather than using TCP.
+        :param workers: Number of worker agent processes.
+        :param loop_name: Event loop implementation, for the front and
+        worker processes.
+
+        The workers are forked before anything else is created, so they
+        don't inherit the front process's event loop or sockets.  If
+        the front process then fails to start, they're stopped again."""
+        self._worker_addresses = []
+        self._worker_pids = []
+
+        sockets = []
+        try:
+            for i in range(workers):
+                sockets.append(self.create_worker_socket(i))
+                self._worker_addresses.append(sockets[-1][1])
+
+            for sock, address in sockets:
+                pid = self.fork_worker(sockets, sock, address, loop_name)
+                self._worker_pids.append(pid)
+        except BaseException:
+            self.stop_workers()
+            raise
+        finally:
+            for sock, _ in sockets:
+                sock.close()
+
+        try:
+            self.start_front(port, unix_path, loop_name)
+        except BaseException:
+            self.stop_workers()
+            raise
+        return
+
+    @staticmethod
+    def fork_worker(sockets: list, sock: socket.SocketType, address,
+                    loop_name: str) -> int:
+        """(Internal) Fork a worker process.
+
+        :param sockets: All workers' (socket, address) tuples.
+        :param sock: This worker's listening socket.
+        :param address: Its address.
+        :param loop_name: Event loop implementation.
+        :returns: The worker's process ID.
+
+        SIGINT is blocked until the child is inside run_worker(), so
+        stopping it early can't unwind into the parent's code."""
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT})
+        try:
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+                    for other, _ in sockets:
+                        if other is not sock:
+                            other.close()
+                    run_worker(sock, address if isinstance(address, str)
+                               else None, loop_name)
+                finally:
+                    os._exit(1)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        return pid
+
+    def start_front(self, port, unix_path, loop_name: str):
+        """(Internal) Set up the front process, once workers are running.
+
+        :param port: TCP port number for accepting control sessions.
+        :param unix_path: Unix domain socket path, if not using TCP.
+        :param loop_name: Event loop implementation."""
+
+        # Control sessions' routes, by control session.
+        self._routes = {}
+
+        # Clients and servers route by a hash of their name, but server
+        # sessions are created in their server's worker.  A server can
+        # be replicated in several workers, listening on the same port.
+        self._session_workers = {}
+        self._server_workers = {}
+        self._server_options = {}
+
+        # Handles seen by proxies, and the (worker, handle) they map to.
+        self._worker_handles = {}
+        self._router_handles = {}
+        self._next_router_handle = 1
+
+        loop, _ = new_event_loop(loop_name)
+        try:
+            super().__init__(port, unix_path, loop)
+        except BaseException:
+            if self._socket is not None:
+                self._socket.close()
+            loop.close()
+            raise
+        return
+
+    def stop_workers(self):
+        """Stop the workers, and remove their sockets' files.
+
+        Workers shut down cleanly on SIGINT, as an agent does, but any
+        still running after WORKER_EXIT_TIMEOUT seconds are killed."""
+        for pid in self._worker_pids:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except OSError:
+                pass
+
+        running = set(self._worker_pids)
+        deadline = time.monotonic() + WORKER_EXIT_TIMEOUT
+        while running and time.monotonic() < deadline:
+            for pid in list(running):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                        running.discard(pid)
+                except OSError:
+                    running.discard(pid)
+            if running:
+                time.sleep(0.01)
+
+        for pid in running:
+            logging.warning("Worker %d didn't exit; killing it", pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._worker_pids = []
+
+        for address in self._worker_addresses:
+            if isinstance(address, str):
+                try:
+                    os.unlink(address)
+                except OSError:
+                    pass
+        self._worker_addresses = []
+        return
+
+    @staticmethod
+    def create_worker_socket(index: int):
+        """Create a listening socket for a worker.
+
+        :param index: Worker index.
+        :returns: Tuple of socket, and its address: a path for a Unix
+        domain socket, or a (host, port) tuple for TCP."""
+        if hasattr(socket, "AF_UNIX"):
+            tmpdir = "/tmp" if sys.platform == "darwin" \
+                else tempfile.gettempdir()
+            path = os.path.join(tmpdir, "fixtool-%d-w%d.sock"
+                                % (os.getpid(), index))
+            if os.path.exists(path):
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            address = path
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(("127.0.0.1", 0))
+            address = sock.getsockname()
+
+        sock.listen(100)
+        return sock, address
+
+    def worker_count(self) -> int:
+        """Return the number of worker processes."""
+        return len(self._worker_pids)
+
+    def worker_for_name(self, name) -> int:
+        """Return the index of the worker for a client or server.
+
+        :param name: Name of the client or server."""
+        key = str(name).encode()
+        return zlib.crc32(key) % len(self._worker_pids)
+
+    def reset(self):
+        """Forget entities, which the workers are resetting."""
+        self._session_workers = {}
+        self._server_workers = {}
+        self._server_options = {}
+        self._worker_handles = {}
+        self._router_handles = {}
+        self._next_router_handle = 1
+        return
+
+    def shutdown(self):
+        """Stop the workers, then clean up for exit."""
+        for route in list(self._routes.values()):
+            for link in route.links:
+                link.close()
+        self._routes = {}
+
+        self.stop_workers()
+        super().shutdown()
+        return
+
+    def accept(self, control_session: ControlSession, transport):
+        """Accept a new control client, and connect it to each worker.
+
+        :param control_session: Control session for the connection.
+        :param transport: Transport for the connection."""
+        super().accept(control_session, transport)
+
+        route = Route(control_session)
+        self._routes[control_session] = route
+        for index, address in enumerate(self._worker_addresses):
+            link = WorkerLink(self, route, index)
+            route.links.append(link)
+            self._loop.create_task(self.connect_worker(link, address))
+        return
+
+    async def connect_worker(self, link: WorkerLink, address):
+        """Connect a control session's link to a worker.
+
+        :param link: Worker link.
+        :param address: Worker's socket path, or (host, port) tuple."""
+        try:
+            if isinstance(address, str):
+                await self._loop.create_unix_connection(lambda: link,
+                                                        address)
+            else:
+                await self._loop.create_connection(lambda: link,
+                                                   address[0], address[1])
+        except OSError as e:
+            logging.error("Failed to connect to worker at %s: %s",
+                          str(address), str(e))
+            link.connection_lost(e)
+        return
+
+    def disconnected(self, control_session: ControlSession):
+        """Clean up after a control client disconnects.
+
+        :param control_session: Disconnected control session.
+
+        Closing its worker connections cleans up its subscriptions."""
+        route = self._routes.pop(control_session, None)
+        if route is not None:
+            for link in route.links:
+                link.close()
+        super().disconnected(control_session)
+        return
+
+    def worker_lost(self, route: Route, index: int):
+        """Handle a worker connection closing unexpectedly.
+
+        :param route: Route using the connection.
+        :param index: Worker index.
+
+        The control session can't continue without the worker, so it's
+        closed too."""
+        logging.error("Lost connection to worker %d", index)
+        route.control.close()
+        return
+
+    def dispatch(self, control_session: ControlSession, payloads: list):
+        """Forward frames from a control client to the workers.
+
+        :param control_session: Control session.
+        :param payloads: List of complete frame payloads."""
+        route = self._routes.get(control_session)
+        if route is None:
+            return
+
+        for payload in payloads:
+            if control_session.is_binary() and BinaryFrame.is_binary(payload):
+                if len(payload) < BINARY_HEADER.size:
+                    logging.warning("Binary frame too short: %d bytes",
+                                    len(payload))
+                    continue
+                self.forward_frame(route, BinaryFrame.from_bytes(payload))
+            else:
+                message = self.decode_request(control_session, payload)
+                if message is not None:
+                    self.forward_request(route, payload, message)
+        return
+
+    def forward_frame(self, route: Route, frame: BinaryFrame):
+        """Forward a binary frame to the worker owning its handle.
+
+        :param route: Route for the control session.
+        :param frame: Binary frame."""
+        # Unknown handles are sent as zero, which no worker allocates, so
+        # a worker reports the error.
+        index, handle = self._worker_handles.get(frame.handle, (0, 0))
+        frame.handle = handle
+        route.links[index].send(frame.to_bytes())
+        return
+
+    def forward_request(self, route: Route, payload: bytes, message: dict):
+        """Forward a JSON request to the worker that should handle it.
+
+        :param route: Route for the control session.
+        :param payload: Request, as received.
+        :param message: Decoded request."""
+        message_type = message["type"]
+        name = message.get("name")
+
+        if message_type == "shutdown":
+            logging.info("agent shutdown() requested")
+            self.stop()
+            return
+
+        if message_type == "reset":
+            self.reset()
+            for link in route.links:
+                link.send(payload)
+            return
+
+        if message_type == "negotiate":
+            # Each worker connection is negotiated, and the client gets
+            # a single response once they all have.
+            route.control.set_binary(bool(message.get("binary")))
+            self.gather(route, list(range(len(route.links))), message,
+                        lambda responses: route.reply(
+                            message, self.first_failure(responses)))
+            return
+
+        if message_type.startswith("session_") or \
+                message_type in SESSION_REQUESTS:
+            index = self._session_workers.get(name, 0)
+            route.links[index].send(payload)
+            return
+
+        if message_type.startswith("client_") or \
+                message_type == "server_create":
+            route.links[self.worker_for_name(name)].send(payload)
+            return
+
+        # Other server requests go to each of the server's workers.  Any
+        # options are kept, for replicas created later.
+        indices = self.server_workers(name)
+        if message_type == "server_configure":
+            self._server_options.setdefault(name, {}).update(
+                message.get("options") or {})
+        if message_type == "server_listen" and \
+                (message.get("workers") or 1) > 1:
+            self.listen(route, message)
+        elif len(indices) == 1:
+            if message_type == "server_accept":
+                self._session_workers[message.get("session_name")] = \
+                    indices[0]
+            route.links[indices[0]].send(payload)
+        elif message_type == "server_pending_accept_request":
+            self.count_pending(route, message, indices)
+        elif message_type == "server_accept":
+            self.accept_session(route, message, indices, 0)
+        else:
+            if message_type == "server_destroy":
+                del self._server_workers[name]
+                self._server_options.pop(name, None)
+            self.gather(route, indices, message,
+                        lambda responses: route.reply(
+                            message, self.first_failure(responses)))
+        return
+
+    def server_workers(self, name) -> list:
+        """Return the indices of the workers running a server.
+
+        :param name: Name of the server.
+
+        The first is the worker chosen by the hash of its name, and any
+        others are replicas."""
+        return self._server_workers.get(name, [self.worker_for_name(name)])
+
+    def listen(self, route: Route, message: dict):
+        """Listen on a port in several workers, using SO_REUSEPORT.
+
+        :param route: Route for the control session.
+        :param message: 'server_listen' request.
+
+        The server's own worker listens first, so that the port is
+        known if it was allocated by the operating system.  The server
+        is then created in the other workers, as required, and they
+        listen on the same port."""
+        name = message.get("name")
+        count = min(message.get("workers"), len(route.links))
+        home = self.worker_for_name(name)
+        indices = [(home + i) % len(route.links) for i in range(count)]
+        message = dict(message, workers=count)
+
+        def listened(index, response):
+            if not response.get("result"):
+                route.reply(message, response)
+                return
+
+            existing = self.server_workers(name)
+            replicas = indices[1:]
+            for replica in replicas:
+                if replica not in existing:
+                    route.request(replica, {"type": "server_create",
+                                            "name": name})
+                    if name in self._server_options:
+                        route.request(replica,
+                                      {"type": "server_configure",
+                                       "name": name,
+                                       "options": self._server_options[name]})
+            self._server_workers[name] = \
+                existing + [r for r in replicas if r not in existing]
+
+            replica_message = dict(message, port=response.get("port"))
+            self.gather(route, replicas, replica_message,
+                        lambda responses: route.reply(
+                            message, self.first_failure([response] +
+                                                        responses)))
+            return
+
+        route.request(home, message, listened)
+        return
+
+    def count_pending(self, route: Route, message: dict, indices: list):
+        """Count a replicated server's pending sessions.
+
+        :param route: Route for the control session.
+        :param message: 'server_pending_accept_request' request.
+        :param indices: Indices of the server's workers.
+
+        Without a timeout, the reply has the total for all workers.
+        With one, each worker waits for a pending session, and the reply
+        is sent as soon as any has one, with the count so far."""
+        responses = {}
+        replied = False
+
+        def counted(index, response):
+            nonlocal replied
+            responses[index] = response
+            if replied:
+                return
+
+            total = sum(r.get("count") or 0 for r in responses.values()
+                        if r.get("result"))
+            if (total > 0 and message.get("timeout")) or \
+                    len(responses) == len(indices):
+                replied = True
+                failure = self.first_failure(list(responses.values()))
+                if total == 0 and not failure.get("result"):
+                    route.reply(message, failure)
+                else:
+                    route.reply(message, dict(response, result=True,
+                                              message='', count=total))
+            return
+
+        for index in indices:
+            route.request(index, message, counted)
+        return
+
+    def accept_session(self, route: Route, message: dict, indices: list,
+                       position: int):
+        """Accept a session from whichever of a server's workers has one.
+
+        :param route: Route for the control session.
+        :param message: 'server_accept' request.
+        :param indices: Indices of the server's workers.
+        :param position: Position in indices of the next to try."""
+
+        def accepted(index, response):
+            if response.get("result"):
+                self._session_workers[message.get("session_name")] = index
+            elif position + 1 < len(indices):
+                self.accept_session(route, message, indices, position + 1)
+                return
+            route.reply(message, response)
+            return
+
+        route.request(indices[position], message, accepted)
+        return
+
+    def gather(self, route: Route, indices: list, message: dict, callback):
+        """Send a request to several workers, and collect the responses.
+
+        :param route: Route for the control session.
+        :param indices: Indices of the workers.
+        :param message: Request message.
+        :param callback: Function called with the list of responses, in
+        the same order as indices, once they have all arrived."""
+        responses = {}
+
+        def collect(index, response):
+            responses[index] = response
+            if len(responses) == len(indices):
+                callback([responses[i] for i in indices])
+            return
+
+        if not indices:
+            callback([])
+        for index in indices:
+            route.request(index, message, collect)
+        return
+
+    @staticmethod
+    def first_failure(responses: list) -> dict:
+        """Return the first failed response, or else the first response.
+
+        :param responses: Non-empty list of decoded responses."""
+        for response in responses:
+            if not response.get("result"):
+                return response
+        return responses[0]
+
+    def forward(self, route: Route, index: int, payloads: list):
+        """Forward frames from a worker to its control client.
+
+        :param route: Route for the control session.
+        :param index: Worker index.
+        :param payloads: List of complete frame payloads."""
+        control = route.control
+        for payload in payloads:
+            if control.is_binary() and BinaryFrame.is_binary(payload):
+                # Responses and pushed messages both carry handles.
+                frame = BinaryFrame.from_bytes(payload)
+                frame.handle = self.router_handle(index, frame.handle)
+                control.send_frame(frame)
+                continue
+
+            # Only responses with handles, or to the router's own
+            # requests, need to be decoded.
+            if b'"handle"' not in payload and \
+                    b'"request_id": -' not in payload:
+                control.send(payload)
+                continue
+
+            message = json.loads(payload.decode())
+            if message.get("handle") is not None:
+                message["handle"] = self.router_handle(index,
+                                                       message["handle"])
+
+            request_id = message.get("request_id")
+            if request_id is not None and request_id < 0:
+                callback = route.callbacks.pop(request_id, None)
+                if callback is not None:
+                    callback(index, message)
+                continue
+
+            control.send(json.dumps(message).encode())
+        return
+
+    def router_handle(self, index: int, handle: int) -> int:
+        """Return the handle seen by proxies for a worker's handle.
+
+        :param index: Worker index.
+        :param handle: Handle allocated by the worker."""
+        key = (index, handle)
+        router_handle = self._router_handles.get(key)
+        if router_handle is None:
+            router_handle = self._next_router_handle
+            self._next_router_handle += 1
+            self._router_handles[key] = router_handle
+            self._worker_handles[router_handle] = key
+        return router_handle
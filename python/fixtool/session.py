@@ -0,0 +1,672 @@
+#! /usr/bin/env python3
+##################################################################
+# fixtool
+# Copyright (C) 2018, David Arnold.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##################################################################
+
+"""FIX session layer, run by the agent for clients and server sessions.
+
+With the session layer enabled, the agent exchanges Logon, Logout,
+Heartbeat, TestRequest, ResendRequest and SequenceReset messages with
+the peer itself, and only application messages are passed to the test.
+Each session-level exchange would otherwise need several control
+protocol round trips."""
+
+import logging
+
+import simplefix
+
+from fixtool.framing import SendingTime, WireMessage, message_type, stamp
+from fixtool.heartbeat import Heartbeat
+from fixtool.journal import SENT, Journal
+from fixtool.timerwheel import TimerWheel
+
+# Session-level message types.
+HEARTBEAT = b'0'
+TEST_REQUEST = b'1'
+RESEND_REQUEST = b'2'
+REJECT = b'3'
+SEQUENCE_RESET = b'4'
+LOGOUT = b'5'
+LOGON = b'A'
+ADMIN_TYPES = (HEARTBEAT, TEST_REQUEST, RESEND_REQUEST, REJECT,
+               SEQUENCE_RESET, LOGOUT, LOGON)
+
+# Session states.
+DISCONNECTED = "disconnected"
+LOGON_SENT = "logon_sent"
+AWAITING_LOGON = "awaiting_logon"
+ACTIVE = "active"
+LOGOUT_SENT = "logout_sent"
+
+
+class SequenceNumbers(object):
+    """MsgSeqNum state for a client or server session."""
+
+    def __init__(self, name: str = None):
+        """Constructor.
+
+        :param name: Name of the session, for logging."""
+        self.name = name
+        self.next_send = 1
+        self.next_receive = 1
+        self.gaps = []
+        self._sending_time = SendingTime()
+        return
+
+    @staticmethod
+    def check_numbers(next_send: int = None, next_receive: int = None):
+        """Raise ValueError if a sequence number is invalid.
+
+        :param next_send: As for set().
+        :param next_receive: As for set()."""
+        for value in (next_send, next_receive):
+            if value is not None and (isinstance(value, bool) or
+                                      not isinstance(value, int) or
+                                      value < 1):
+                raise ValueError("Bad sequence number: %s" % str(value))
+        return
+
+    def set(self, next_send: int = None, next_receive: int = None):
+        """Set the next sequence numbers.
+
+        :param next_send: MsgSeqNum for the next message sent, or None
+        to leave it unchanged.
+        :param next_receive: MsgSeqNum expected for the next message
+        received, or None to leave it unchanged.  Setting it discards
+        any recorded gaps.
+
+        Raises ValueError if a sequence number is invalid."""
+        self.check_numbers(next_send, next_receive)
+        if next_send is not None:
+            self.next_send = next_send
+        if next_receive is not None:
+            self.next_receive = next_receive
+            self.gaps = []
+        return
+
+    def stamp(self, message: bytes, sequence: int = None,
+              possible_duplicate: bool = False) -> bytes:
+        """Set MsgSeqNum, and SendingTime, in a message to send.
+
+        :param message: Byte array of formatted FIX message.
+        :param sequence: MsgSeqNum for a resent message, or None to use
+        the next one.
+        :param possible_duplicate: If True, also set PossDupFlag and
+        OrigSendingTime, for a resent message.
+        :returns: Stamped message.
+
+        A message that can't be stamped is sent unchanged, without
+        using a sequence number."""
+        try:
+            stamped = stamp(message,
+                            self.next_send if sequence is None else sequence,
+                            self._sending_time.now(), possible_duplicate)
+        except ValueError as e:
+            logging.warning("%s: sending unstamped message: %s",
+                            self.name, str(e))
+            return message
+
+        if sequence is None:
+            self.next_send += 1
+        return stamped
+
+    def check(self, wire: WireMessage):
+        """Check the MsgSeqNum of a received message.
+
+        :param wire: Received FIX message.
+
+        A MsgSeqNum higher than expected records the missing range as a
+        gap.  One lower than expected is logged, unless the message is
+        a possible duplicate."""
+        try:
+            sequence = wire.get(34)
+        except ValueError:
+            return
+        if sequence is None or not sequence.isdigit():
+            return
+
+        sequence = int(sequence)
+        expected = self.next_receive
+        if sequence < expected:
+            if wire.get(43) != b'Y':
+                logging.warning("%s: MsgSeqNum %d lower than expected %d",
+                                self.name, sequence, expected)
+            return
+
+        if sequence > expected:
+            logging.info("%s: sequence gap, %d to %d missing",
+                         self.name, expected, sequence - 1)
+            self.gaps.append((expected, sequence - 1))
+        self.next_receive = sequence + 1
+        return
+
+
+class SessionLayer(object):
+    """Session-level state machine for a client or server session.
+
+    A client (the initiator) sends Logon once connected; a server
+    session (the acceptor) waits for one, and replies with its own.
+    Once logged on, application messages are passed to the test, and:
+
+    * Heartbeats are consumed, and TestRequests answered,
+    * a MsgSeqNum gap is answered with a ResendRequest, and later
+      messages are dropped until it's filled,
+    * received ResendRequests are answered with SequenceReset-GapFill,
+    * SequenceResets move the expected MsgSeqNum,
+    * a MsgSeqNum lower than expected, without PossDupFlag, ends the
+      session, and
+    * a Logout is answered, and the session disconnected.
+
+    Application messages sent by the test before the Logon exchange
+    completes are held, and sent once it has."""
+
+    # Default HeartBtInt sent in Logon, in seconds.
+    DEFAULT_HEARTBEAT_INTERVAL = 30
+
+    # Time allowed for the peer's Logon, in seconds.
+    LOGON_TIMEOUT = 10
+
+    # Resent messages are written in batches of about this many bytes,
+    # until the write buffer pauses.
+    RESEND_BATCH_SIZE = 64 * 1024
+
+    def __init__(self, entity, initiator: bool, heartbeat: Heartbeat,
+                 sequence: SequenceNumbers, timers: TimerWheel):
+        """Constructor.
+
+        :param entity: Client or ServerSession.
+        :param initiator: True for a client, False for a server session.
+        :param heartbeat: Entity's heartbeat engine.
+        :param sequence: Entity's sequence numbers.
+        :param timers: Agent's shared timer wheel."""
+        self._entity = entity
+        self._initiator = initiator
+        self._heartbeat = heartbeat
+        self._sequence = sequence
+        self._timers = timers
+        self._journal = None
+        self._timer = None
+        self._state = DISCONNECTED
+        self._begin_string = b'FIX.4.2'
+        self._sender = None
+        self._target = None
+        self._heartbeat_interval = 0
+        self._resend_end = 0
+        self._resends = None
+        self._deferred = []
+        self._held = []
+        return
+
+    def state(self) -> str:
+        """Return the session state."""
+        return self._state
+
+    def is_active(self) -> bool:
+        """Return True once the Logon exchange is complete, and no
+        resend is in progress."""
+        return self._state == ACTIVE and self._resends is None
+
+    @staticmethod
+    def check_options(options: dict):
+        """Raise ValueError if a session-layer option's value is invalid.
+
+        :param options: As for configure()."""
+        for key in ("begin_string", "sender_comp_id", "target_comp_id"):
+            value = options.get(key)
+            if value is not None and not isinstance(value, str):
+                raise ValueError("Bad %s: %s" % (key, str(value)))
+        return
+
+    def configure(self, options: dict):
+        """Change session-layer options.
+
+        :param options: Dictionary of option names and values, as for
+        the entity.  Options not included are left unchanged.
+
+        Raises ValueError if an option's value is invalid."""
+        self.check_options(options)
+        if options.get("begin_string") is not None:
+            self._begin_string = options["begin_string"].encode()
+        if options.get("sender_comp_id") is not None:
+            self._sender = options["sender_comp_id"].encode()
+        if options.get("target_comp_id") is not None:
+            self._target = options["target_comp_id"].encode()
+        self._heartbeat_interval = options.get("heartbeat_interval",
+                                               self._heartbeat_interval)
+        return
+
+    def set_journal(self, journal: Journal):
+        """Answer ResendRequests from a journal.
+
+        :param journal: The entity's journal, or None."""
+        self._journal = journal
+        return
+
+    def connected(self):
+        """Start the session, once the entity is connected."""
+        self._resend_end = 0
+        self._timer = self._timers.schedule(self.LOGON_TIMEOUT,
+                                            self.logon_timeout)
+        if not self._initiator:
+            self._state = AWAITING_LOGON
+            return
+
+        if self._sender is None or self._target is None:
+            logging.warning("%s: Logon needs sender_comp_id and "
+                            "target_comp_id", self._sequence.name)
+        interval = self._heartbeat_interval or \
+            self.DEFAULT_HEARTBEAT_INTERVAL
+        logon = self.new_message(LOGON)
+        logon.append_pair(98, 0)
+        logon.append_pair(108, int(interval))
+        self.send(logon)
+        self._state = LOGON_SENT
+        return
+
+    def disconnected(self):
+        """Reset the session, once the entity is disconnected."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.stop_resend()
+        if self._held:
+            logging.info("%s: discarding %d messages held for Logon",
+                         self._sequence.name, len(self._held))
+            self._held = []
+        self._state = DISCONNECTED
+        return
+
+    def logon_timeout(self):
+        """Disconnect if the Logon exchange hasn't completed in time."""
+        self._timer = None
+        if self._state in (LOGON_SENT, AWAITING_LOGON):
+            logging.warning("%s: no Logon received; disconnecting",
+                            self._sequence.name)
+            self._entity.disconnect()
+        return
+
+    def hold(self, message: bytes):
+        """Hold an application message until the session is active.
+
+        :param message: Byte array of formatted FIX message."""
+        self._held.append(message)
+        return
+
+    def logout(self, text: str = None):
+        """Send Logout, if logged on.
+
+        :param text: Optional reason, sent as Text (58)."""
+        if self._state not in (ACTIVE, LOGON_SENT):
+            return
+
+        self.stop_resend()
+        logout = self.new_message(LOGOUT)
+        if text:
+            logout.append_pair(58, text)
+        self.send(logout)
+        self._state = LOGOUT_SENT
+        return
+
+    def received(self, wire: WireMessage) -> bool:
+        """Process a received message.
+
+        :param wire: Received FIX message.
+        :returns: True if it's an application message for the test."""
+        try:
+            message_type = wire.get(35)
+            sequence = wire.get(34)
+        except ValueError as e:
+            logging.warning("%s: malformed message: %s",
+                            self._sequence.name, str(e))
+            return True
+
+        if message_type == LOGON:
+            if not self.logon_received(wire, sequence):
+                return False
+        elif self._state in (LOGON_SENT, AWAITING_LOGON):
+            self.end("First message must be Logon")
+            return False
+
+        if message_type == SEQUENCE_RESET and wire.get(123) != b'Y':
+            self.sequence_reset(wire)
+            return False
+
+        if sequence is None or not sequence.isdigit():
+            self.end("Missing MsgSeqNum")
+            return False
+
+        sequence = int(sequence)
+        expected = self._sequence.next_receive
+        if sequence > expected:
+            # A Logon completes, and a ResendRequest is answered, before
+            # the gap is filled: the peer's recovery may depend on it.
+            if message_type == LOGON:
+                self.logged_on()
+            elif message_type == RESEND_REQUEST:
+                self.resend_requested(wire, sequence)
+            if not self._resend_end:
+                self._sequence.gaps.append((expected, sequence - 1))
+                request = self.new_message(RESEND_REQUEST)
+                request.append_pair(7, expected)
+                request.append_pair(16, 0)
+                self.send(request)
+            self._resend_end = max(self._resend_end, sequence)
+            if message_type == LOGOUT:
+                self.logout_received()
+            return False
+
+        if sequence < expected:
+            if wire.get(43) != b'Y':
+                self.end("MsgSeqNum too low, expecting %d but received %d"
+                         % (expected, sequence))
+            return False
+
+        self._sequence.next_receive = sequence + 1
+        if message_type == SEQUENCE_RESET:
+            self.sequence_reset(wire)
+        if self._sequence.next_receive > self._resend_end:
+            self._resend_end = 0
+
+        if message_type not in ADMIN_TYPES:
+            return True
+
+        if message_type == LOGON:
+            self.logged_on()
+        elif message_type == TEST_REQUEST:
+            self._heartbeat.send_heartbeat(wire.get(112))
+        elif message_type == RESEND_REQUEST:
+            self.resend_requested(wire, sequence)
+        elif message_type == LOGOUT:
+            self.logout_received()
+        return False
+
+    def logon_received(self, wire: WireMessage, sequence: bytes) -> bool:
+        """Handle the peer's Logon, before its MsgSeqNum is checked.
+
+        :param wire: Received Logon message.
+        :param sequence: Its MsgSeqNum (34) value.
+        :returns: False if the Logon is unexpected, and was dropped."""
+        if self._state not in (LOGON_SENT, AWAITING_LOGON):
+            logging.warning("%s: unexpected Logon", self._sequence.name)
+            return False
+
+        if wire.get(141) == b'Y' and sequence is not None and \
+                sequence.isdigit():
+            # ResetSeqNumFlag: both sides start again from one.
+            self._sequence.set(next_receive=int(sequence))
+            if not self._initiator:
+                self._sequence.set(next_send=1)
+
+        if self._initiator:
+            return True
+
+        # The acceptor takes its CompIDs and HeartBtInt from the Logon,
+        # unless configured.
+        if self._sender is None:
+            self._sender = wire.get(56)
+        if self._target is None:
+            self._target = wire.get(49)
+        self._begin_string = wire.get(8) or self._begin_string
+        interval = wire.get(108)
+        if not self._heartbeat_interval and interval and interval.isdigit():
+            self._heartbeat_interval = int(interval)
+
+        logon = self.new_message(LOGON)
+        logon.append_pair(98, 0)
+        logon.append_pair(108, int(self._heartbeat_interval))
+        if wire.get(141) == b'Y':
+            logon.append_pair(141, b'Y')
+        self.send(logon)
+        return True
+
+    def logged_on(self):
+        """Complete the Logon exchange."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        self._state = ACTIVE
+        self._heartbeat.set_header(self._begin_string, self._sender,
+                                   self._target)
+        self._entity.start_heartbeat(self._heartbeat_interval)
+        self.release_held()
+        return
+
+    def release_held(self):
+        """Send the messages held while the session wasn't active."""
+        held = self._held
+        self._held = []
+        for message in held:
+            self._entity.send_message(message)
+        return
+
+    def sequence_reset(self, wire: WireMessage):
+        """Move the expected MsgSeqNum, for a SequenceReset.
+
+        :param wire: Received SequenceReset message.
+
+        In GapFill mode, the NewSeqNo can't go backwards."""
+        new_sequence = wire.get(36)
+        if new_sequence is None or not new_sequence.isdigit():
+            logging.warning("%s: SequenceReset without NewSeqNo",
+                            self._sequence.name)
+            return
+
+        new_sequence = int(new_sequence)
+        if wire.get(123) == b'Y' and \
+                new_sequence < self._sequence.next_receive:
+            logging.warning("%s: SequenceReset-GapFill to %d, expecting %d",
+                            self._sequence.name, new_sequence,
+                            self._sequence.next_receive)
+            return
+        self._sequence.next_receive = new_sequence
+        return
+
+    def resend_requested(self, wire: WireMessage, sequence: int):
+        """Answer a received ResendRequest, or Reject it if malformed.
+
+        :param wire: Received ResendRequest message.
+        :param sequence: Its MsgSeqNum."""
+        begin = wire.get(7) or b'1'
+        end = wire.get(16) or b'0'
+        for tag, value in ((7, begin), (16, end)):
+            if not value.isdigit():
+                self.reject(sequence, tag, "Bad value for tag %d" % tag)
+                return
+        self.resend(int(begin), int(end))
+        return
+
+    def reject(self, sequence: int, tag: int, text: str):
+        """Send a Reject for a received message with a bad field.
+
+        :param sequence: MsgSeqNum of the rejected message.
+        :param tag: Tag of the bad field.
+        :param text: Explanation, for the peer's log."""
+        logging.warning("%s: rejecting message %d: %s",
+                        self._sequence.name, sequence, text)
+        reject = self.new_message(REJECT)
+        reject.append_pair(45, sequence)
+        reject.append_pair(371, tag)
+        # SessionRejectReason: incorrect data format for value.
+        reject.append_pair(373, 6)
+        reject.append_pair(58, text)
+        self.send(reject)
+        return
+
+    def resend(self, begin: int, end: int):
+        """Answer a ResendRequest.
+
+        :param begin: BeginSeqNo (7).
+        :param end: EndSeqNo (16), or zero for all.
+
+        The messages are written as the write buffer drains, and new
+        messages are held until they've all been sent.  A resend still
+        in progress is abandoned."""
+        next_send = self._sequence.next_send
+        if end == 0 or end >= next_send:
+            end = next_send - 1
+        if begin > end:
+            return
+
+        self.stop_resend()
+        self._resends = self.resend_messages(max(begin, 1), end)
+        self._entity.write_buffer().add_listener(self, self.write_state)
+        self.pump_resend()
+        return
+
+    def resend_messages(self, begin: int, end: int):
+        """Generate the stamped messages answering a ResendRequest.
+
+        :param begin: First MsgSeqNum to resend.
+        :param end: Last MsgSeqNum to resend.
+        :returns: Generator of message bytes.
+
+        Application messages are read from the journal one at a time,
+        and resent with PossDupFlag set.  Each run of session-level
+        messages, or of numbers not in the journal, is skipped with a
+        single SequenceReset-GapFill.  Without a journal, that's the
+        whole range."""
+        fill_from = begin
+        if self._journal is not None:
+            for sequence, message in self._journal.messages(SENT, begin,
+                                                            end):
+                if message_type(message) in ADMIN_TYPES:
+                    continue
+                if sequence > fill_from:
+                    yield self.gap_fill(fill_from, sequence)
+                yield self._sequence.stamp(message, sequence, True)
+                fill_from = sequence + 1
+
+        if fill_from <= end:
+            yield self.gap_fill(fill_from, end + 1)
+        return
+
+    def gap_fill(self, sequence: int, new_sequence: int) -> bytes:
+        """Return a stamped SequenceReset-GapFill message.
+
+        :param sequence: Its MsgSeqNum: the first number skipped.
+        :param new_sequence: NewSeqNo (36): the next number not skipped."""
+        gap_fill = self.new_message(SEQUENCE_RESET)
+        gap_fill.append_pair(43, b'Y', header=True)
+        gap_fill.append_pair(123, b'Y')
+        gap_fill.append_pair(36, new_sequence)
+        return self._sequence.stamp(gap_fill.encode(), sequence)
+
+    def pump_resend(self):
+        """Write resent messages until done, or the write buffer pauses."""
+        writer = self._entity.write_buffer()
+        while self._resends is not None and not writer.is_paused():
+            batch = []
+            size = 0
+            for message in self._resends:
+                batch.append(message)
+                size += len(message)
+                if size >= self.RESEND_BATCH_SIZE:
+                    break
+
+            if not batch:
+                deferred = self._deferred
+                self.stop_resend()
+                for message in deferred:
+                    self.send(message)
+                self.release_held()
+                return
+
+            data = b''.join(batch)
+            try:
+                writer.write(data)
+            except OSError:
+                self.stop_resend()
+                return
+            self._heartbeat.sent(data, True)
+            self._entity.record(SENT, data, False)
+        return
+
+    def write_state(self, paused: bool, buffered: int):
+        """Continue a resend when the write buffer resumes.
+
+        :param paused: True if the buffer paused, False if it resumed.
+        :param buffered: Number of bytes buffered."""
+        if not paused and self._state != DISCONNECTED:
+            self.pump_resend()
+        return
+
+    def stop_resend(self):
+        """Abandon any resend in progress, and the session-level
+        messages waiting for it."""
+        self._deferred = []
+        if self._resends is None:
+            return
+
+        self._resends.close()
+        self._resends = None
+        self._entity.write_buffer().remove_listener(self)
+        return
+
+    def logout_received(self):
+        """Answer the peer's Logout, and disconnect."""
+        if self._state != LOGOUT_SENT:
+            self.stop_resend()
+            self.send(self.new_message(LOGOUT))
+            self._state = LOGOUT_SENT
+        self._entity.disconnect()
+        return
+
+    def end(self, text: str):
+        """End the session after a session-level error.
+
+        :param text: Reason, sent in the Logout message."""
+        logging.warning("%s: %s", self._sequence.name, text)
+        self.logout(text)
+        self._entity.disconnect()
+        return
+
+    def new_message(self, message_type: bytes) -> simplefix.FixMessage:
+        """Return a new session-level message, with its header.
+
+        :param message_type: MsgType (35) value."""
+        message = simplefix.FixMessage()
+        message.append_pair(8, self._begin_string, header=True)
+        message.append_pair(35, message_type, header=True)
+        message.append_pair(49, self._sender or b'', header=True)
+        message.append_pair(56, self._target or b'', header=True)
+        return message
+
+    def send(self, message: simplefix.FixMessage, sequence: int = None):
+        """Stamp and send a session-level message.
+
+        :param message: Message to send.
+        :param sequence: MsgSeqNum, for a resent message, or None to
+        use the next one.
+
+        While a resend is in progress, new messages wait for it to
+        finish, so MsgSeqNums stay in order."""
+        if sequence is None and self._resends is not None:
+            self._deferred.append(message)
+            return
+
+        data = self._sequence.stamp(message.encode(), sequence)
+        self._entity.write_buffer().write(data)
+        self._heartbeat.sent(data, True)
+        self._entity.record(SENT, data, sequence is None)
+        return
@@ -0,0 +1,429 @@
+#! /usr/bin/env python3
+##################################################################
+# fixtool
+# Copyright (C) 2018, David Arnold.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##################################################################
+
+"""Shared memory ring buffers for FIX message payloads.
+
+A channel carries messages in both directions between a proxy and an
+agent on the same host, without passing them through the control
+session.  It consists of a memory-mapped file, holding two
+single-producer, single-consumer ring buffers, and a named pipe used by
+the proxy to wake the agent when it has written to its ring.
+
+Each ring buffer has a header, followed by its data area.  The header
+holds the producer's position and message count, and (on a separate
+cache line) the consumer's position and message count.  Positions are
+byte offsets that only ever increase; they're reduced modulo the data
+area size to index into the buffer.
+
+Each message is written as a four byte little-endian length, followed
+by the message itself.  A message is never split across the end of the
+data area: if it won't fit, a wrap marker is written (if there's room
+for one) and the message is written at the start of the area."""
+
+import itertools
+import mmap
+import os
+import re
+import stat
+import struct
+import sys
+import tempfile
+import time
+
+
+# Header layout.
+POSITION = struct.Struct("<QQ")
+PRODUCER_OFFSET = 0
+CONSUMER_OFFSET = 64
+HEADER_SIZE = 128
+
+# Message length prefix.
+LENGTH = struct.Struct("<L")
+WRAP_MARKER = 0xffffffff
+
+# Default, and minimum, size of each ring's data area.
+DEFAULT_RING_SIZE = 1024 * 1024
+MIN_RING_SIZE = 64
+
+# Default maximum time to wait for room in a full ring, in seconds.
+DEFAULT_SEND_TIMEOUT = 10.0
+
+# Distinguishes channels created by this process.
+_channel_ids = itertools.count(1)
+
+# Name of a channel's file, as created by temporary_path().
+CHANNEL_NAME = re.compile(r"fixtool-[0-9]+-[0-9]+\.shm\Z")
+
+
+def channel_directory() -> str:
+    """Return the directory holding channel files."""
+    return "/tmp" if sys.platform == "darwin" else tempfile.gettempdir()
+
+
+def temporary_path() -> str:
+    """Return an unused path name for a new channel's file."""
+    return os.path.join(channel_directory(), "fixtool-%d-%d.shm"
+                        % (os.getpid(), next(_channel_ids)))
+
+
+def check_channel(path: str, ring_size: int):
+    """Raise ValueError unless a channel could have been created by a
+    proxy, with temporary_path().
+
+    :param path: Path name of the channel's file.
+    :param ring_size: Size of each ring's data area, in bytes.
+
+    The agent maps and writes the file, so it mustn't be anything
+    else."""
+    if not isinstance(path, str) or \
+            os.path.dirname(path) != channel_directory() or \
+            not CHANNEL_NAME.match(os.path.basename(path)):
+        raise ValueError("Not a channel file: %s" % str(path))
+    if not isinstance(ring_size, int) or isinstance(ring_size, bool) or \
+            ring_size < MIN_RING_SIZE:
+        raise ValueError("Bad ring size: %s" % str(ring_size))
+    return
+
+
+class RingBuffer(object):
+    """Single-producer, single-consumer ring buffer of messages."""
+
+    def __init__(self, buffer, offset: int, size: int):
+        """Constructor.
+
+        :param buffer: Shared buffer (usually an mmap) holding the ring.
+        :param offset: Offset of the ring's header within the buffer.
+        :param size: Size of the ring's data area, in bytes."""
+        self._buffer = buffer
+        self._offset = offset
+        self._data = offset + HEADER_SIZE
+        self._size = size
+        return
+
+    @staticmethod
+    def total_size(size: int) -> int:
+        """Return space needed for a ring with a data area of this size."""
+        return HEADER_SIZE + size
+
+    def _producer(self):
+        return POSITION.unpack_from(self._buffer,
+                                    self._offset + PRODUCER_OFFSET)
+
+    def _consumer(self):
+        return POSITION.unpack_from(self._buffer,
+                                    self._offset + CONSUMER_OFFSET)
+
+    def count(self) -> int:
+        """Return the number of messages waiting in the ring."""
+        _, produced = self._producer()
+        _, consumed = self._consumer()
+        return produced - consumed
+
+    def is_empty(self) -> bool:
+        """Return True if there are no messages waiting in the ring."""
+        return self.count() == 0
+
+    def write(self, message: bytes) -> bool:
+        """(Producer) Append a message to the ring.
+
+        :param message: Byte array to append.
+        :returns: False if there wasn't room for the message."""
+        needed = LENGTH.size + len(message)
+        if needed > self._size:
+            raise ValueError("Message too large for ring buffer")
+
+        head, produced = self._producer()
+        tail, _ = self._consumer()
+
+        index = head % self._size
+        skip = 0
+        if index + needed > self._size:
+            skip = self._size - index
+        if needed + skip > self._size - (head - tail):
+            return False
+
+        if skip:
+            if skip >= LENGTH.size:
+                LENGTH.pack_into(self._buffer, self._data + index, WRAP_MARKER)
+            head += skip
+            index = 0
+
+        start = self._data + index
+        LENGTH.pack_into(self._buffer, start, len(message))
+        self._buffer[start + LENGTH.size:start + needed] = message
+
+        # Publish the message only once it has been completely written.
+        POSITION.pack_into(self._buffer, self._offset + PRODUCER_OFFSET,
+                           head + needed, produced + 1)
+        return True
+
+    def write_many(self, messages: list) -> int:
+        """(Producer) Append several messages to the ring.
+
+        :param messages: List of byte arrays to append, in order.
+        :returns: The number of messages written."""
+        written = 0
+        for message in messages:
+            if not self.write(message):
+                break
+            written += 1
+        return written
+
+    def read(self):
+        """(Consumer) Remove and return the first message in the ring.
+
+        :returns: Byte array, or None if the ring is empty."""
+        head, _ = self._producer()
+        tail, consumed = self._consumer()
+        if head == tail:
+            return None
+
+        index = tail % self._size
+        if self._size - index < LENGTH.size or \
+                LENGTH.unpack_from(self._buffer,
+                                   self._data + index)[0] == WRAP_MARKER:
+            tail += self._size - index
+            index = 0
+
+        start = self._data + index
+        length = LENGTH.unpack_from(self._buffer, start)[0]
+        message = bytes(self._buffer[start + LENGTH.size:
+                                     start + LENGTH.size + length])
+
+        POSITION.pack_into(self._buffer, self._offset + CONSUMER_OFFSET,
+                           tail + LENGTH.size + length, consumed + 1)
+        return message
+
+    def read_many(self, max_count: int = None, max_bytes: int = None):
+        """(Consumer) Remove and return messages from the ring.
+
+        :param max_count: Maximum number of messages to return, or None.
+        :param max_bytes: Maximum total size of the returned messages, or
+        None.  The first message is always returned, even if it is larger
+        than this limit.
+        :returns: List of byte arrays, possibly empty."""
+        messages = []
+        total = 0
+        while max_count is None or len(messages) < max_count:
+            length = self.peek_length()
+            if length is None:
+                break
+            if max_bytes is not None and messages and \
+                    total + length > max_bytes:
+                break
+            messages.append(self.read())
+            total += length
+        return messages
+
+    def peek_length(self):
+        """(Consumer) Return the length of the first message in the ring.
+
+        :returns: Length in bytes, or None if the ring is empty."""
+        head, _ = self._producer()
+        tail, _ = self._consumer()
+        if head == tail:
+            return None
+
+        index = tail % self._size
+        if self._size - index >= LENGTH.size:
+            length = LENGTH.unpack_from(self._buffer, self._data + index)[0]
+            if length != WRAP_MARKER:
+                return length
+        return LENGTH.unpack_from(self._buffer, self._data)[0]
+
+
+class SharedChannel(object):
+    """Pair of ring buffers, shared between a proxy and an agent.
+
+    The proxy writes messages to be sent into the 'outbound' ring, and
+    reads received messages from the 'inbound' ring.  The agent does the
+    reverse."""
+
+    def __init__(self, path: str, ring_size: int, create: bool):
+        """(Internal) Constructor.
+
+        Use SharedChannel.create() or SharedChannel.open()."""
+        self._path = path
+        self._ring_size = ring_size
+        self._doorbell_path = path + ".bell"
+        self._doorbell = None
+
+        total = 2 * RingBuffer.total_size(ring_size)
+        flags = os.O_RDWR | (os.O_CREAT | os.O_EXCL if create
+                             else os.O_NOFOLLOW)
+        fd = os.open(path, flags, 0o600)
+        try:
+            if create:
+                os.ftruncate(fd, total)
+            else:
+                info = os.fstat(fd)
+                if not stat.S_ISREG(info.st_mode) or \
+                        info.st_uid != os.geteuid() or \
+                        info.st_size != total:
+                    raise ValueError("Channel file doesn't match: %s"
+                                     % path)
+            self._mmap = mmap.mmap(fd, total)
+        finally:
+            os.close(fd)
+
+        self.outbound = RingBuffer(self._mmap, 0, ring_size)
+        self.inbound = RingBuffer(self._mmap,
+                                  RingBuffer.total_size(ring_size),
+                                  ring_size)
+        return
+
+    @staticmethod
+    def create(path: str, ring_size: int = DEFAULT_RING_SIZE):
+        """(Proxy) Create a new channel.
+
+        :param path: Path name for the channel's file.
+        :param ring_size: Size of each ring's data area, in bytes."""
+        channel = SharedChannel(path, ring_size, True)
+        os.mkfifo(channel._doorbell_path, 0o600)
+        return channel
+
+    @staticmethod
+    def open(path: str, ring_size: int = DEFAULT_RING_SIZE):
+        """(Agent) Open an existing channel.
+
+        :param path: Path name of the channel's file.
+        :param ring_size: Size of each ring's data area, in bytes.
+
+        Raises ValueError if the file isn't a channel of this size, or
+        OSError if it can't be opened."""
+        check_channel(path, ring_size)
+        channel = SharedChannel(path, ring_size, False)
+
+        # Opening for both reading and writing means the pipe never
+        # reports end-of-file, even when the proxy isn't attached.
+        try:
+            doorbell = os.open(channel._doorbell_path,
+                               os.O_RDWR | os.O_NONBLOCK | os.O_NOFOLLOW)
+            channel._doorbell = doorbell
+            if not stat.S_ISFIFO(os.fstat(doorbell).st_mode):
+                raise ValueError("Not a doorbell pipe: %s"
+                                 % channel._doorbell_path)
+        except (OSError, ValueError):
+            channel.close()
+            raise
+        return channel
+
+    def path(self) -> str:
+        """Return the path name of the channel's file."""
+        return self._path
+
+    def ring_size(self) -> int:
+        """Return the size of each ring's data area."""
+        return self._ring_size
+
+    def doorbell(self) -> int:
+        """Return the file descriptor of the channel's doorbell pipe."""
+        return self._doorbell
+
+    def connect_doorbell(self):
+        """(Proxy) Open the doorbell pipe, once the agent has opened it."""
+        self._doorbell = os.open(self._doorbell_path,
+                                 os.O_WRONLY | os.O_NONBLOCK)
+        return
+
+    def ring(self):
+        """(Proxy) Wake the agent to read the outbound ring."""
+        try:
+            os.write(self._doorbell, b'\x01')
+        except BlockingIOError:
+            # Pipe is full, so the agent will wake up anyway.
+            pass
+        return
+
+    def send(self, messages: list, timeout: float = DEFAULT_SEND_TIMEOUT,
+             alive=None):
+        """(Proxy) Write messages to the outbound ring, and wake the agent.
+
+        :param messages: List of byte arrays to write, in order.
+        :param timeout: If the ring is full, the maximum time to wait
+        for the agent to make room, in seconds.
+        :param alive: Optional callable returning False once the agent
+        has gone away, checked while waiting.
+
+        Raises TimeoutError if there's no room in time, and
+        ConnectionError if the agent has gone away or closed its end
+        of the doorbell.  Messages already written are not withdrawn."""
+        deadline = time.monotonic() + timeout
+        for message in messages:
+            while not self.outbound.write(message):
+                self.ring()
+                if time.monotonic() > deadline:
+                    raise TimeoutError("No room in channel %s" % self._path)
+                if alive is not None and not alive():
+                    raise ConnectionError("Agent has gone away")
+                time.sleep(0)
+        self.ring()
+        return
+
+    def receive(self, timeout: float = None):
+        """(Proxy) Read a message from the inbound ring.
+
+        :param timeout: If the ring is empty, the maximum time to wait
+        for a message, in seconds.
+        :returns: Byte array, or None if no message arrived in time.
+
+        Waiting spins, rather than sleeping, to minimise latency."""
+        message = self.inbound.read()
+        if message is not None or not timeout:
+            return message
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            message = self.inbound.read()
+            if message is not None:
+                return message
+            time.sleep(0)
+        return self.inbound.read()
+
+    def clear(self):
+        """(Agent) Discard any pending doorbell notifications."""
+        try:
+            while os.read(self._doorbell, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return
+
+    def close(self):
+        """Unmap the channel, and close the doorbell pipe."""
+        if self._doorbell is not None:
+            os.close(self._doorbell)
+            self._doorbell = None
+        self._mmap.close()
+        return
+
+    def unlink(self):
+        """(Proxy) Remove the channel's file and doorbell pipe."""
+        for path in (self._path, self._doorbell_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        return
@@ -0,0 +1,221 @@
+#! /usr/bin/env python3
+##################################################################
+# fixtool
+# Copyright (C) 2018, David Arnold.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##################################################################
+
+"""Hierarchical timer wheel.
+
+A single wheel holds the timers for every session in the agent, rather
+than each session having its own event loop timer.  Time is divided
+into ticks, and the wheel has several levels of slots: the first has
+one slot per tick, and each following level's slots span a whole
+revolution of the level below it.  A timer is placed in the lowest
+level whose range covers its expiry.  Each time a level's index wraps,
+the next slot of the level above is emptied, and its timers are placed
+again, now in lower levels.
+
+Scheduling and cancelling a timer are O(1), and so is each tick, apart
+from the timers expiring or moving down a level.  The wheel is driven
+by one event loop timer per tick, and only while it holds timers."""
+
+import asyncio
+import math
+
+
+# Number of bits in each level's slot index: 256 slots in the first
+# level, and 64 in each of the others.
+LEVEL_BITS = (8, 6, 6, 6)
+
+
+class Timer(object):
+    """A scheduled callback, returned by TimerWheel.schedule()."""
+
+    __slots__ = ("wheel", "expires", "callback", "args", "slot")
+
+    def __init__(self, wheel, expires: int, callback, args: tuple):
+        """Constructor.
+
+        :param wheel: TimerWheel holding the timer.
+        :param expires: Tick at which the timer expires.
+        :param callback: Function called on expiry.
+        :param args: Arguments for the callback."""
+        self.wheel = wheel
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.slot = None
+        return
+
+    def is_active(self) -> bool:
+        """Return True if the timer has neither expired nor been
+        cancelled."""
+        return self.slot is not None
+
+    def cancel(self):
+        """Cancel the timer, if it's still active."""
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.cancelled()
+        return
+
+
+class TimerWheel(object):
+    """Timers for many sessions, driven by a single event loop timer."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None,
+                 resolution: float = 0.1):
+        """Constructor.
+
+        :param loop: Event loop, or None for the current event loop.
+        :param resolution: Length of a tick, in seconds.  Timers expire
+        at most one tick late, and never early."""
+        self._loop = loop or asyncio.get_event_loop()
+        self._resolution = resolution
+        self._start = self._loop.time()
+        self._current = 0
+        self._levels = [[set() for _ in range(1 << bits)]
+                        for bits in LEVEL_BITS]
+        self._max_ticks = (1 << sum(LEVEL_BITS)) - 1
+        self._count = 0
+        self._handle = None
+        return
+
+    def __len__(self):
+        return self._count
+
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Return the event loop driving the wheel."""
+        return self._loop
+
+    def resolution(self) -> float:
+        """Return the length of a tick, in seconds."""
+        return self._resolution
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        """Call a function after a delay.
+
+        :param delay: Delay, in seconds.
+        :param callback: Function to call.
+        :param args: Arguments for the function.
+        :returns: Timer, which can be cancelled."""
+        now = self._loop.time() - self._start
+        expires = int(math.ceil((now + delay) / self._resolution))
+        timer = Timer(self, max(expires, self._current + 1), callback, args)
+        self.insert(timer)
+        self.start()
+        return timer
+
+    def cancelled(self):
+        """Account for a timer being cancelled."""
+        self._count -= 1
+        if not self._count:
+            self.stop()
+        return
+
+    def elapsed_ticks(self) -> int:
+        """Return the number of whole ticks since the wheel started."""
+        now = self._loop.time()
+        return max(self._current,
+                   int((now - self._start) / self._resolution))
+
+    def insert(self, timer: Timer):
+        """Place a timer in the slot covering its expiry.
+
+        :param timer: Timer to insert."""
+        delta = timer.expires - self._current
+        if delta > self._max_ticks:
+            timer.expires = self._current + self._max_ticks
+            delta = self._max_ticks
+
+        shift = 0
+        for level, bits in enumerate(LEVEL_BITS):
+            if delta < (1 << (shift + bits)) or \
+                    level == len(LEVEL_BITS) - 1:
+                index = (timer.expires >> shift) & ((1 << bits) - 1)
+                slot = self._levels[level][index]
+                break
+            shift += bits
+
+        slot.add(timer)
+        timer.slot = slot
+        self._count += 1
+        return
+
+    def start(self):
+        """Schedule the next tick, if there are timers and it isn't
+        already scheduled."""
+        if self._handle is None and self._count:
+            when = self._start + (self._current + 1) * self._resolution
+            self._handle = self._loop.call_at(when, self.tick)
+        return
+
+    def stop(self):
+        """Stop ticking.  Timers remain scheduled until start()."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        return
+
+    def tick(self):
+        """Process each tick up to the current time."""
+        self._handle = None
+        target = self.elapsed_ticks()
+        while self._current < target and self._count:
+            self._current += 1
+            self.cascade()
+
+            slot = self._levels[0][self._current & ((1 << LEVEL_BITS[0])
+                                                    - 1)]
+            # Each timer is removed just before it's called, so a
+            # callback can still cancel the others.
+            for timer in list(slot):
+                if timer.slot is not slot:
+                    continue
+                slot.discard(timer)
+                timer.slot = None
+                self._count -= 1
+                timer.callback(*timer.args)
+
+        if not self._count:
+            self._current = max(self._current, target)
+        self.start()
+        return
+
+    def cascade(self):
+        """Move timers down from higher levels, where lower ones wrap."""
+        shift = 0
+        for level in range(1, len(LEVEL_BITS)):
+            shift += LEVEL_BITS[level - 1]
+            if self._current & ((1 << shift) - 1):
+                break
+
+            index = (self._current >> shift) & ((1 << LEVEL_BITS[level]) - 1)
+            slot = self._levels[level][index]
+            if slot:
+                timers = list(slot)
+                slot.clear()
+                self._count -= len(timers)
+                for timer in timers:
+                    self.insert(timer)
+        return
@@ -23,9 +23,35 @@
 #
 ##################################################################
 
+import asyncio
 import fixtool
+import glob
+import os
 import simplefix
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+
+from fixtool.agent import ControlSession, ReceiveQueue, new_event_loop
+from fixtool.framing import FixFramer, WireMessage, message_type
+from fixtool.framing import sequence_number, stamp
+from fixtool.heartbeat import Heartbeat
+from fixtool.journal import RECEIVED, SENT, Journal
+from fixtool.message import JOURNAL_MAX_COUNT, BadRequestMessage
+from fixtool.message import ClientIsConnectedRequest
+from fixtool.message import ClientAttachMessage, ClientConnectMessage
+from fixtool.message import ClientJournalRequest, ServerDestroyMessage
+from fixtool.message import OP_CLIENT_GET, OP_CLIENT_GET_ALL
+from fixtool.message import ServerPendingAcceptCountRequest
+from fixtool.message import SessionGetMessage
+from fixtool.router import FixToolRouter
+from fixtool.session import SequenceNumbers, SessionLayer
+from fixtool.shmring import SharedChannel, temporary_path
+from fixtool.timerwheel import TimerWheel
 
 
 class BasicTests(unittest.TestCase):
@@ -36,6 +62,52 @@ class BasicTests(unittest.TestCase):
     def tearDown(self):
         return
 
+    @staticmethod
+    def socket_owners(port: int):
+        """Count the established TCP connections on a local port, by
+        the process that owns each one.
+
+        :param port: Local port number.
+        :returns: Dictionary of counts, by process ID, or None if this
+        can't be found from /proc."""
+        inodes = set()
+        for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+            if not os.path.exists(table):
+                continue
+            with open(table) as f:
+                for line in f.readlines()[1:]:
+                    fields = line.split()
+                    local_port = int(fields[1].split(":")[1], 16)
+                    if local_port == port and fields[3] == "01":
+                        inodes.add("socket:[%s]" % fields[9])
+        if not inodes:
+            return None
+
+        owners = {}
+        for pid in filter(str.isdigit, os.listdir("/proc")):
+            try:
+                fds = os.listdir("/proc/%s/fd" % pid)
+                links = [os.readlink("/proc/%s/fd/%s" % (pid, fd))
+                         for fd in fds]
+            except OSError:
+                continue
+            count = len([link for link in links if link in inodes])
+            if count:
+                owners[int(pid)] = count
+        return owners
+
+    def wait_until(self, condition, timeout: float = 5):
+        """Poll until condition() is true, failing after timeout seconds.
+
+        :param condition: Function returning True once done.
+        :param timeout: Maximum time to wait, in seconds."""
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() >= deadline:
+                self.fail("Timed out after %s seconds" % timeout)
+            time.sleep(0.01)
+        return
+
     def test_spawn(self):
         proxy = fixtool.spawn_agent()
         self.assertIsNotNone(proxy)
@@ -43,6 +115,55 @@ class BasicTests(unittest.TestCase):
         proxy.shutdown()
         return
 
+    def test_new_event_loop(self):
+        loop, name = new_event_loop()
+        self.assertEqual("asyncio", name)
+        self.assertIsInstance(loop, asyncio.AbstractEventLoop)
+        loop.close()
+
+        try:
+            import uvloop
+        except ImportError:
+            # Falls back to asyncio, and says so.
+            with self.assertLogs(level="WARNING"):
+                loop, name = new_event_loop("uvloop")
+            self.assertEqual("asyncio", name)
+            self.assertIsInstance(loop, asyncio.AbstractEventLoop)
+        else:
+            loop, name = new_event_loop("uvloop")
+            self.assertEqual("uvloop", name)
+            self.assertIsInstance(loop, uvloop.Loop)
+        loop.close()
+        return
+
+    def test_spawn_event_loop(self):
+        # Falls back to asyncio if uvloop isn't installed.
+        proxy = fixtool.spawn_agent("uvloop")
+        self.assertIsNotNone(proxy)
+
+        c1 = proxy.create_client("c1")
+        self.assertFalse(c1.is_connected())
+        proxy.shutdown()
+        return
+
+    def test_spawn_unix_socket(self):
+        if not hasattr(socket, "AF_UNIX"):
+            self.skipTest("Unix domain sockets not supported")
+
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+        self.assertIsNotNone(proxy._unix_path)
+
+        other = fixtool.connect_agent(unix_path=proxy._unix_path)
+        c1 = other.create_client("c1")
+        self.assertFalse(c1.is_connected())
+
+        path = proxy._unix_path
+        proxy.shutdown()
+        while os.path.exists(path):
+            time.sleep(0.01)
+        return
+
     def test_create_server(self):
         proxy = fixtool.spawn_agent()
         self.assertIsNotNone(proxy)
@@ -76,6 +197,1650 @@ class BasicTests(unittest.TestCase):
         proxy.shutdown()
         return
 
+    def test_session_names(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        s1 = proxy.create_server("s1")
+        port = s1.listen(0)
+        c1 = proxy.create_client("c1")
+        c1.connect('localhost', port)
+        c2 = proxy.create_client("c2")
+        c2.connect('localhost', port)
+        self.assertEqual(2, s1.wait_for_pending_accept(5))
+
+        # A name can't be reused while its session exists.
+        cs1 = s1.accept("cs1")
+        self.assertRaises(RuntimeError, s1.accept, "cs1")
+        self.assertEqual(1, s1.pending_accept_count())
+        cs1.disconnect()
+        self.assertRaises(RuntimeError, s1.accept, "cs1")
+
+        # Destroying the server releases its sessions' names.
+        request_id = proxy.send_request(ServerDestroyMessage("s1"))
+        self.assertTrue(proxy.await_response(request_id).result)
+        self.assertRaises(RuntimeError, cs1.is_connected)
+
+        s2 = proxy.create_server("s2")
+        c1.connect('localhost', s2.listen(0))
+        self.assertEqual(1, s2.wait_for_pending_accept(5))
+        cs1 = s2.accept("cs1")
+        self.assertTrue(cs1.is_connected())
+
+        c1.destroy()
+        c2.destroy()
+        s2.destroy()
+        proxy.shutdown()
+        return
+
+    def test_client_connect_failure(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        # Find a port with no listener.
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        port = peer.getsockname()[1]
+        peer.close()
+
+        c1 = proxy.create_client("c1")
+        self.assertRaises(RuntimeError, c1.connect, 'localhost', port)
+        self.assertFalse(c1.is_connected())
+
+        # The client can still connect after a failure.
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+        c1.connect('localhost', peer.getsockname()[1], timeout=5)
+        self.assertTrue(c1.is_connected())
+
+        peer.close()
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_client_connect_requests(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        c1 = proxy.create_client("c1")
+        for host, port, timeout in ((None, 1, None), ("localhost", None, None),
+                                    ("localhost", "1", None),
+                                    ("localhost", 70000, None),
+                                    ("localhost", 1, -1)):
+            request_id = proxy.send_request(
+                ClientConnectMessage("c1", host, port, timeout))
+            self.assertFalse(proxy.await_response(request_id).result)
+
+        # A full backlog leaves the next connection waiting.
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(0)
+        port = peer.getsockname()[1]
+        queued = socket.create_connection(('localhost', port))
+
+        first = proxy.send_request(ClientConnectMessage("c1", "localhost",
+                                                        port, 10))
+        second = proxy.send_request(ClientConnectMessage("c1", "localhost",
+                                                         port, 10))
+        response = proxy.await_response(second)
+        self.assertFalse(response.result)
+        self.assertIn("connecting", response.message)
+
+        # Destroyed while connecting, so the connection is closed.
+        c1.destroy()
+        sock, _ = peer.accept()
+        sock.close()
+        response = proxy.await_response(first)
+        self.assertFalse(response.result)
+        self.assertIn("destroyed", response.message)
+        sock, _ = peer.accept()
+        self.assertEqual(b"", sock.recv(100))
+
+        sock.close()
+        queued.close()
+        peer.close()
+        proxy.shutdown()
+        return
+
+    def test_settle(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        c1 = proxy.create_client("c1")
+        c1.connect('localhost', peer.getsockname()[1])
+        sock, _ = peer.accept()
+
+        # More than one read's worth, already received by the kernel.
+        messages = []
+        for seq in range(1, 3):
+            fix_msg = simplefix.FixMessage()
+            fix_msg.append_pair(8, "FIX.4.2")
+            fix_msg.append_pair(35, "8")
+            fix_msg.append_pair(34, seq)
+            fix_msg.append_pair(58, "x" * 40000)
+            messages.append(fix_msg.encode())
+        sock.sendall(b''.join(messages))
+        self.assertEqual(len(messages), c1.receive_queue_length())
+        self.assertEqual(messages, c1.receive_all())
+
+        sock.close()
+        peer.close()
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_write_watermarks(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        c1 = proxy.create_client("c1")
+        c1.connect('localhost', peer.getsockname()[1])
+        sock, _ = peer.accept()
+
+        self.assertRaises(RuntimeError, c1.configure,
+                          write_high_watermark=10, write_low_watermark=20)
+
+        # A bad option leaves the others unchanged too.
+        self.assertRaises(RuntimeError, c1.configure, queue_capacity=1,
+                          queue_policy="drop_oldest",
+                          write_high_watermark=10, write_low_watermark=20)
+        self.assertRaises(RuntimeError, c1.configure, queue_capacity=1,
+                          queue_policy="drop_oldest", raw=True,
+                          session_layer=True)
+        sock.sendall(b"8=FIX.4.2\x019=5\x0135=0\x0110=163\x01" * 3)
+        self.wait_until(lambda: c1.receive_queue_length() == 3)
+        self.assertEqual(3, len(c1.receive_all()))
+
+        c1.configure(write_high_watermark=1024 * 1024,
+                     write_low_watermark=1024)
+        reports = []
+        watch = c1.watch_writes(lambda p, b: reports.append(p))
+
+        # The peer isn't reading, so the agent has to buffer.
+        fix_msg = simplefix.FixMessage()
+        fix_msg.append_pair(8, "FIX.4.2")
+        fix_msg.append_pair(35, "D")
+        fix_msg.append_pair(58, "x" * 60000)
+        message = fix_msg.encode()
+        total = 0
+        while not watch.is_paused():
+            c1.send(message)
+            total += len(message)
+        self.assertEqual([True], reports)
+        self.assertTrue(c1.is_connected())
+
+        received = 0
+        while received < total:
+            received += len(sock.recv(1024 * 1024))
+        while watch.is_paused():
+            proxy.poll(0.1)
+        self.assertEqual([True, False], reports)
+
+        sock.close()
+        peer.close()
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_pipelined_requests(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        c1 = proxy.create_client("c1")
+
+        id1 = proxy.send_request(ClientIsConnectedRequest("c1"))
+        id2 = proxy.send_request(ClientIsConnectedRequest("c2"))
+        self.assertNotEqual(id1, id2)
+
+        # Collect responses in the opposite order to the requests.
+        r2 = proxy.await_response(id2)
+        self.assertEqual(id2, r2.request_id)
+        self.assertFalse(r2.result)
+
+        r1 = proxy.await_response(id1)
+        self.assertEqual(id1, r1.request_id)
+        self.assertTrue(r1.result)
+        self.assertFalse(r1.connected)
+
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_control_session_frames(self):
+        frames = [b'{"type": "a"}', b'', b'{"type": "bc"}']
+        stream = b''.join(struct.pack(">L", len(f)) + f for f in frames)
+
+        # Every split point, including within the length headers.
+        for split in range(len(stream) + 1):
+            session = ControlSession(None)
+            received = session.append_bytes(stream[:split])
+            received += session.append_bytes(stream[split:])
+            self.assertEqual(frames, received)
+            self.assertEqual([], session.append_bytes(b''))
+
+        # A byte at a time.
+        session = ControlSession(None)
+        received = []
+        for i in range(len(stream)):
+            received += session.append_bytes(stream[i:i + 1])
+        self.assertEqual(frames, received)
+        return
+
+    def test_control_session_buffer(self):
+        small = b'x' * 1000
+        large = b'y' * (ControlSession.INITIAL_BUFFER_SIZE * 3)
+        stream = b''.join(struct.pack(">L", len(f)) + f
+                          for f in [small, large, small])
+
+        # Read through the reused buffer, as a buffered protocol does.
+        session = ControlSession(None)
+        received = []
+        offset = 0
+        while offset < len(stream):
+            view = session.get_buffer(-1)
+            nbytes = min(len(view), len(stream) - offset, 5000)
+            view[:nbytes] = stream[offset:offset + nbytes]
+            view.release()
+            received += session.buffer_updated(nbytes)
+            offset += nbytes
+        self.assertEqual([small, large, small], received)
+        return
+
+    def test_fix_framer(self):
+        fix_msg = simplefix.FixMessage()
+        fix_msg.append_pair(8, "FIX.4.2")
+        fix_msg.append_pair(35, "D")
+        fix_msg.append_pair(58, "8=FIX")
+        message = fix_msg.encode()
+        stream = message + message
+
+        # Every split point.
+        for split in range(len(stream) + 1):
+            framer = FixFramer()
+            received = framer.append_buffer(stream[:split])
+            received += framer.append_buffer(stream[split:])
+            self.assertEqual([message, message], received)
+            self.assertEqual(b'', framer.pending())
+
+        # Leading junk, and a message with a bad BodyLength, are skipped.
+        framer = FixFramer()
+        received = framer.append_buffer(b"junk" + message +
+                                        b"8=FIX.4.2\x019=5\x01oops" +
+                                        message + message[:10])
+        self.assertEqual([message, message], received)
+        self.assertEqual(message[:10], framer.pending())
+
+        # An oversized BodyLength, or an unterminated CheckSum, doesn't
+        # hold up the messages after it.
+        framer = FixFramer()
+        received = framer.append_buffer(b"8=FIX.4.2\x019=999999999\x01" +
+                                        message)
+        received += framer.append_buffer(message[:-1] + b"0000" + message)
+        self.assertEqual([message, message], received)
+        self.assertEqual(b'', framer.pending())
+        return
+
+    def test_wire_message(self):
+        fix_msg = simplefix.FixMessage()
+        fix_msg.append_pair(8, "FIX.4.2")
+        fix_msg.append_pair(35, "D")
+        fix_msg.append_pair(95, 5)
+        fix_msg.append_pair(96, b"a\x01b=c")
+        fix_msg.append_pair(58, "one")
+        fix_msg.append_pair(58, "two")
+        buffer = fix_msg.encode()
+
+        message = WireMessage(buffer)
+        self.assertEqual(buffer, bytes(message))
+        self.assertEqual(b"D", message.get(35))
+        self.assertEqual(b"a\x01b=c", message.get(96))
+        self.assertEqual(b"two", message.get(58, 2))
+        self.assertIsNone(message.get(58, 3))
+        self.assertIsNone(message.get(1))
+        self.assertIsNone(message.get(34))
+        self.assertEqual(8, message.field_count())
+        self.assertEqual(3 * 8, len(message.index()))
+        self.assertEqual(buffer, message.to_fix_message().encode())
+
+        # Header fields come from their slots, or by scanning for a
+        # later occurrence.
+        fix_msg = simplefix.FixMessage()
+        fix_msg.append_pair(8, "FIX.4.2")
+        fix_msg.append_pair(35, "8")
+        fix_msg.append_pair(49, "SENDER")
+        fix_msg.append_pair(56, "TARGET")
+        fix_msg.append_pair(34, 12)
+        fix_msg.append_pair(52, "20180101-00:00:00.000")
+        fix_msg.append_pair(58, "x")
+        fix_msg.append_pair(34, 13)
+        message = WireMessage(fix_msg.encode())
+        self.assertEqual((b"8", b"SENDER", b"TARGET", b"12",
+                          b"20180101-00:00:00.000"),
+                         (message.get(35), message.get(49), message.get(56),
+                          message.get(34), message.get(52)))
+        self.assertEqual(b"13", message.get(34, 2))
+        self.assertIsNone(message.get(49, 2))
+
+        self.assertRaises(ValueError, WireMessage(b"8=FIX.4.2").index)
+        return
+
+    def test_stamp(self):
+        message = simplefix.FixMessage()
+        message.append_pair(8, "FIX.4.2")
+        message.append_pair(35, "D")
+        message.append_pair(49, "SENDER")
+        message.append_pair(34, 7)
+        message.append_pair(52, "20180101-00:00:00.000")
+        message.append_pair(11, "order1")
+        expected = message.encode()
+        self.assertEqual(expected,
+                         stamp(expected, 7, b"20180101-00:00:00.000"))
+
+        # Missing fields are added after MsgType, and BodyLength and
+        # CheckSum recalculated.
+        stamped = stamp(b"8=FIX.4.2\x0135=D\x0149=SENDER\x0111=order1\x01",
+                        8, b"20180101-00:00:01.000")
+        wire = WireMessage(stamped)
+        self.assertEqual([8, 9, 35, 34, 52, 49, 11, 10],
+                         [tag for tag, _ in wire.fields()])
+        self.assertEqual(b"8", wire.get(34))
+        parser = simplefix.FixParser()
+        parser.append_buffer(stamped)
+        message = parser.get_message()
+        self.assertEqual(b"20180101-00:00:01.000", message.get(52))
+        self.assertEqual(stamped, message.encode(raw=True))
+
+        self.assertRaises(ValueError, stamp, b"35=D\x01", 1, b"")
+        self.assertRaises(ValueError, stamp, b"8=FIX.4.2\x0149=S\x01", 1,
+                          b"")
+        return
+
+    def test_auto_sequence(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        c1 = proxy.create_client("c1")
+        c1.connect('localhost', peer.getsockname()[1])
+        sock1, _ = peer.accept()
+        sock1.settimeout(5)
+
+        self.assertRaises(RuntimeError, c1.configure, next_send_sequence=0)
+        c1.configure(auto_sequence=True)
+        self.assertEqual((1, 1, []), c1.sequence_numbers())
+
+        # Sent messages need only BeginString, MsgType and the body.
+        order = b"8=FIX.4.2\x0135=D\x0149=CLIENT\x0156=SERVER\x0111=a\x01"
+        c1.send(order)
+        c1.send_batch([order, order])
+        c1.configure(next_send_sequence=10)
+        c1.send(order)
+
+        framer = FixFramer()
+        messages = []
+        while len(messages) < 4:
+            messages.extend(framer.append_buffer(sock1.recv(4096)))
+        self.assertEqual([b"1", b"2", b"3", b"10"],
+                         [WireMessage(m).get(34) for m in messages])
+        parser = simplefix.FixParser()
+        parser.append_buffer(messages[0])
+        self.assertEqual(messages[0], parser.get_message().encode())
+
+        # Received sequence numbers are checked for gaps.
+        for sequence in (1, 2, 5, 6, 9):
+            sock1.sendall(stamp(b"8=FIX.4.2\x0135=0\x01", sequence, b""))
+        for _ in range(5):
+            self.assertIsNotNone(c1.receive(5))
+        self.assertEqual((11, 10, [(3, 4), (7, 8)]), c1.sequence_numbers())
+
+        c1.configure(next_receive_sequence=20)
+        self.assertEqual((11, 20, []), c1.sequence_numbers())
+
+        sock1.close()
+        peer.close()
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_session_layer(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        c1 = proxy.create_client("c1")
+        self.assertRaises(RuntimeError, c1.configure, session_layer=True,
+                          raw=True)
+        c1.configure(raw=False, session_layer=True, sender_comp_id="CLIENT",
+                     target_comp_id="SERVER", heartbeat_interval=30)
+        c1.connect('localhost', peer.getsockname()[1])
+        sock1, _ = peer.accept()
+        sock1.settimeout(5)
+        framer = FixFramer()
+        received = []
+
+        def read_message():
+            while not received:
+                received.extend(framer.append_buffer(sock1.recv(4096)))
+            return WireMessage(received.pop(0))
+
+        def send(sequence, fields):
+            message = b"8=FIX.4.2\x01" + b"".join(
+                b"%d=%s\x01" % field for field in fields)
+            sock1.sendall(stamp(message, sequence, b"20180101-00:00:00"))
+
+        logon = read_message()
+        self.assertEqual((b"A", b"1", b"CLIENT", b"30"),
+                         (logon.get(35), logon.get(34), logon.get(49),
+                          logon.get(108)))
+
+        # Messages sent before the Logon exchange completes are held.
+        order = b"8=FIX.4.2\x0135=D\x0149=CLIENT\x0156=SERVER\x0111=a\x01"
+        c1.send(order)
+        send(1, [(35, b"A"), (98, b"0"), (108, b"30")])
+        self.assertEqual(b"2", read_message().get(34))
+
+        # A gap is answered with a ResendRequest, and filled.
+        send(4, [(35, b"8"), (37, b"x")])
+        request = read_message()
+        self.assertEqual((b"2", b"2", b"0"),
+                         (request.get(35), request.get(7), request.get(16)))
+        send(2, [(35, b"4"), (43, b"Y"), (123, b"Y"), (36, b"4")])
+        send(4, [(35, b"8"), (43, b"Y"), (37, b"x")])
+        self.assertEqual(b"x", WireMessage(c1.receive(5)).get(37))
+
+        # Session-level messages are handled in the agent.
+        send(5, [(35, b"1"), (112, b"ping")])
+        heartbeat = read_message()
+        self.assertEqual((b"0", b"ping"),
+                         (heartbeat.get(35), heartbeat.get(112)))
+        send(6, [(35, b"2"), (7, b"1"), (16, b"0")])
+        gap_fill = read_message()
+        self.assertEqual((b"4", b"1", b"Y", b"5"),
+                         (gap_fill.get(35), gap_fill.get(34),
+                          gap_fill.get(123), gap_fill.get(36)))
+        self.assertEqual((5, 7, [(2, 3)]), c1.sequence_numbers())
+        self.assertEqual(0, c1.receive_queue_length())
+
+        # Malformed session-level messages don't end the session.
+        send(7, [(35, b"2"), (7, b"x"), (16, b"0")])
+        reject = read_message()
+        self.assertEqual((b"3", b"5", b"7", b"7"),
+                         (reject.get(35), reject.get(34), reject.get(45),
+                          reject.get(371)))
+        send(8, [(35, b"4"), (36, b"y")])
+        self.assertEqual((6, 8, [(2, 3)]), c1.sequence_numbers())
+        self.assertTrue(c1.is_connected())
+
+        send(8, [(35, b"5")])
+        self.assertEqual(b"5", read_message().get(35))
+        self.assertEqual(b"", sock1.recv(4096))
+        self.assertFalse(c1.is_connected())
+
+        sock1.close()
+        peer.close()
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_session_layer_recovery(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        c1 = proxy.create_client("c1")
+        c1.configure(session_layer=True, sender_comp_id="CLIENT",
+                     target_comp_id="SERVER", next_send_sequence=3)
+        c1.connect('localhost', peer.getsockname()[1])
+        sock1, _ = peer.accept()
+        sock1.settimeout(5)
+        framer = FixFramer()
+        received = []
+
+        def read_message():
+            while not received:
+                received.extend(framer.append_buffer(sock1.recv(4096)))
+            return WireMessage(received.pop(0))
+
+        def send(sequence, fields):
+            message = b"8=FIX.4.2\x01" + b"".join(
+                b"%d=%s\x01" % field for field in fields)
+            sock1.sendall(stamp(message, sequence, b"20180101-00:00:00"))
+
+        self.assertEqual(b"3", read_message().get(34))
+
+        # A reconnecting peer's Logon is ahead: the session is logged
+        # on, and then asks for the missing messages.
+        send(5, [(35, b"A"), (98, b"0"), (108, b"30")])
+        request = read_message()
+        self.assertEqual((b"2", b"4", b"1", b"0"),
+                         (request.get(35), request.get(34),
+                          request.get(7), request.get(16)))
+
+        # The peer's own ResendRequest is answered, despite the gap.
+        send(6, [(35, b"2"), (7, b"1"), (16, b"0")])
+        gap_fill = read_message()
+        self.assertEqual((b"4", b"1", b"5"),
+                         (gap_fill.get(35), gap_fill.get(34),
+                          gap_fill.get(36)))
+
+        send(1, [(35, b"4"), (43, b"Y"), (123, b"Y"), (36, b"7")])
+        send(7, [(35, b"8"), (37, b"x")])
+        self.assertEqual(b"x", WireMessage(c1.receive(5)).get(37))
+        self.assertTrue(c1.is_connected())
+        self.assertEqual((5, 8, [(1, 4)]), c1.sequence_numbers())
+
+        c1.send(b"8=FIX.4.2\x0135=D\x0149=CLIENT\x0156=SERVER\x0111=a\x01")
+        self.assertEqual(b"5", read_message().get(34))
+
+        sock1.close()
+        peer.close()
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_session_layer_server(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        s1 = proxy.create_server("s1")
+        self.assertRaises(RuntimeError, s1.configure, bad_option=True)
+        s1.configure(session_layer=True)
+        port = s1.listen()
+
+        c1 = proxy.create_client("c1")
+        c1.configure(session_layer=True, sender_comp_id="CLIENT",
+                     target_comp_id="SERVER", heartbeat_interval=5)
+        c1.connect('localhost', port)
+        self.assertEqual(1, s1.wait_for_pending_accept(5))
+        cs1 = s1.accept("cs1")
+
+        # Each side sees only the other's application messages.
+        c1.send(b"8=FIX.4.2\x0135=D\x0149=CLIENT\x0156=SERVER\x0111=a\x01")
+        order = WireMessage(cs1.receive(5))
+        self.assertEqual((b"D", b"2", b"CLIENT"),
+                         (order.get(35), order.get(34), order.get(49)))
+        cs1.send(b"8=FIX.4.2\x0135=8\x0149=SERVER\x0156=CLIENT\x0137=x\x01")
+        report = WireMessage(c1.receive(5))
+        self.assertEqual((b"8", b"2"), (report.get(35), report.get(34)))
+
+        # Logout is answered before the session closes.
+        c1.disconnect()
+        deadline = time.time() + 5
+        while cs1.is_connected() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(cs1.is_connected())
+        self.assertEqual(0, cs1.receive_queue_length())
+        self.assertEqual((4, 4, []), cs1.sequence_numbers())
+
+        c1.destroy()
+        s1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_journal(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "test.journal")
+        journal = Journal(path, 0)
+        for i in range(1, 1001):
+            journal.append(SENT, b"8=FIX.4.2\x019=9\x0134=%d\x01" % i)
+        journal.append(RECEIVED, b"8=FIX.4.2\x019=5\x0134=7\x01")
+
+        # Far-out MsgSeqNums are indexed sparsely, or if too large for
+        # a record, not at all.
+        journal.append(RECEIVED, b"8=FIX.4.2\x019=5\x0134=200000000\x01"
+                       b"8=FIX.4.2\x019=5\x0134=99999999999\x01")
+        self.assertEqual([7, 200000000], [seq for seq, _ in
+                                          journal.messages(RECEIVED, 1)])
+        journal.close()
+
+        # Reopening rebuilds the index.
+        journal = Journal(path)
+        self.assertEqual(1000, journal.last_sequence(SENT))
+        self.assertEqual([(999, b"8=FIX.4.2\x019=9\x0134=999\x01"),
+                          (1000, b"8=FIX.4.2\x019=9\x0134=1000\x01")],
+                         list(journal.messages(SENT, 999)))
+        self.assertEqual([7], [seq for seq, _ in
+                               journal.messages(RECEIVED, 1, 10)])
+        self.assertEqual(200000000, journal.last_sequence(RECEIVED))
+        self.assertIsNone(journal.get(RECEIVED, 8))
+        journal.close()
+        os.remove(path)
+
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        s1 = proxy.create_server("s1")
+        s1.configure(session_layer=True, journal=directory)
+        port = s1.listen()
+
+        c1 = proxy.create_client("c1")
+        self.assertRaises(RuntimeError, c1.configure,
+                          journal=os.path.join(directory, "missing"))
+        c1.configure(session_layer=True, sender_comp_id="CLIENT",
+                     target_comp_id="SERVER", journal=directory,
+                     journal_sync_interval=0.1)
+        c1.connect('localhost', port)
+        self.assertEqual(1, s1.wait_for_pending_accept(5))
+        cs1 = s1.accept("cs1")
+
+        for i in range(3):
+            c1.send(b"8=FIX.4.2\x0135=D\x0149=CLIENT\x0156=SERVER"
+                    b"\x0111=%d\x01" % i)
+            cs1.receive(5)
+
+        # The client's Logon is followed by its orders.
+        sent = [WireMessage(m) for m in c1.journal()]
+        self.assertEqual([b"A", b"D", b"D", b"D"],
+                         [m.get(35) for m in sent])
+        orders = c1.journal(3, 4)
+        self.assertEqual([b"1", b"2"],
+                         [WireMessage(m).get(11) for m in orders])
+        self.assertEqual(1, len(c1.journal(2, max_count=1)))
+
+        received = [WireMessage(m) for m in cs1.journal(direction="received")]
+        self.assertEqual([b"A", b"D", b"D", b"D"],
+                         [m.get(35) for m in received])
+        self.assertEqual([b"A"], [WireMessage(m).get(35)
+                                  for m in cs1.journal(direction="sent")])
+        self.assertRaises(RuntimeError, cs1.journal, direction="up")
+        for count in (-1, True, "1"):
+            request_id = proxy.send_request(
+                ClientJournalRequest("c1", 1, 0, "sent", count))
+            self.assertFalse(proxy.await_response(request_id).result)
+
+        # Responses are limited, and the proxy fetches the rest.
+        c1.send_batch([b"8=FIX.4.2\x0135=D\x0149=CLIENT\x0156=SERVER"
+                       b"\x0111=%d\x01" % i
+                       for i in range(JOURNAL_MAX_COUNT)])
+        request_id = proxy.send_request(
+            ClientJournalRequest("c1", 1, 0, "sent", None))
+        response = proxy.await_response(request_id)
+        self.assertEqual(JOURNAL_MAX_COUNT, len(response.payloads))
+        self.assertEqual(JOURNAL_MAX_COUNT + 4, len(c1.journal()))
+        self.assertEqual(JOURNAL_MAX_COUNT + 2,
+                         len(c1.journal(3, max_count=JOURNAL_MAX_COUNT + 2)))
+
+        paths = [c1.journal_path(), cs1.journal_path()]
+        for path in paths:
+            self.assertEqual(directory, os.path.dirname(path))
+
+        c1.disconnect()
+        c1.destroy()
+        s1.destroy()
+        proxy.shutdown()
+
+        for path in paths:
+            os.remove(path)
+        os.rmdir(directory)
+        return
+
+    def test_resend_messages(self):
+        directory = tempfile.mkdtemp()
+        journal = Journal(os.path.join(directory, "test.journal"))
+        count = 500000
+
+        # Every tenth message, and the first hundred of every thousand,
+        # are Heartbeats; 2000 is missing.
+        def is_admin(sequence):
+            return sequence % 10 == 0 or sequence % 1000 < 100
+
+        for sequence in range(1, count + 1):
+            if sequence != 2000:
+                journal.append_record(SENT, b"8=FIX.4.2\x019=0\x0135=%s"
+                                      b"\x0134=%d\x0152=20180101-00:00:00"
+                                      b"\x0110=000\x01" %
+                                      (b"0" if is_admin(sequence) else b"D",
+                                       sequence), sequence)
+
+        expected = []
+        for sequence in range(1, count + 1):
+            if is_admin(sequence) or sequence == 2000:
+                if expected and expected[-1][0] == b"4":
+                    expected[-1] = (b"4", expected[-1][1], sequence + 1)
+                else:
+                    expected.append((b"4", sequence, sequence + 1))
+            else:
+                expected.append((b"D", sequence, None))
+
+        session = SessionLayer(None, True, None, SequenceNumbers("test"),
+                               None)
+        session.set_journal(journal)
+        # Application messages are only stamped, not parsed.
+        resent = []
+        for message in session.resend_messages(1, count):
+            self.assertIn(b"\x0143=Y\x01", message)
+            if message_type(message) == b"D":
+                self.assertIn(b"\x01122=20180101-00:00:00\x01", message)
+                resent.append((b"D", sequence_number(message), None))
+            else:
+                wire = WireMessage(message)
+                resent.append((wire.get(35), int(wire.get(34)),
+                               int(wire.get(36))))
+        self.assertEqual(expected, resent)
+
+        journal.close()
+        os.remove(journal.path())
+        os.rmdir(directory)
+        return
+
+    def test_resend_from_journal(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        c1 = proxy.create_client("c1")
+        c1.configure(session_layer=True, sender_comp_id="CLIENT",
+                     target_comp_id="SERVER", journal=True)
+        c1.connect('localhost', peer.getsockname()[1])
+        sock1, _ = peer.accept()
+        sock1.settimeout(5)
+        framer = FixFramer()
+        received = []
+
+        def read_message():
+            while not received:
+                received.extend(framer.append_buffer(sock1.recv(65536)))
+            return WireMessage(received.pop(0))
+
+        def send(sequence, fields):
+            message = b"8=FIX.4.2\x01" + b"".join(
+                b"%d=%s\x01" % field for field in fields)
+            sock1.sendall(stamp(message, sequence, b"20180101-00:00:00"))
+
+        read_message()
+        send(1, [(35, b"A"), (98, b"0"), (108, b"30")])
+
+        # Enough orders to fill the write buffer, and a Heartbeat among
+        # them.
+        count = 20000
+        for first in range(0, count, 5000):
+            c1.send_batch([b"8=FIX.4.2\x0135=D\x0149=CLIENT\x0156=SERVER"
+                           b"\x0111=%d\x01" % i
+                           for i in range(first, first + 5000)])
+            if first == 5000:
+                send(2, [(35, b"1"), (112, b"ping")])
+        heartbeat = None
+        for sequence in range(2, count + 3):
+            message = read_message()
+            self.assertEqual(sequence, int(message.get(34)))
+            if message.get(35) == b"0":
+                heartbeat = sequence
+        self.assertIsNotNone(heartbeat)
+
+        send(3, [(35, b"2"), (7, b"1"), (16, b"0")])
+
+        # Sent while the resend is in progress, so held until it's done.
+        c1.send(b"8=FIX.4.2\x0135=D\x0149=CLIENT\x0156=SERVER"
+                b"\x0111=last\x01", False)
+
+        gap_fill = read_message()
+        self.assertEqual((b"4", b"1", b"Y", b"2"),
+                         (gap_fill.get(35), gap_fill.get(34),
+                          gap_fill.get(123), gap_fill.get(36)))
+        sequence = 2
+        order = 0
+        while sequence < count + 3:
+            message = read_message()
+            self.assertEqual((b"Y", b"%d" % sequence),
+                             (message.get(43), message.get(34)))
+            if message.get(35) == b"4":
+                self.assertEqual((heartbeat, heartbeat + 1),
+                                 (sequence, int(message.get(36))))
+            else:
+                self.assertEqual(b"%d" % order, message.get(11))
+                self.assertIsNotNone(message.get(122))
+                order += 1
+            sequence += 1
+        self.assertEqual(count, order)
+
+        last = read_message()
+        self.assertEqual((b"last", b"%d" % (count + 3), None),
+                         (last.get(11), last.get(34), last.get(43)))
+
+        path = c1.journal_path()
+        c1.destroy()
+        sock1.close()
+        peer.close()
+        proxy.shutdown()
+        os.remove(path)
+        return
+
+    def test_raw_mode(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        c1 = proxy.create_client("c1")
+        c1.connect('localhost', peer.getsockname()[1])
+        sock1, _ = peer.accept()
+
+        # Messages are queued exactly as received, even with a bad
+        # checksum, in either mode.
+        message = b"8=FIX.4.2\x019=5\x0135=0\x0110=000\x01"
+        sock1.sendall(message)
+        self.assertEqual(message, c1.receive(5))
+
+        self.assertRaises(RuntimeError, c1.configure, raw="yes")
+        c1.configure(raw=True)
+        sock1.sendall(message[:7])
+        sock1.sendall(message[7:] + message)
+        self.assertEqual(message, c1.receive(5))
+        self.assertEqual(message, c1.receive(5))
+
+        sock1.close()
+        peer.close()
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_timer_wheel(self):
+        loop = asyncio.new_event_loop()
+        wheel = TimerWheel(loop, 0.001)
+        start = loop.time()
+
+        # Delays span the first two levels of the wheel.
+        fired = []
+        delays = [0.3, 0.002, 0.05, 0.26, 0.001, 0.1]
+        for delay in delays:
+            wheel.schedule(delay, fired.append, delay)
+        cancelled = wheel.schedule(0.01, fired.append, None)
+        cancelled.cancel()
+        self.assertFalse(cancelled.is_active())
+        self.assertEqual(len(delays), len(wheel))
+
+        loop.run_until_complete(asyncio.sleep(0.4))
+        self.assertEqual(sorted(delays), fired)
+        self.assertEqual(0, len(wheel))
+        self.assertLess(start + 0.3, loop.time())
+
+        # A callback can cancel a timer expiring in the same tick.
+        fired = []
+        timers = {}
+
+        def expire(name, other):
+            fired.append(name)
+            if other:
+                timers[other].cancel()
+
+        timers["a"] = wheel.schedule(0.05, expire, "a", "b")
+        timers["b"] = wheel.schedule(0.05, expire, "b", "a")
+        wheel.schedule(0.05, expire, "c", None)
+        wheel.schedule(0.2, expire, "d", None)
+        loop.run_until_complete(asyncio.sleep(0.3))
+        self.assertEqual(3, len(fired))
+        self.assertEqual(1, len({"a", "b"} & set(fired)))
+        self.assertEqual(["c", "d"], sorted(fired)[1:])
+        self.assertEqual(0, len(wheel))
+        loop.close()
+        return
+
+    def test_heartbeat_silent_session(self):
+        loop = asyncio.new_event_loop()
+        wheel = TimerWheel(loop, 0.001)
+
+        class Entity(object):
+            def __init__(self):
+                self.sent = []
+                self.connected = True
+
+            def is_connected(self):
+                return self.connected
+
+            def send_message(self, message):
+                self.sent.append(WireMessage(message))
+
+            def disconnect(self):
+                self.connected = False
+
+        # Nothing can be sent without a header, so the timer waits.
+        entity = Entity()
+        heartbeat = Heartbeat(entity, wheel)
+        heartbeat.set_interval(0.05)
+        loop.run_until_complete(asyncio.sleep(0.3))
+        self.assertEqual(0, len(wheel))
+        self.assertEqual([], entity.sent)
+
+        # Once there is one, the silent peer is sent a Heartbeat and a
+        # TestRequest, and is then disconnected.
+        heartbeat.set_header(b"FIX.4.2", b"CLIENT", b"SERVER")
+        self.assertEqual(1, len(wheel))
+        loop.run_until_complete(asyncio.sleep(0.4))
+        self.assertFalse(entity.connected)
+        self.assertIn(b"1", [message.get(35) for message in entity.sent])
+        self.assertEqual(0, len(wheel))
+        loop.close()
+        return
+
+    def test_auto_heartbeat(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        c1 = proxy.create_client("c1")
+        c1.connect('localhost', peer.getsockname()[1])
+        sock1, _ = peer.accept()
+        sock1.settimeout(5)
+        framer = FixFramer()
+        received = []
+
+        def read_message():
+            while not received:
+                received.extend(framer.append_buffer(sock1.recv(4096)))
+            return WireMessage(received.pop(0))
+
+        self.assertRaises(RuntimeError, c1.configure, heartbeat_interval=-1)
+        c1.configure(heartbeat_interval=0.3, auto_sequence=False)
+
+        # Heartbeats follow the header of the last message sent.
+        logon = simplefix.FixMessage()
+        logon.append_pair(8, "FIX.4.2")
+        logon.append_pair(35, "A")
+        logon.append_pair(49, "CLIENT")
+        logon.append_pair(56, "SERVER")
+        logon.append_pair(34, 1)
+        logon.append_pair(108, 1)
+        c1.send(logon.encode())
+        self.assertEqual(b"A", read_message().get(35))
+
+        heartbeat = read_message()
+        self.assertEqual(b"0", heartbeat.get(35))
+        self.assertEqual(b"2", heartbeat.get(34))
+        self.assertEqual(b"CLIENT", heartbeat.get(49))
+
+        # Heartbeats imply automatic sequencing, so the test's messages
+        # don't reuse the MsgSeqNums they took.
+        news = simplefix.FixMessage()
+        news.append_pair(8, "FIX.4.2")
+        news.append_pair(35, "B")
+        news.append_pair(49, "CLIENT")
+        news.append_pair(56, "SERVER")
+        news.append_pair(34, 2)
+        news.append_pair(148, "headline")
+        c1.send(news.encode())
+        message = read_message()
+        while message.get(35) != b"B":
+            message = read_message()
+        self.assertLess(2, int(message.get(34)))
+
+        # Received TestRequests are answered.
+        request = simplefix.FixMessage()
+        request.append_pair(8, "FIX.4.2")
+        request.append_pair(35, "1")
+        request.append_pair(49, "SERVER")
+        request.append_pair(56, "CLIENT")
+        request.append_pair(34, 2)
+        request.append_pair(112, "ping")
+        sock1.sendall(request.encode())
+        message = read_message()
+        while message.get(35) != b"0" or message.get(112) is None:
+            message = read_message()
+        self.assertEqual(b"ping", message.get(112))
+
+        # A silent peer gets a TestRequest, and is then disconnected.
+        message = read_message()
+        while message.get(35) != b"1":
+            message = read_message()
+        self.assertIsNotNone(message.get(112))
+        while sock1.recv(4096):
+            pass
+        self.assertFalse(c1.is_connected())
+
+        sock1.close()
+        peer.close()
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_receive_queue_policies(self):
+        messages = [b"m%d" % i for i in range(10)]
+
+        queue = ReceiveQueue(3, "drop_oldest")
+        for message in messages:
+            self.assertTrue(queue.append(message))
+        self.assertEqual(messages[-3:], queue.take())
+        self.assertEqual(7, queue.dropped_count())
+
+        queue = ReceiveQueue(3, "drop_newest")
+        self.assertEqual([True] * 3 + [False] * 7,
+                         [queue.append(m) for m in messages])
+        self.assertEqual(messages[:3], queue.take())
+
+        queue = ReceiveQueue(3, "block")
+        for message in messages[:3]:
+            queue.append(message)
+        self.assertTrue(queue.is_blocked())
+        queue.popleft()
+        self.assertFalse(queue.is_blocked())
+
+        queue = ReceiveQueue(3, "spill")
+        for message in messages[:6]:
+            queue.append(message)
+        self.assertEqual(6, len(queue))
+        self.assertEqual(messages[:2], queue.take(max_count=2))
+        for message in messages[6:]:
+            queue.append(message)
+        self.assertEqual(messages[2:], queue.take())
+        self.assertEqual(0, len(queue))
+
+        self.assertRaises(ValueError, queue.configure, 0, "spill")
+        self.assertRaises(ValueError, queue.configure, None, "explode")
+        queue.clear()
+        return
+
+    def test_configure_queue(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        s1 = proxy.create_server("s1")
+        port = s1.listen(0)
+        c1 = proxy.create_client("c1")
+        c1.connect("localhost", port)
+        self.assertEqual(1, s1.wait_for_pending_accept(5))
+        cs1 = s1.accept("cs1")
+
+        self.assertRaises(RuntimeError, cs1.configure, colour="blue")
+        self.assertRaises(RuntimeError, cs1.configure, queue_policy="x")
+        cs1.configure(queue_capacity=2, queue_policy="drop_oldest")
+
+        messages = []
+        for seq in range(1, 6):
+            fix_msg = simplefix.FixMessage()
+            fix_msg.append_pair(8, "FIX.4.2")
+            fix_msg.append_pair(35, "0")
+            fix_msg.append_pair(34, seq)
+            messages.append(fix_msg.encode())
+        c1.send_batch(messages)
+
+        # The batch arrives in one write, and settles as one read.
+        self.wait_until(lambda: cs1.receive_queue_length() >= 2)
+        self.assertEqual(messages[-2:], cs1.receive_all())
+
+        c1.destroy()
+        s1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_client_send_batch(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        c1 = proxy.create_client("c1")
+        c1.connect('localhost', peer.getsockname()[1])
+        sock, _ = peer.accept()
+
+        messages = []
+        for seq in range(1, 101):
+            fix_msg = simplefix.FixMessage()
+            fix_msg.append_pair(8, "FIX.4.2")
+            fix_msg.append_pair(35, "D")
+            fix_msg.append_pair(34, seq)
+            messages.append(fix_msg.encode())
+        c1.send_batch(messages)
+
+        expected = b''.join(messages)
+        received = b''
+        while len(received) < len(expected):
+            received += sock.recv(65536)
+        self.assertEqual(expected, received)
+
+        sock.close()
+        peer.close()
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_client_receive_all(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        c1 = proxy.create_client("c1")
+        c1.connect('localhost', peer.getsockname()[1])
+        sock, _ = peer.accept()
+        self.assertEqual([], c1.receive_all())
+
+        messages = []
+        for seq in range(1, 6):
+            fix_msg = simplefix.FixMessage()
+            fix_msg.append_pair(8, "FIX.4.2")
+            fix_msg.append_pair(35, "8")
+            fix_msg.append_pair(34, seq)
+            messages.append(fix_msg.encode())
+        sock.sendall(b''.join(messages))
+
+        self.wait_until(
+            lambda: c1.receive_queue_length() >= len(messages))
+
+        received = c1.receive_all(max_count=2)
+        self.assertEqual(messages[:2], received)
+
+        received = c1.receive_all(max_bytes=len(messages[2]) + 1)
+        self.assertEqual(messages[2:3], received)
+
+        received = c1.receive_all()
+        self.assertEqual(messages[3:], received)
+
+        sock.close()
+        peer.close()
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_binary_and_json_frames(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+        self.assertTrue(proxy.is_binary())
+
+        json_proxy = fixtool.connect_agent("localhost", proxy._port,
+                                           unix_path=proxy._unix_path)
+        self.assertFalse(json_proxy.is_binary())
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(2)
+
+        c1 = proxy.create_client("c1")
+        c1.connect('localhost', peer.getsockname()[1])
+        sock1, _ = peer.accept()
+
+        c2 = json_proxy.create_client("c2")
+        c2.connect('localhost', peer.getsockname()[1])
+        sock2, _ = peer.accept()
+
+        fix_msg = simplefix.FixMessage()
+        fix_msg.append_pair(8, "FIX.4.2")
+        fix_msg.append_pair(35, "0")
+        fix_msg.append_pair(34, 1)
+        message = fix_msg.encode()
+
+        self.assertIsNone(c1.receive())
+        sock1.sendall(message)
+        sock2.sendall(message + message)
+        self.wait_until(lambda: c1.receive_queue_length() >= 1)
+        self.wait_until(lambda: c2.receive_queue_length() >= 2)
+
+        self.assertEqual(message, c1.receive())
+        self.assertEqual([message, message], c2.receive_all())
+
+        c1.send_batch([message, message])
+        c2.send(message)
+        self.assertEqual(message + message, sock1.recv(65536))
+        self.assertEqual(message, sock2.recv(65536))
+
+        # Bad payload lengths are refused, keeping the control session.
+        for opcode, payload in ((OP_CLIENT_GET, b"\x00\x01"),
+                                (OP_CLIENT_GET_ALL, b""),
+                                (OP_CLIENT_GET_ALL, b"\x00" * 12)):
+            request_id = proxy.send_frame(opcode, c1._handle, payload)
+            self.assertFalse(proxy.await_response(request_id).result)
+        self.assertTrue(c1.is_connected())
+
+        sock1.close()
+        sock2.close()
+        peer.close()
+        c1.destroy()
+        c2.destroy()
+        proxy.shutdown()
+        return
+
+    def test_send_unconnected(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+        json_proxy = fixtool.connect_agent("localhost", proxy._port,
+                                           unix_path=proxy._unix_path)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        fix_msg = simplefix.FixMessage()
+        fix_msg.append_pair(8, "FIX.4.2")
+        fix_msg.append_pair(35, "0")
+        message = fix_msg.encode()
+
+        # Sends are refused before connecting, and nothing is kept for
+        # the connection.
+        c1 = proxy.create_client("c1")
+        c2 = json_proxy.create_client("c2")
+        for client in (c1, c2):
+            self.assertRaises(RuntimeError, client.send, message)
+            self.assertRaises(RuntimeError, client.send_batch, [message])
+
+        c1.connect('localhost', peer.getsockname()[1])
+        sock, _ = peer.accept()
+        c1.send(message)
+        self.assertEqual(message, sock.recv(65536))
+
+        # And after disconnecting, without losing the control session.
+        c1.disconnect()
+        self.assertRaises(RuntimeError, c1.send, message)
+        self.assertRaises(RuntimeError, c1.send_batch, [message])
+        self.assertFalse(c1.is_connected())
+        self.assertFalse(c2.is_connected())
+
+        sock.close()
+        peer.close()
+        c1.destroy()
+        c2.destroy()
+        proxy.shutdown()
+        return
+
+    def test_sharded_agent(self):
+        proxy = fixtool.spawn_agent(workers=3)
+        self.assertIsNotNone(proxy)
+        self.assertTrue(proxy.is_binary())
+
+        fix_msg = simplefix.FixMessage()
+        fix_msg.append_pair(8, "FIX.4.2")
+        fix_msg.append_pair(35, "0")
+        fix_msg.append_pair(34, 1)
+        message = fix_msg.encode()
+
+        # Enough pairs that they're spread across the workers.
+        self.assertEqual({0, 1, 2}, set(zlib.crc32(b"s%d" % i) % 3
+                                        for i in range(6)))
+        pairs = []
+        for i in range(6):
+            server = proxy.create_server("s%d" % i)
+            port = server.listen(0)
+            client = proxy.create_client("c%d" % i)
+            client.connect("localhost", port)
+            self.assertEqual(1, server.wait_for_pending_accept(5))
+            session = server.accept("cs%d" % i)
+            self.assertTrue(session.is_connected())
+            pairs.append((client, session))
+
+        handles = [c._handle for c, _ in pairs] + \
+            [s._handle for _, s in pairs]
+        self.assertEqual(len(handles), len(set(handles)))
+
+        for client, session in pairs:
+            client.send(message)
+            self.assertEqual(message, session.receive(5))
+            session.send_batch([message, message])
+            self.assertEqual(message, client.receive(5))
+            self.assertEqual(message, client.receive(5))
+
+        client, session = pairs[0]
+        subscription = client.subscribe()
+        session.send(message)
+        self.assertEqual(message, subscription.get(5))
+        client.unsubscribe()
+
+        # A second proxy, using JSON requests, sees the same entities.
+        json_proxy = fixtool.connect_agent(unix_path=proxy._unix_path)
+        self.assertFalse(json_proxy.is_binary())
+        request_id = json_proxy.send_request(
+            ClientIsConnectedRequest("c3"))
+        self.assertTrue(json_proxy.await_response(request_id).connected)
+
+        proxy.reset()
+        proxy.shutdown()
+        return
+
+    def test_listen_reuse_port(self):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            self.skipTest("SO_REUSEPORT not supported")
+
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        s1 = proxy.create_server("s1")
+        self.assertRaises(RuntimeError, s1.listen, 0, backlog=0)
+        port = s1.listen(0, backlog=64, workers=2)
+
+        # Another process could share the port.
+        other = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        other.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        other.bind(('', port))
+        other.close()
+
+        s2 = proxy.create_server("s2")
+        self.assertRaises(RuntimeError, s2.listen, port)
+        proxy.shutdown()
+        return
+
+    def test_router_start_failure(self):
+        if not os.path.exists("/proc/self/task"):
+            self.skipTest("Can't list child processes")
+
+        def children():
+            pids = set()
+            for task in os.listdir("/proc/self/task"):
+                path = "/proc/self/task/%s/children" % task
+                with open(path) as f:
+                    pids.update(f.read().split())
+            return pids
+
+        busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        busy.bind(("0.0.0.0", 0))
+        busy.listen(1)
+        before = children()
+
+        # The workers are forked before the front socket fails to bind.
+        self.assertRaises(OSError, FixToolRouter, busy.getsockname()[1],
+                          None, 2)
+        self.assertEqual(set(), children() - before)
+        pattern = "fixtool-%d-w*.sock" % os.getpid()
+        self.assertEqual([], glob.glob(os.path.join(tempfile.gettempdir(),
+                                                    pattern)))
+        busy.close()
+        return
+
+    def test_bad_requests(self):
+        # Malformed requests are refused by an agent, or a sharded
+        # agent's front process, keeping the control session.
+        for workers in (None, 2):
+            proxy = fixtool.spawn_agent(workers=workers)
+            self.assertIsNotNone(proxy)
+            c1 = proxy.create_client("c1")
+
+            for payload in (b'{"type": ', b'\xff', b'[1]', b'{}',
+                            b'{"type": 3, "name": "c1"}',
+                            b'{"request_id": 99}'):
+                proxy._socket.sendall(struct.pack(">L", len(payload)) +
+                                      payload)
+                response = proxy.read_message()
+                self.assertIsInstance(response, BadRequestMessage)
+                self.assertFalse(response.result)
+            self.assertEqual(99, response.request_id)
+
+            # Short binary frames are dropped.
+            proxy._socket.sendall(struct.pack(">LBB", 2, 0, 1))
+            self.assertFalse(c1.is_connected())
+            proxy.shutdown()
+        return
+
+    def test_sharded_listen(self):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            self.skipTest("SO_REUSEPORT not supported")
+
+        proxy = fixtool.spawn_agent(workers=3)
+        self.assertIsNotNone(proxy)
+
+        s1 = proxy.create_server("s1")
+        port = s1.listen(0, backlog=256, workers=3)
+
+        peers = [socket.create_connection(("localhost", port))
+                 for _ in range(30)]
+        self.assertTrue(s1.wait_for_pending_accept(5) > 0)
+        self.wait_until(lambda: s1.pending_accept_count() == len(peers))
+
+        # The kernel spreads the connections across the workers.
+        owners = self.socket_owners(port)
+        if owners is not None:
+            self.assertEqual(len(peers), sum(owners.values()))
+            self.assertTrue(len(owners) > 1)
+
+        sessions = [s1.accept("cs%d" % i) for i in range(len(peers))]
+        self.assertEqual(0, s1.pending_accept_count())
+        self.assertRaises(RuntimeError, s1.accept, "extra")
+        self.assertEqual(len(sessions),
+                         len(set(s._handle for s in sessions)))
+
+        for session in sessions:
+            self.assertTrue(session.is_connected())
+            session.send(b"8=FIX.4.2\x01")
+        for peer in peers:
+            self.assertEqual(b"8=FIX.4.2\x01", peer.recv(100))
+            peer.close()
+
+        s1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_client_subscribe(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.bind(('localhost', 0))
+        peer.listen(1)
+
+        c1 = proxy.create_client("c1")
+        c1.connect('localhost', peer.getsockname()[1])
+        sock, _ = peer.accept()
+
+        messages = []
+        for seq in range(1, 4):
+            fix_msg = simplefix.FixMessage()
+            fix_msg.append_pair(8, "FIX.4.2")
+            fix_msg.append_pair(35, "8")
+            fix_msg.append_pair(34, seq)
+            messages.append(fix_msg.encode())
+
+        # Already queued message is pushed on subscription.
+        sock.sendall(messages[0])
+        self.wait_until(lambda: c1.receive_queue_length() >= 1)
+
+        subscription = c1.subscribe()
+        sock.sendall(messages[1] + messages[2])
+
+        received = []
+        for message in subscription:
+            received.append(message)
+            if len(received) == len(messages):
+                break
+        self.assertEqual(messages, received)
+        self.assertIsNone(subscription.get(timeout=0.1))
+
+        subscription.close()
+        sock.sendall(messages[0])
+        self.wait_until(lambda: c1.receive_queue_length() >= 1)
+        self.assertEqual(messages[0], c1.receive())
+
+        sock.close()
+        peer.close()
+        c1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_receive_timeout(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        s1 = proxy.create_server("s1")
+        port = s1.listen(0)
+        self.assertEqual(0, s1.wait_for_pending_accept(0.1))
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        timer = threading.Timer(0.2, peer.connect, (('localhost', port),))
+        timer.start()
+        self.assertEqual(1, s1.wait_for_pending_accept(5))
+        cs1 = s1.accept("cs1")
+
+        self.assertIsNone(cs1.receive(timeout=0.1))
+
+        # Bad timeouts are refused, rather than never answered.
+        for request in (SessionGetMessage("cs1", "soon"),
+                        SessionGetMessage("cs1", -1),
+                        ServerPendingAcceptCountRequest("s1", -1)):
+            request_id = proxy.send_request(request)
+            self.assertFalse(proxy.await_response(request_id).result)
+
+        fix_msg = simplefix.FixMessage()
+        fix_msg.append_pair(8, "FIX.4.2")
+        fix_msg.append_pair(35, "0")
+        fix_msg.append_pair(34, 1)
+        message = fix_msg.encode()
+
+        timer = threading.Timer(0.2, peer.sendall, (message,))
+        timer.start()
+        self.assertEqual(message, cs1.receive(timeout=5))
+
+        peer.close()
+        s1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_shared_memory(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        s1 = proxy.create_server("s1")
+        port = s1.listen(0)
+        c1 = proxy.create_client("c1")
+        c1.connect("localhost", port)
+        self.assertEqual(1, s1.wait_for_pending_accept(5))
+        cs1 = s1.accept("cs1")
+
+        messages = []
+        for seq in range(1, 11):
+            fix_msg = simplefix.FixMessage()
+            fix_msg.append_pair(8, "FIX.4.2")
+            fix_msg.append_pair(35, "D")
+            fix_msg.append_pair(34, seq)
+            messages.append(fix_msg.encode())
+
+        # Queued before attaching, so delivered through the channel.
+        c1.send(messages[0])
+        self.assertEqual(1, cs1.receive_queue_length())
+
+        # Small rings, so the agent has to wait for room.
+        c1.attach_shared_memory(256)
+        cs1.attach_shared_memory(256)
+        self.assertEqual(messages[0], cs1.receive(timeout=5))
+        self.assertIsNone(cs1.receive())
+
+        c1.send_batch(messages[1:])
+        received = []
+        while len(received) < len(messages) - 1:
+            received.extend(cs1.receive_all())
+        self.assertEqual(messages[1:], received)
+
+        cs1.send(messages[0])
+        self.assertEqual(messages[0], c1.receive(timeout=5))
+
+        # Back to the control session.
+        cs1.detach_shared_memory()
+        c1.send(messages[1])
+        self.assertEqual(messages[1], cs1.receive(timeout=5))
+
+        # Only channels a proxy created, of the right size, are mapped.
+        channel = SharedChannel.create(temporary_path(), 256)
+        with tempfile.NamedTemporaryFile() as other:
+            for path, ring_size in ((channel.path(), -1),
+                                    (channel.path(), 512),
+                                    (channel.path(), "256"),
+                                    (other.name, 256),
+                                    ("/etc/passwd", 256),
+                                    (["/tmp"], 256),
+                                    (channel.path() + "x", 256)):
+                request_id = proxy.send_request(
+                    ClientAttachMessage("c1", path, ring_size))
+                self.assertFalse(proxy.await_response(request_id).result)
+
+        # Waiting for room in a full ring is bounded.
+        agent_end = SharedChannel.open(channel.path(), 256)
+        channel.connect_doorbell()
+        message = b'x' * 100
+        self.assertRaises(TimeoutError, channel.send, [message] * 3, 0.1)
+        self.assertRaises(ConnectionError, channel.send, [message],
+                          alive=lambda: False)
+        agent_end.close()
+        self.assertRaises(ConnectionError, channel.send, [message])
+        channel.close()
+        channel.unlink()
+        c1.send(messages[2])
+        self.assertEqual(messages[2], cs1.receive(timeout=5))
+
+        c1.destroy()
+        s1.destroy()
+        proxy.shutdown()
+        return
+
+    def test_async_proxy(self):
+        proxy = fixtool.spawn_agent()
+        self.assertIsNotNone(proxy)
+
+        fix_msg = simplefix.FixMessage()
+        fix_msg.append_pair(8, "FIX.4.2")
+        fix_msg.append_pair(35, "0")
+        fix_msg.append_pair(34, 1)
+        message = fix_msg.encode()
+
+        async def run(binary):
+            aproxy = await fixtool.AsyncFixToolProxy.connect(
+                "localhost", proxy._port, binary, proxy._unix_path)
+            self.assertEqual(binary, aproxy.is_binary())
+
+            s1 = await aproxy.create_server("s1")
+            port = await s1.listen(0)
+            c1 = await aproxy.create_client("c1")
+            await c1.connect("localhost", port)
+            self.assertEqual(1, await s1.wait_for_pending_accept(5))
+            cs1 = await s1.accept("cs1")
+
+            # Outstanding requests don't block each other.
+            received, _ = await asyncio.gather(cs1.receive(timeout=5),
+                                               c1.send(message))
+            self.assertEqual(message, received)
+
+            subscription = await c1.subscribe()
+            await cs1.send_batch([message, message])
+            self.assertEqual(message, await subscription.get(5))
+            self.assertEqual(message, await subscription.get(5))
+            await subscription.close()
+            subscription = await cs1.subscribe()
+
+            await c1.destroy()
+            await s1.destroy()
+
+            # Closing fails outstanding requests, and later ones.
+            s2 = await aproxy.create_server("s2-%s" % binary)
+            await s2.listen(0)
+            waiting = asyncio.ensure_future(s2.wait_for_pending_accept(5))
+            await asyncio.sleep(0)
+            await aproxy.close()
+            with self.assertRaises(ConnectionError):
+                await asyncio.wait_for(waiting, 1)
+            self.assertIsNone(await subscription.get(1))
+            with self.assertRaises(ConnectionError):
+                await aproxy.create_client("c2")
+            return
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run(False))
+        loop.run_until_complete(run(True))
+        loop.close()
+
+        proxy.shutdown()
+        return
+
     def xxx_test_connect_disconnect(self):
         proxy = fixtool.FixToolProxy("localhost", 11011)
         client = proxy.create_client("c1")
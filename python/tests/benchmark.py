@@ -0,0 +1,149 @@
+#! /usr/bin/env python3
+##################################################################
+# fixtool
+# Copyright (C) 2017-2018, David Arnold.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##################################################################
+
+"""Measure agent throughput with each event loop implementation.
+
+Each workload runs against a freshly spawned agent: a client sends FIX
+messages to one of the agent's own server sessions, and the proxy
+collects them from the session.  Run from this directory, with the
+package on PYTHONPATH, eg.
+
+    PYTHONPATH=.. python3 benchmark.py --count 100000
+"""
+
+import argparse
+import importlib.util
+import time
+
+import simplefix
+
+import fixtool
+from fixtool.agent import EVENT_LOOPS
+
+
+def make_message(sequence: int) -> bytes:
+    """Return an encoded heartbeat message.
+
+    :param sequence: Message sequence number."""
+    fix_msg = simplefix.FixMessage()
+    fix_msg.append_pair(8, "FIX.4.2")
+    fix_msg.append_pair(35, "0")
+    fix_msg.append_pair(34, sequence)
+    fix_msg.append_pair(49, "CLIENT")
+    fix_msg.append_pair(56, "SERVER")
+    return fix_msg.encode()
+
+
+def run_single(client, session, count: int, batch: int):
+    """Send each message, and receive it, one at a time."""
+    # pylint: disable=unused-argument
+    message = make_message(1)
+    for _ in range(count):
+        client.send(message)
+        session.receive(5)
+    return
+
+
+def run_batch(client, session, count: int, batch: int):
+    """Send batches of messages, and receive whatever has arrived.
+
+    If count isn't a multiple of batch, the last batch is smaller."""
+    messages = [make_message(i + 1) for i in range(batch)]
+    received = 0
+    for start in range(0, count, batch):
+        client.send_batch(messages[:count - start])
+        received += len(session.receive_all())
+
+    while received < count:
+        message = session.receive(5)
+        if message is None:
+            raise RuntimeError("Lost messages")
+        received += 1 + len(session.receive_all())
+    return
+
+
+WORKLOADS = {"single": run_single, "batch": run_batch}
+
+
+def measure(loop: str, workload: str, count: int, batch: int) -> float:
+    """Run a workload against a new agent.
+
+    :returns: Messages per second."""
+    proxy = fixtool.spawn_agent(loop)
+    if proxy is None:
+        raise RuntimeError("Failed to spawn agent")
+
+    try:
+        server = proxy.create_server("s1")
+        port = server.listen(0)
+        client = proxy.create_client("c1")
+        client.connect("localhost", port)
+        server.wait_for_pending_accept(5)
+        session = server.accept("cs1")
+
+        start = time.perf_counter()
+        WORKLOADS[workload](client, session, count, batch)
+        elapsed = time.perf_counter() - start
+    finally:
+        proxy.shutdown()
+
+    return count / elapsed
+
+
+def main():
+    """Main function for benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=20000,
+                        help="Number of messages per workload")
+    parser.add_argument("-b", "--batch", type=int, default=100,
+                        help="Messages per batch, for the batch workload")
+    parser.add_argument("-w", "--workload", action="append",
+                        choices=sorted(WORKLOADS.keys()),
+                        help="Workload to run (default all)")
+    parser.add_argument("--loop", action="append",
+                        choices=EVENT_LOOPS,
+                        help="Event loop to measure (default all)")
+    args = parser.parse_args()
+
+    workloads = args.workload or sorted(WORKLOADS.keys())
+    loops = args.loop or list(EVENT_LOOPS)
+
+    print("%-10s %-10s %12s" % ("loop", "workload", "messages/s"))
+    for loop in loops:
+        if loop == "uvloop" and importlib.util.find_spec("uvloop") is None:
+            print("%-10s %-10s %12s" % (loop, "-", "not installed"))
+            continue
+
+        for workload in workloads:
+            rate = measure(loop, workload, args.count, args.batch)
+            print("%-10s %-10s %12.0f" % (loop, workload, rate))
+    return
+
+
+if __name__ == "__main__":
+    main()
+
+
+##################################################################